@@ -1,5 +1,6 @@
 from GenModels.GM.Distributions import Categorical, Dirichlet, TensorTransitionDirichletPrior
 from .DiscreteGraphParameters import *
+from .DiscreteGraphParameters import stackArrays, sampledFamilies, emissionSamples, groupNodes, TransitionBins, GroupTransitionBins
 import autograd.numpy as np
 from autograd import grad, value_and_grad, jacobian
 from autograd.misc.optimizers import adam, unrolledGrad
@@ -45,28 +46,66 @@ class Optimizer():
 ######################################################################
 
 class GraphSmoothedState():
+    # A sample of every hidden state from P( X | Y ).  The graph is sampled one level
+    # of msg.forwardLevels at a time and the states are kept in an int array that is
+    # indexed by node ( -1 until the node is sampled ).
 
     def __init__( self, msg, U, V ):
         self.msg = msg
-        self.node_states = {}
         self.U = U
         self.V = V
+        self.states = np.full( msg.nodes.shape[ 0 ], -1, dtype=int )
+
+    @property
+    def node_states( self ):
+        # Dict view of the sampled states
+        sampled = np.nonzero( self.states >= 0 )[ 0 ]
+        return dict( zip( sampled.tolist(), self.states[ sampled ].tolist() ) )
+
+    @staticmethod
+    def gumbelMax( log_probs ):
+        # Draw one state from every row of unnormalized log probabilities
+        return np.argmax( log_probs + np.random.gumbel( size=log_probs.shape ), axis=-1 )
 
     def __call__( self, node_list ):
-        # Compute P( x_c | x_p1..pN, Y )
-        vals = self.msg.conditionalParentChild( self.U, self.V, node_list )
+        # Sample x_c ~ P( x_c | x_p1..pN, Y ) for every node in node_list.  The parents
+        # have already been sampled, so the conditionals are stacked, indexed at the
+        # parents' states and the whole level is drawn at once
+        conditionals = dict( self.msg.conditionalParentChild( self.U, self.V, node_list ) )
 
-        for node, probs in vals:
-            parents, parent_order = self.msg.getParents( node, get_order=True )
-            if( len( parents ) == 0 ):
-                prob = probs
-            else:
-                indices = tuple( [ [ self.node_states[ p ] ] for p in parents ] )
-                prob = probs[ indices ].ravel()
+        # Not every filter returns the roots
+        roots = [ node for node in node_list if node not in conditionals ]
+        if( len( roots ) > 0 ):
+            conditionals.update( self.msg.nodeSmoothed( self.U, self.V, roots ) )
 
-            # Sample from P( x_c | x_p1..pN, Y )
-            state = Categorical.sample( nat_params=( prob, ) )[ 0 ]
-            self.node_states[ node ] = state
+        by_shape = {}
+        for node in node_list:
+            by_shape.setdefault( conditionals[ node ].shape, [] ).append( node )
+
+        nodes, log_probs = [], []
+        for shape, shape_nodes in by_shape.items():
+            shape_nodes = np.array( shape_nodes, dtype=int )
+            tables = stackArrays( [ conditionals[ node ] for node in shape_nodes ] )
+
+            n_parents = len( shape ) - 1
+            if( n_parents > 0 ):
+                parent_states = self.states[ self.msg.parentTable[ shape_nodes, :n_parents ] ]
+                assert np.all( parent_states >= 0 )
+                tables = tables[ ( np.arange( shape_nodes.shape[ 0 ] ), ) + tuple( parent_states.T ) ]
+
+            nodes.append( shape_nodes )
+            log_probs.append( tables )
+
+        # Pad the groups with different state sizes so that there is only one draw
+        K = max( [ val.shape[ 1 ] for val in log_probs ] )
+        log_probs = [ np.pad( val, ( ( 0, 0 ), ( 0, K - val.shape[ 1 ] ) ), mode='constant', constant_values=-np.inf ) for val in log_probs ]
+
+        self.states[ np.concatenate( nodes ) ] = self.gumbelMax( np.concatenate( log_probs ) )
+
+    def sample( self ):
+        for node_list in self.msg.forwardLevels:
+            self( node_list )
+        return self.states
 
 ######################################################################
 
@@ -76,11 +115,19 @@ class Gibbs( Optimizer ):
         super().__init__( msg, parameters )
         self.graph_state = None
 
+    def currentParams( self ):
+        # The parameters from the last step of the chain
+        pi0 = self.params.initial_dist.pi
+        pis = [ dist.pi for dist in self.params.transition_dists ]
+        L = self.params.emission_dist.pi
+        return pi0, pis, L
+
     def resampleStates( self, return_marginal=False ):
-        self.msg.updateParams( self.params.sampleInitialDist(), self.params.sampleTransitionDist(), self.params.sampleEmissionDist() )
+        # Sample X ~ P( X | Y, Θ ) using the Θ that was sampled at the last step
+        self.msg.updateParams( *self.currentParams() )
         self.runFilter()
         self.graph_state = GraphSmoothedState( self.msg, self.U, self.V )
-        self.msg.forwardPass( self.graph_state )
+        self.graph_state.sample()
         if( return_marginal ):
             return self.msg.marginalProb( self.U, self.V )
         return None
@@ -98,28 +145,24 @@ class Gibbs( Optimizer ):
         self.resampleParameters()
         return ret_val
 
-    def genProbHelper( self, node_list ):
-        # Compute P( X, Y | Θ )
-        for node in node_list:
-            node_state = self.graph_state.node_states[ node ]
-
-            # P( X | Θ )
-            if( self.msg.nParents( node ) == 0 ):
-                self.gen_prob += self.params.initial_dist.ilog_likelihood( np.array( [ node_state ] ) )
-            else:
-                parents, parent_order = self.msg.getParents( node, get_order=True )
-                states = tuple( [ np.array( [ self.graph_state.node_states[ p ] ] ) for p in parents ] )
-                transition_state = states + ( np.array( [ node_state ] ), )
-                self.gen_prob += self.params.transition_dist.ilog_likelihood( transition_state )
-
-            # P( Y | X, Θ )
-            emission_state = ( np.array( [ node_state ] ), np.array( [ self.msg.ys[ node ] ] ) )
-            self.gen_prob += self.params.emission_dist.ilog_likelihood( emission_state )
-
     def generativeProbability( self ):
-        self.gen_prob = 0.0
-        self.msg.forwardPass( self.genProbHelper )
-        return self.gen_prob
+        # log P( X, Y | Θ ) at the last sample of X
+        states = self.graph_state.states
+        families = sampledFamilies( self.msg, states )
+        gen_prob = 0.0
+
+        # P( X | Θ )
+        if( 0 in families ):
+            gen_prob += np.log( self.params.initial_dist.pi[ families[ 0 ][ 1 ][ :, 0 ] ] ).sum()
+        transition_bins = TransitionBins( self.msg, self.graph_state )
+        for dist in self.params.transition_dists:
+            if( dist.pi.ndim in transition_bins.counts ):
+                gen_prob += np.log( dist.pi[ tuple( transition_bins.counts[ dist.pi.ndim ] ) ] ).sum()
+
+        # P( Y | X, Θ )
+        x, y = emissionSamples( self.msg, states, self.msg.nodes )
+        gen_prob += np.log( self.params.emission_dist.pi[ x, y ] ).sum()
+        return gen_prob
 
 ######################################################################
 
@@ -128,24 +171,33 @@ class GroupGibbs( Gibbs ):
     def __init__( self, msg, parameters ):
         super().__init__( msg, parameters )
 
-    def genProbHelper( self, node_list ):
-        # Compute P( X, Y | Θ )
-        for node in node_list:
-            node_state = self.graph_state.node_states[ node ]
-            group = self.msg.node_groups[ node ]
+    def currentParams( self ):
+        pi0s = dict( [ ( group, dist.pi ) for group, dist in self.params.initial_dists.items() ] )
+        pis = dict( [ ( group, [ dist.pi for shape, dist in dists.items() ] ) for group, dists in self.params.transition_dists.items() ] )
+        Ls = dict( [ ( group, dist.pi ) for group, dist in self.params.emission_dists.items() ] )
+        return pi0s, pis, Ls
 
-            # P( X | Θ )
-            if( self.msg.nParents( node ) == 0 ):
-                self.gen_prob += self.params.initial_dists[ group ].ilog_likelihood( np.array( [ node_state ] ) )
-            else:
-                parents, parent_order = self.msg.getParents( node, get_order=True )
-                states = tuple( [ np.array( [ self.graph_state.node_states[ p ] ] ) for p in parents ] )
-                transition_state = states + ( np.array( [ node_state ] ), )
-                self.gen_prob += self.params.transition_dists[ group ].ilog_likelihood( transition_state )
-
-            # P( Y | X, Θ )
-            emission_state = ( np.array( [ node_state ] ), np.array( [ self.msg.ys[ node ] ] ) )
-            self.gen_prob += self.params.emission_dists[ group ].ilog_likelihood( emission_state )
+    def generativeProbability( self ):
+        # log P( X, Y | Θ ) at the last sample of X
+        states = self.graph_state.states
+        families = sampledFamilies( self.msg, states )
+        gen_prob = 0.0
+
+        # P( X | Θ )
+        if( 0 in families ):
+            for node, ( state, ) in zip( *families[ 0 ] ):
+                gen_prob += np.log( self.params.initial_dists[ self.msg.node_groups[ node ] ].pi[ state ] )
+        transition_bins = GroupTransitionBins( self.msg, self.graph_state, self.params.transition_dists.keys() )
+        for group, count_and_shapes in transition_bins.counts.items():
+            for shape, counts in count_and_shapes.items():
+                gen_prob += np.log( self.params.transition_dists[ group ][ shape ].pi[ tuple( counts ) ] ).sum()
+
+        # P( Y | X, Θ )
+        group_nodes = groupNodes( self.msg, self.params.emission_dists.keys() )
+        for group, dist in self.params.emission_dists.items():
+            x, y = emissionSamples( self.msg, states, group_nodes[ group ] )
+            gen_prob += np.log( dist.pi[ x, y ] ).sum()
+        return gen_prob
 
 ######################################################################
 
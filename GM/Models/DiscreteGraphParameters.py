@@ -35,6 +35,13 @@ class Parameters():
         ans += self.emission_dist.ilog_params()
         return ans
 
+    def allDists( self ):
+        # Every distribution, always in the same order
+        return [ self.initial_dist ] + list( self.transition_dists ) + [ self.emission_dist ]
+
+    def flatParams( self ):
+        return np.hstack( [ dist.pi.ravel() for dist in self.allDists() ] )
+
 class GroupParameters():
 
     def __init__( self, root_priors, transition_priors, emission_priors ):
@@ -66,47 +73,112 @@ class GroupParameters():
             ans += self.emission_dists[ group ].ilog_params()
         return ans
 
+    def allDists( self ):
+        # Every distribution, always in the same order
+        ans = []
+        for group in self.initial_dists.keys():
+            ans.append( self.initial_dists[ group ] )
+            ans.extend( self.transition_dists[ group ].values() )
+            ans.append( self.emission_dists[ group ] )
+        return ans
+
+    def flatParams( self ):
+        return np.hstack( [ dist.pi.ravel() for dist in self.allDists() ] )
+
+######################################################################
+
+def stackArrays( vals ):
+    # Same as np.array( vals ) for a list of arrays with the same shape.  autograd's
+    # np.array looks at every element of the list, so this is a lot faster on big lists
+    return np.concatenate( vals ).reshape( ( len( vals ), ) + np.shape( vals[ 0 ] ) )
+
+def sumSmoothed( smoothed, key ):
+    # Sum the smoothed probabilities ( a dict from node to array ) that share
+    # the same key.  Everything with a key is stacked and reduced with one sum
+    stacks = {}
+    for node, val in smoothed.items():
+        stacks.setdefault( key( node, val ), [] ).append( val )
+    return dict( [ ( k, stackArrays( vals ).sum( axis=0 ) ) for k, vals in stacks.items() ] )
+
+def emissionStats( msg, node_smoothed, nodes, shape ):
+    # Expected number of times that each ( state, observation ) pair is seen
+    # over nodes and the expected number of measurements in each state.
+    # The measurements are scattered into the counts with a bincount per state
+    if( len( nodes ) == 0 ):
+        return np.zeros( shape ), np.zeros( shape[ 0 ] )
+
+    probs = stackArrays( [ node_smoothed[ node ] for node in nodes ] )
+    ys = [ msg.ys[ node ] for node in nodes ]
+    measurements = np.fromiter( map( len, ys ), dtype=int, count=len( ys ) )
+
+    flat_ys = np.concatenate( ys ).astype( int )
+    weights = np.repeat( probs, measurements, axis=0 )
+    numerator = np.vstack( [ np.bincount( flat_ys, weights=weights[ :, k ], minlength=shape[ 1 ] ) for k in range( shape[ 0 ] ) ] )
+    denominator = ( probs * measurements[ :, None ] ).sum( axis=0 )
+    return numerator, denominator
+
+def groupNodes( msg, groups ):
+    # The nodes in each group
+    ans = dict( [ ( group, [] ) for group in groups ] )
+    for node in msg.nodes:
+        ans[ msg.node_groups[ node ] ].append( node )
+    return ans
+
+######################################################################
+
+def sampledFamilies( msg, states ):
+    # Split the sampled nodes by their number of parents.  Returns a dict from
+    # the number of parents to ( nodes, states of the family ) where the columns
+    # of the family states are in the order of the transition axes
+    parent_table = msg.parentTable
+    n_parents = ( parent_table >= 0 ).sum( axis=1 )
+    sampled = states >= 0
+
+    ans = {}
+    for n in np.unique( n_parents[ sampled ] ):
+        nodes = msg.nodes[ ( n_parents == n ) & sampled ]
+        family = np.hstack( ( parent_table[ nodes, :n ], nodes[ :, None ] ) )
+        ans[ int( n ) ] = ( nodes, states[ family ] )
+    return ans
+
+def emissionSamples( msg, states, nodes ):
+    # The sampled state of every measurement along with the measurements
+    nodes = [ node for node in nodes if states[ node ] >= 0 ]
+    if( len( nodes ) == 0 ):
+        return [ np.array( [], dtype=int ), np.array( [], dtype=int ) ]
+
+    ys = [ msg.ys[ node ] for node in nodes ]
+    measurements = np.fromiter( map( len, ys ), dtype=int, count=len( ys ) )
+    return [ np.repeat( states[ nodes ], measurements ), np.concatenate( ys ).astype( int ) ]
+
 ######################################################################
 
 class TransitionBins():
+    # The sampled states of every family, split by the size of the family.
+    # counts[ ndim ][ i ] are the states on the i'th axis of the transition
     def __init__( self, msg, graph_state ):
         self.msg = msg
         self.graph_state = graph_state
         self.counts = {}
-
-    def __call__( self, node_list ):
-        for node in filter( lambda n: self.msg.nParents( n ) > 0, node_list ):
-            parents, order = self.msg.getParents( node, get_order=True )
-            ndim = parents.shape[ 0 ] + 1
-            if( ndim not in self.counts ):
-                self.counts[ ndim ] = [ [] for _ in range( ndim ) ]
-            for i, p in zip( order, parents ):
-                self.counts[ ndim ][ i ].append( self.graph_state.node_states[ p ] )
-            self.counts[ ndim ][ -1 ].append( self.graph_state.node_states[ node ] )
+        for n_parents, ( nodes, family_states ) in sampledFamilies( msg, graph_state.states ).items():
+            if( n_parents > 0 ):
+                self.counts[ n_parents + 1 ] = [ family_states[ :, i ] for i in range( n_parents + 1 ) ]
 
 class GibbsParameters( Parameters ):
 
     def resampleInitialDist( self, msg, graph_state ):
-        root_states = np.array( [ state for node, state in graph_state.node_states.items() if msg.nParents( node ) == 0 ] )
+        families = sampledFamilies( msg, graph_state.states )
+        root_states = families[ 0 ][ 1 ][ :, 0 ] if 0 in families else np.array( [], dtype=int )
         self.initial_dist.resample( x=root_states )
 
     def resampleTransitionDist( self, msg, graph_state ):
         transition_bins = TransitionBins( msg, graph_state )
-        msg.forwardPass( transition_bins )
         for dist in self.transition_dists:
             ndim = dist.pi.ndim
-            x = [ np.array( count ) for count in transition_bins.counts[ ndim ] ]
-            dist.resample( x )
+            dist.resample( transition_bins.counts[ ndim ] )
 
     def resampleEmissionDist( self, msg, graph_state ):
-        states = []
-        emissions = []
-        for node in msg.nodes:
-            state = graph_state.node_states[ node ]
-            state_addition = state * np.ones_like( msg.ys[ node ] )
-            states.extend( state_addition.tolist() )
-            emissions.extend( msg.ys[ node ].tolist() )
-        x = [ np.array( states ), np.array( emissions ) ]
+        x = emissionSamples( msg, graph_state.states, msg.nodes )
         self.emission_dist.resample( x )
 
     def sampleInitialDist( self ):
@@ -125,35 +197,34 @@ class GibbsParameters( Parameters ):
 ######################################################################
 
 class GroupTransitionBins():
+    # Same as TransitionBins, but split by group and then by the shape of the transition
     def __init__( self, msg, graph_state, groups ):
         self.msg = msg
         self.graph_state = graph_state
         self.counts = dict( [ ( group, {} ) for group in groups ] )
 
-    def __call__( self, node_list ):
-        for node in filter( lambda n: self.msg.nParents( n ) > 0, node_list ):
-            group = self.msg.node_groups[ node ]
+        dims = np.array( [ msg.getNodeDim( node ) for node in msg.nodes ], dtype=int )
+        for n_parents, ( nodes, family_states ) in sampledFamilies( msg, graph_state.states ).items():
+            if( n_parents == 0 ):
+                continue
 
-            parents, order = self.msg.getParents( node, get_order=True )
-            shape = []
-            for p in parents:
-                shape.append( self.msg.getNodeDim( p ) )
-            shape.append( self.msg.getNodeDim( node ) )
-            shape = tuple( shape )
+            family = np.hstack( ( msg.parentTable[ nodes, :n_parents ], nodes[ :, None ] ) )
+            shapes = dims[ family ]
 
-            if( shape not in self.counts[ group ] ):
-                self.counts[ group ][ shape ] = [ [] for _ in shape ]
+            rows = {}
+            for i, ( node, shape ) in enumerate( zip( nodes, shapes ) ):
+                rows.setdefault( ( msg.node_groups[ node ], tuple( shape.tolist() ) ), [] ).append( i )
 
-            for i, p in zip( order, parents ):
-                self.counts[ group ][ shape ][ i ].append( self.graph_state.node_states[ p ] )
-            self.counts[ group ][ shape ][ -1 ].append( self.graph_state.node_states[ node ] )
+            for ( group, shape ), index in rows.items():
+                self.counts[ group ][ shape ] = [ family_states[ index, i ] for i in range( n_parents + 1 ) ]
 
 class GroupGibbsParameters( GroupParameters ):
 
     def resampleInitialDist( self, msg, graph_state ):
         root_states = dict( [ ( group, [] ) for group in self.initial_dists.keys() ] )
-        for node, state in graph_state.node_states.items():
-            if( msg.nParents( node ) == 0 ):
+        families = sampledFamilies( msg, graph_state.states )
+        if( 0 in families ):
+            for node, ( state, ) in zip( *families[ 0 ] ):
                 root_states[ msg.node_groups[ node ] ].append( state )
 
         for group in self.initial_dists:
@@ -161,26 +232,16 @@ class GroupGibbsParameters( GroupParameters ):
 
     def resampleTransitionDist( self, msg, graph_state ):
         transition_bins = GroupTransitionBins( msg, graph_state, self.transition_dists.keys() )
-        msg.forwardPass( transition_bins )
 
         for group, count_and_shapes in transition_bins.counts.items():
             for shape, counts in count_and_shapes.items():
                 dist = self.transition_dists[ group ][ shape ]
-                x = [ np.array( count ) for count in counts ]
-                dist.resample( x )
+                dist.resample( counts )
 
     def resampleEmissionDist( self, msg, graph_state ):
-        states = dict( [ ( group, [] ) for group in self.emission_dists.keys() ] )
-        emissions = dict( [ ( group, [] ) for group in self.emission_dists.keys() ] )
-        for node in msg.nodes:
-            group = msg.node_groups[ node ]
-            state = graph_state.node_states[ node ]
-            state_addition = state * np.ones_like( msg.ys[ node ] )
-            states[ group ].extend( state_addition.tolist() )
-            emissions[ group ].extend( msg.ys[ node ].tolist() )
-
+        group_nodes = groupNodes( msg, self.emission_dists.keys() )
         for group in self.emission_dists.keys():
-            x = [ np.array( states[ group ] ), np.array( emissions[ group ] ) ]
+            x = emissionSamples( msg, graph_state.states, group_nodes[ group ] )
             self.emission_dists[ group ].resample( x )
 
     def sampleInitialDist( self ):
@@ -207,10 +268,8 @@ class GroupGibbsParameters( GroupParameters ):
 class EMParameters( Parameters ):
 
     def updateInitialDist( self, msg, node_smoothed ):
-        initial_dist = np.zeros_like( msg.pi0 )
         # Update the root distribution
-        for root in msg.roots:
-            initial_dist += node_smoothed[ root ]
+        initial_dist = stackArrays( [ node_smoothed[ root ] for root in msg.roots ] ).sum( axis=0 )
         initial_dist /= msg.roots.size
 
         self.initial_dist.params = ( initial_dist, )
@@ -219,36 +278,23 @@ class EMParameters( Parameters ):
 
     def updateTransitionDist( self, msg, parents_smoothed, node_parents_smoothed ):
 
-        trans_dist_numerator = {}
-        trans_dist_denominator = {}
-
-        for ndim, val in msg.pis.items():
-            trans_dist_numerator[ ndim ] = np.zeros_like( val )
-            trans_dist_denominator[ ndim ] = np.zeros( val.shape[ :-1 ] )
+        # Only the nodes with parents are in the smoothed dicts, so the
+        # number of parents can be read off of the shapes
+        trans_dist_numerator = sumSmoothed( node_parents_smoothed, lambda node, val: val.ndim )
+        trans_dist_denominator = sumSmoothed( parents_smoothed, lambda node, val: val.ndim + 1 )
 
         # Update the transition distributions
-        for node in filter( lambda n: msg.nParents( n ) > 0, msg.nodes ):
-            ndim = msg.nParents( node ) + 1
-            trans_dist_numerator[ ndim ] += node_parents_smoothed[ node ]
-            trans_dist_denominator[ ndim ] += parents_smoothed[ node ]
-
         for dist in self.transition_dists:
             ndim = dist.pi.ndim
-            dist.params = ( trans_dist_numerator[ ndim ] / trans_dist_denominator[ ndim ][ ..., None ], )
+            numerator = trans_dist_numerator.get( ndim, np.zeros_like( dist.pi ) )
+            denominator = trans_dist_denominator.get( ndim, np.zeros( dist.pi.shape[ :-1 ] ) )
+            dist.params = ( numerator / denominator[ ..., None ], )
             assert np.allclose( dist.params[ 0 ].sum( axis=-1 ), 1.0 )
 
     def updateEmissionDist( self, msg, node_smoothed ):
 
-        emission_dist_numerator = np.zeros_like( msg.emission_dist )
-        emission_dist_denominator = np.zeros_like( msg.pi0 )
-
         # Update the emission distribution
-        for node, ys in zip( msg.nodes, msg.ys ):
-            measurements = ys.shape[ 0 ]
-
-            for y in ys:
-                emission_dist_numerator[ :, y ] += node_smoothed[ node ]
-            emission_dist_denominator += node_smoothed[ node ] * measurements
+        emission_dist_numerator, emission_dist_denominator = emissionStats( msg, node_smoothed, msg.nodes, msg.emission_dist.shape )
 
         self.emission_dist.params = ( emission_dist_numerator / emission_dist_denominator[ :, None ], )
         assert np.allclose( self.emission_dist.params[ 0 ].sum( axis=-1 ), 1.0 )
@@ -259,14 +305,12 @@ class GroupEMParameters( GroupParameters ):
 
     def updateInitialDist( self, msg, node_smoothed ):
 
-        initial_dists = dict( [ ( group, np.zeros_like( msg.pi0s[ group ] ) ) for group in self.initial_dists.keys() ] )
-
         # Update the root distribution
+        initial_dists = sumSmoothed( dict( [ ( root, node_smoothed[ root ] ) for root in msg.roots ] ), lambda node, val: msg.node_groups[ node ] )
+
         root_counts = dict( [ ( group, 0 ) for group in self.initial_dists.keys() ] )
         for root in msg.roots:
-            group = msg.node_groups[ root ]
-            initial_dists[ group ] += node_smoothed[ root ]
-            root_counts[ group ] += 1
+            root_counts[ msg.node_groups[ root ] ] += 1
 
         for group in self.initial_dists.keys():
             if( root_counts[ group ] > 0 ):
@@ -276,44 +320,26 @@ class GroupEMParameters( GroupParameters ):
 
     def updateTransitionDist( self, msg, parents_smoothed, node_parents_smoothed ):
 
-        trans_dist_numerator = {}
-        trans_dist_denominator = {}
-        for group, dists in self.transition_dists.items():
-            trans_dist_numerator[ group ] = {}
-            trans_dist_denominator[ group ] = {}
-            for shape, dist in dists.items():
-                trans_dist_numerator[ group ][ shape ] = np.zeros( shape )
-                trans_dist_denominator[ group ][ shape ] = np.zeros( shape[ :-1 ] )
+        # Sum over the nodes with the same group and family shape
+        key = lambda node, val: ( msg.node_groups[ node ], node_parents_smoothed[ node ].shape )
+        trans_dist_numerator = sumSmoothed( node_parents_smoothed, key )
+        trans_dist_denominator = sumSmoothed( parents_smoothed, key )
 
         # Update the transition distributions
-        for node in filter( lambda n: msg.nParents( n ) > 0, msg.nodes ):
-            group = msg.node_groups[ node ]
-            shape = node_parents_smoothed[ node ].shape
-
-            trans_dist_numerator[ group ][ shape ] += node_parents_smoothed[ node ]
-            trans_dist_denominator[ group ][ shape ] += parents_smoothed[ node ]
-
         for group in self.transition_dists.keys():
             for shape, dist in self.transition_dists[ group ].items():
-                dist.params = ( trans_dist_numerator[ group ][ shape ] / trans_dist_denominator[ group ][ shape ][ ..., None ], )
+                numerator = trans_dist_numerator.get( ( group, shape ), np.zeros( shape ) )
+                denominator = trans_dist_denominator.get( ( group, shape ), np.zeros( shape[ :-1 ] ) )
+                dist.params = ( numerator / denominator[ ..., None ], )
                 assert np.allclose( dist.params[ 0 ].sum( axis=-1 ), 1.0 )
 
     def updateEmissionDist( self, msg, node_smoothed ):
 
-        emission_dist_numerator = dict( [ ( group, np.zeros_like( msg.emission_dists[ group ] ) ) for group in self.emission_dists.keys() ] )
-        emission_dist_denominator = dict( [ ( group, np.zeros_like( msg.pi0s[ group ] ) ) for group in self.emission_dists.keys() ] )
-
         # Update the emission distribution
-        for node, ys in zip( msg.nodes, msg.ys ):
-            measurements = ys.shape[ 0 ]
-            group = msg.node_groups[ node ]
-
-            for y in ys:
-                emission_dist_numerator[ group ][ :, y ] += node_smoothed[ node ]
-            emission_dist_denominator[ group ] += node_smoothed[ node ] * measurements
-
+        nodes = groupNodes( msg, self.emission_dists.keys() )
         for group in self.emission_dists.keys():
-            self.emission_dists[ group ].params = ( emission_dist_numerator[ group ] / emission_dist_denominator[ group ][ :, None ], )
+            emission_dist_numerator, emission_dist_denominator = emissionStats( msg, node_smoothed, nodes[ group ], msg.emission_dists[ group ].shape )
+            self.emission_dists[ group ].params = ( emission_dist_numerator / emission_dist_denominator[ :, None ], )
             assert np.allclose( self.emission_dists[ group ].params[ 0 ].sum( axis=-1 ), 1.0 )
 
 ######################################################################
@@ -328,36 +354,22 @@ class VIParameters( Parameters ):
 
     def updatedInitialPrior( self, msg, node_smoothed ):
 
-        expected_initial_stats = np.zeros_like( msg.pi0 )
         # Update the root distribution
-        for root in msg.roots:
-            expected_initial_stats += node_smoothed[ root ]
+        expected_initial_stats = stackArrays( [ node_smoothed[ root ] for root in msg.roots ] ).sum( axis=0 )
 
         return ( self.initial_dist.prior.mf_nat_params[ 0 ] + self.s * expected_initial_stats, )
 
     def updatedTransitionPrior( self, msg, node_parents_smoothed ):
 
-        expected_transition_stats = {}
-
-        for ndim, val in msg.pis.items():
-            expected_transition_stats[ ndim ] = np.zeros_like( val )
-
         # Update the transition distributions
-        for node in filter( lambda n: msg.nParents( n ) > 0, msg.nodes ):
-            ndim = msg.nParents( node ) + 1
-            expected_transition_stats[ ndim ] += node_parents_smoothed[ node ]
+        expected_transition_stats = sumSmoothed( node_parents_smoothed, lambda node, val: val.ndim )
 
-        return [ ( dist.prior.mf_nat_params[ 0 ] + self.s * expected_transition_stats[ dist.pi.ndim ], ) for dist in self.transition_dists ]
+        return [ ( dist.prior.mf_nat_params[ 0 ] + self.s * expected_transition_stats.get( dist.pi.ndim, 0.0 ), ) for dist in self.transition_dists ]
 
     def updatedEmissionPrior( self, msg, node_smoothed ):
 
-        expected_emission_stats = np.zeros_like( msg.emission_dist )
-
         # Update the emission distribution
-        for node, ys in zip( msg.nodes, msg.ys ):
-
-            for y in ys:
-                expected_emission_stats[ :, y ] += node_smoothed[ node ]
+        expected_emission_stats, _ = emissionStats( msg, node_smoothed, msg.nodes, msg.emission_dist.shape )
 
         return ( self.emission_dist.prior.mf_nat_params[ 0 ] + self.s * expected_emission_stats, )
 
@@ -380,49 +392,30 @@ class GroupVIParameters( GroupParameters ):
 
     def updatedInitialPrior( self, msg, node_smoothed ):
 
-        expected_initial_stats = dict( [ ( group, np.zeros_like( msg.pi0s[ group ] ) ) for group in self.initial_dists.keys() ] )
-
         # Update the root distribution
-        for root in msg.roots:
-            group = msg.node_groups[ root ]
-            expected_initial_stats[ group ] += node_smoothed[ root ]
+        expected_initial_stats = sumSmoothed( dict( [ ( root, node_smoothed[ root ] ) for root in msg.roots ] ), lambda node, val: msg.node_groups[ node ] )
 
-        return dict( [ ( group, ( dist.prior.mf_nat_params[ 0 ] + self.s * expected_initial_stats[ group ], ) ) for group, dist in self.initial_dists.items() ] )
+        return dict( [ ( group, ( dist.prior.mf_nat_params[ 0 ] + self.s * expected_initial_stats.get( group, 0.0 ), ) ) for group, dist in self.initial_dists.items() ] )
 
     def updatedTransitionPrior( self, msg, node_parents_smoothed ):
 
-        expected_transition_stats = {}
-        for group, dists in self.transition_dists.items():
-            expected_transition_stats[ group ] = {}
-            for shape, dist in dists.items():
-                expected_transition_stats[ group ][ shape ] = np.zeros( shape )
-
         # Update the transition distributions
-        for node in filter( lambda n: msg.nParents( n ) > 0, msg.nodes ):
-            group = msg.node_groups[ node ]
-            shape = node_parents_smoothed[ node ].shape
-
-            expected_transition_stats[ group ][ shape ] += node_parents_smoothed[ node ]
+        expected_transition_stats = sumSmoothed( node_parents_smoothed, lambda node, val: ( msg.node_groups[ node ], val.shape ) )
 
         ans = {}
 
         for group in self.transition_dists.keys():
             ans[ group ] = {}
             for shape, dist in self.transition_dists[ group ].items():
-                ans[ group ][ shape ] = ( dist.prior.mf_nat_params[ 0 ] + self.s * expected_transition_stats[ group ][ shape ], )
+                ans[ group ][ shape ] = ( dist.prior.mf_nat_params[ 0 ] + self.s * expected_transition_stats.get( ( group, shape ), 0.0 ), )
 
         return ans
 
     def updatedEmissionPrior( self, msg, node_smoothed ):
 
-        expected_emission_stats = dict( [ ( group, np.zeros_like( msg.emission_dists[ group ] ) ) for group in self.emission_dists.keys() ] )
-
         # Update the emission distribution
-        for node, ys in zip( msg.nodes, msg.ys ):
-            group = msg.node_groups[ node ]
-
-            for y in ys:
-                expected_emission_stats[ group ][ :, y ] += node_smoothed[ node ]
+        nodes = groupNodes( msg, self.emission_dists.keys() )
+        expected_emission_stats = dict( [ ( group, emissionStats( msg, node_smoothed, nodes[ group ], msg.emission_dists[ group ].shape )[ 0 ] ) for group in self.emission_dists.keys() ] )
 
         return dict( [ ( group, ( dist.prior.mf_nat_params[ 0 ] + self.s * expected_emission_stats[ group ], ) ) for group, dist in self.emission_dists.items() ] )
 
@@ -0,0 +1,135 @@
+import autograd.numpy as np
+import copy
+import multiprocessing
+from GenModels.GM.Utility import rHat, effectiveSampleSize
+from .DiscreteGraphModels import GHMM
+
+__all__ = [ 'GibbsChains' ]
+
+######################################################################
+
+# The model that the chains are run on in a worker process.  It is handed to the
+# workers when they start, so with fork they share the preprocessed graphs with
+# the main process instead of getting a copy with every task
+_chain_model = None
+
+def setChainModel( model ):
+    global _chain_model
+    _chain_model = model
+
+def chainSteps( params, rng_state, n_steps, model=None ):
+    # Run n_steps of Gibbs sampling starting at params.  The random state belongs to
+    # the chain, so a chain gives the same samples no matter which process runs it.
+    # Returns the new params, the new random state and a trace of the flattened
+    # parameters and log P( X, Y | Θ ) at every step
+    model = _chain_model if model is None else model
+    model.params = params
+    model.opt.params = params
+    np.random.set_state( rng_state )
+
+    trace = []
+    for _ in range( n_steps ):
+        model.fitStep()
+        trace.append( np.hstack( ( params.flatParams(), model.generative() ) ) )
+
+    return params, np.random.get_state(), np.vstack( trace )
+
+######################################################################
+
+class GibbsChains():
+    # Runs n_chains independent Gibbs chains of a GHMM ( or GroupGHMM ) over the same
+    # graphs.  The trace has shape ( n_chains, n_samples, n_params + 1 ) where the last
+    # column is log P( X, Y | Θ ), so that R-hat and the effective sample size can be
+    # checked while sampling.  With the same seed, the chains are the same regardless
+    # of the number of workers.
+
+    def __init__( self, graphs, priors, n_chains=4, seed=None, n_workers=1, model_type=GHMM, **kwargs ):
+        assert n_chains > 1, 'Need at least 2 chains for R-hat'
+        assert n_workers >= 1
+
+        self.model = model_type( graphs, priors=priors, method='Gibbs', **kwargs )
+        self.n_chains = n_chains
+        self.n_workers = n_workers
+
+        # Every chain gets its own random state and starts at its own sample from the prior.
+        # Leave the global random state the way that we found it
+        global_rng_state = np.random.get_state()
+        self.params = []
+        self.rng_states = []
+        for seed_sequence in np.random.SeedSequence( seed ).spawn( n_chains ):
+            rng_state = np.random.RandomState( seed_sequence.generate_state( 1 )[ 0 ] ).get_state()
+            np.random.set_state( rng_state )
+            params = copy.deepcopy( self.model.params )
+            for dist in params.allDists():
+                dist.resample()
+            self.params.append( params )
+            self.rng_states.append( np.random.get_state() )
+        np.random.set_state( global_rng_state )
+
+        self.trace = np.zeros( ( n_chains, 0, self.params[ 0 ].flatParams().shape[ 0 ] + 1 ) )
+
+    ######################################################################
+
+    @property
+    def pool( self ):
+        if( hasattr( self, '_pool' ) == False ):
+            # Fork where we can so that the workers don't need to unpickle the model
+            context = multiprocessing.get_context( 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None )
+            self._pool = context.Pool( self.n_workers, initializer=setChainModel, initargs=( self.model, ) )
+        return self._pool
+
+    def cleanup( self ):
+        if( hasattr( self, '_pool' ) ):
+            self._pool.close()
+            self._pool.join()
+            delattr( self, '_pool' )
+
+    def __del__( self ):
+        self.cleanup()
+
+    ######################################################################
+
+    @property
+    def n_samples( self ):
+        return self.trace.shape[ 1 ]
+
+    def step( self, n_steps=1 ):
+        # Advance every chain by n_steps
+        args = [ ( params, rng_state, n_steps ) for params, rng_state in zip( self.params, self.rng_states ) ]
+        if( self.n_workers == 1 ):
+            global_rng_state = np.random.get_state()
+            results = [ chainSteps( *arg, model=self.model ) for arg in args ]
+            np.random.set_state( global_rng_state )
+        else:
+            results = self.pool.starmap( chainSteps, args )
+
+        self.params = [ params for params, _, _ in results ]
+        self.rng_states = [ rng_state for _, rng_state, _ in results ]
+        trace = np.concatenate( [ trace[ None ] for _, _, trace in results ], axis=0 )
+        self.trace = np.concatenate( ( self.trace, trace ), axis=1 )
+
+    ######################################################################
+
+    def diagnostics( self, burn_in=0 ):
+        # R-hat and the effective sample size of every column of the trace
+        samples = self.trace[ :, burn_in: ]
+        assert samples.shape[ 1 ] >= 4, 'Not enough samples after the burn in'
+        return rHat( samples ), effectiveSampleSize( samples )
+
+    def run( self, max_steps, check_every=10, burn_in=0, max_r_hat=1.01, min_ess=100, callback=None ):
+        # Sample until every R-hat is below max_r_hat and every effective sample size
+        # is above min_ess, or until there are max_steps samples.  Returns whether or not
+        # the chains converged.  callback( chains, r_hat, ess ) is called at every check
+        while( self.n_samples < max_steps ):
+            self.step( min( check_every, max_steps - self.n_samples ) )
+            if( self.n_samples - burn_in < 4 ):
+                continue
+
+            r_hat, ess = self.diagnostics( burn_in=burn_in )
+            if( callback is not None ):
+                callback( self, r_hat, ess )
+
+            if( np.all( r_hat < max_r_hat ) and np.all( ess >= min_ess ) ):
+                return True
+
+        return False
@@ -83,13 +83,19 @@ class LDSModel( _InferenceModel ):
             return state, dummy.state.params
         return state
 
-    def expectationMaximization( self, ys, u=None, nIters=100, monitorMarginal=10, verbose=False, preprocessKwargs={}, filterKwargs={} ):
+    def expectationMaximization( self, ys, u=None, nIters=100, monitorMarginal=10, verbose=False, preprocessKwargs={}, filterKwargs={}, statsOnly=True ):
+        # With statsOnly, the E-step only keeps the expected sufficient statistics
+        # instead of the smoothed messages for every sequence
 
         lastMarginal = 999
 
         for i in verboseRange( nIters, verbose ):
-            alphas, betas = self.state.EStep( ys=ys, u=u, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
-            self.state.params = self.state.MStep( ys, u, alphas, betas )
+            if( statsOnly ):
+                stats = self.state.EStepStats( ys=ys, u=u, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
+                self.state.params = self.state.MStepFromStats( stats )
+            else:
+                alphas, betas = self.state.EStep( ys=ys, u=u, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
+                self.state.params = self.state.MStep( ys, u, alphas, betas )
 
             marginal = self.state.last_normalizer
             if( np.isclose( marginal, lastMarginal ) ):
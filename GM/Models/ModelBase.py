@@ -54,13 +54,19 @@ class _GibbsMixin():
 
 class _EMMixin():
 
-    def expectationMaximization( self, ys, nIters=100, monitorMarginal=10, verbose=False, preprocessKwargs={}, filterKwargs={} ):
+    def expectationMaximization( self, ys, nIters=100, monitorMarginal=10, verbose=False, preprocessKwargs={}, filterKwargs={}, statsOnly=True ):
+        # With statsOnly, the E-step only keeps the expected sufficient statistics
+        # instead of the alphas and betas for every sequence
 
         lastMarginal = 999
 
         for i in verboseRange( nIters, verbose ):
-            alphas, betas = self.state.EStep( ys=ys, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
-            self.state.nat_params = self.state.MStep( ys, alphas, betas )
+            if( statsOnly ):
+                stats = self.state.EStepStats( ys=ys, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
+                self.state.nat_params = self.state.MStepFromStats( stats )
+            else:
+                alphas, betas = self.state.EStep( ys=ys, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
+                self.state.nat_params = self.state.MStep( ys, alphas, betas )
 
             marginal = self.state.last_normalizer
             if( np.isclose( marginal, lastMarginal ) ):
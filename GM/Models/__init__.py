@@ -2,4 +2,5 @@ from .HMMModel import *
 from .LDSModel import *
 from .DiscreteGraphModels import *
 from .DiscreteGraphOptimizers import *
-from .DiscreteGraphParameters import *
\ No newline at end of file
+from .DiscreteGraphParameters import *
+from .GibbsChains import *
\ No newline at end of file
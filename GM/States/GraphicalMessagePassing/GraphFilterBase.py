@@ -6,12 +6,31 @@ from functools import partial
 from collections import Iterable
 import itertools
 from GenModels.GM.Utility import fbsData
+from .MessageArena import MessageList
 
 __all__ = [ 'GraphFilter', 'GraphFilterFBS' ]
 
 ######################################################################
 
-class _filterMixin():
+class _smoothingMixin():
+
+    def normalizeJoints( self, joints ):
+        # Divide each joint by P( Y ) of the graph that its node is in.  Every
+        # joint in a graph integrates to the same P( Y ), so only integrate
+        # the first joint that we see from each graph
+        marginals = {}
+        ans = []
+        for node, joint in joints:
+            graph_index = self.graphIndex( node )
+            if( graph_index not in marginals ):
+                marginals[ graph_index ] = self.integrate( joint, axes=range( joint.ndim ) )
+            ans.append( ( node, joint - marginals[ graph_index ] ) )
+        return ans
+
+######################################################################
+######################################################################
+
+class _filterMixin( _smoothingMixin ):
     # Base message passing class for hyper graphs.
     # Will use a sparse matrix to hold graph structure
 
@@ -30,6 +49,11 @@ class _filterMixin():
     def integrate( self, integrand, axes=None ):
         assert 0
 
+    def contract( self, terms, axes ):
+        # Multiply the terms and integrate out axes.  Children should
+        # override this with something that doesn't build the full product
+        return self.integrate( self.multiplyTerms( terms=terms ), axes=axes )
+
     ######################################################################
 
     # def uBaseCase( self, roots, U ):
@@ -48,13 +72,9 @@ class _filterMixin():
 
     ######################################################################
 
-    def vDataFromMask( self, V, mask ):
+    def vDataFromSlots( self, V, slots ):
         _, _, V_data = V
-        ans = []
-        for i, mask_value in enumerate( mask ):
-            if( mask_value == True ):
-                ans.append( V_data[ i ] )
-        return ans
+        return [ V_data[ i ] for i in slots ]
 
     ######################################################################
 
@@ -83,31 +103,17 @@ class _filterMixin():
     def vData( self, U, V, node, edges=None, ndim=None ):
         # THESE MUST NOT MODIFY U OR V!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         # VERY IMPORTANT!!!!!! PROBABLY ENFORCE THIS SOMEHOW IN THE FURURE
-        V_row, V_col, V_data = V
-
-        if( ~np.any( np.in1d( V_row, node ) ) ):
-            # If the node isn't in the V object (node is a leaf)
-            ans = [ np.array( [] ) ]
-        elif( edges is None ):
-            # Return the data over all down edges
-            ans = self.vDataFromMask( V, np.in1d( V_row, node ) )
-        elif( isinstance( edges, Iterable ) and len( edges ) > 0 ):
-            # Return over only certain edges
-            mask = np.in1d( V_row, node )
-            for e in edges:
-                mask &= np.in1d( V_col, e )
-            ans = self.vDataFromMask( V, mask )
-        elif( isinstance( edges, Iterable ) and len( edges ) == 0 ):
+
+        if( isinstance( edges, Iterable ) and len( edges ) == 0 ):
             # This happens when we're not passed a down edge.  In this
             # case, we should return an empty v value, not a leaf v value
             return [ np.array( [] ) ]
-        else:
-            # Only looking at one edge
-            ans = self.vDataFromMask( V, np.in1d( V_col, edges ) )
+
+        ans = self.vDataFromSlots( V, self.vSlots( node, edges=edges ) )
 
         if( len( ans ) == 0 ):
             # If we're looking at a leaf, return all 0s
-            nVals = 1 if edges is None else len( edges )
+            nVals = 1 if edges is None or isinstance( edges, Iterable ) == False else len( edges )
             ans = []
             for _ in range( nVals ):
                 ans.append( np.array( [] ) )
@@ -144,13 +150,18 @@ class _filterMixin():
         # U over node
         # V over node for each down edge that isn't down_edge
         # Multiply U and all Vs
+        ans = self.multiplyTerms( terms=self.aTerms( U, V, node, down_edge ) )
+        return ans
+
+    def aTerms( self, U, V, node, down_edge ):
+        # The terms that a multiplies together.  u and v use these directly
+        # so that the product happens inside of their contraction
         u = self.uData( U, V, node )
 
         down_edges = self.getDownEdges( node, skip_edges=down_edge )
         vs = self.vData( U, V, node, edges=down_edges )
 
-        ans = self.multiplyTerms( terms=( u, *vs ) )
-        return ans
+        return [ u, *vs ]
 
     ######################################################################
 
@@ -189,8 +200,7 @@ class _filterMixin():
         # Multiply together the transition, emission and Vs
         # Integrate over node's (last) axis unless node is in the fbs
         # Integrate over the node's latent states which is last axis
-        integrand = self.multiplyTerms( terms=( node_transition, node_emission, *vs ) )
-        ans = self.integrate( integrand, axes=[ n_parents ] )
+        ans = self.contract( terms=( node_transition, node_emission, *vs ), axes=[ n_parents ] )
 
         return ans
 
@@ -230,18 +240,17 @@ class _filterMixin():
         # Transition prob to node
         node_transition = self.transitionProb( node )
 
-        # A over each parent (aligned according to ordering of parents)
-        parent_as = [ self.a( U, V, p, self.getUpEdges( node ) ) for p in parents ]
-        parent_as = [ self.extendAxes( p, a, i, n_parents ) for p, a, i in zip( parents, parent_as, parent_order ) if a.size > 0 ]
+        # A over each parent (aligned according to ordering of parents).  Keep
+        # the terms of each a separate so that they get multiplied in the contraction
+        up_edge = self.getUpEdges( node )
+        parent_as = [ self.extendAxes( p, a, i, n_parents ) for p, i in zip( parents, parent_order ) for a in self.aTerms( U, V, p, up_edge ) if a.size > 0 ]
 
         # B over each sibling
         sigling_bs = [ self.b( U, V, s ) for s in siblings ]
 
         # Multiply all of the terms together
         # Integrate out the parent latent states
-        integrand = self.multiplyTerms( terms=( node_transition, *parent_as, *sigling_bs ) )
-
-        node_terms = self.integrate( integrand, axes=parent_order )
+        node_terms = self.contract( terms=( node_transition, *parent_as, *sigling_bs ), axes=parent_order )
 
         # Squeeze all of the left most dims.  This is because if a parent is in
         # the fbs and we integrate out the other one, there will be an empty dim
@@ -285,17 +294,15 @@ class _filterMixin():
         n_parents = self.nParents( children[ 0 ] )
 
         # A values over each mate (aligned according to ordering of mates)
-        mate_as = [ self.a( U, V, m, edge ) for m in mates ]
-        mate_as = [ self.extendAxes( m, a, i, n_parents ) for m, a, i in zip( mates, mate_as, mate_order ) if a.size > 0  ]
+        # with the terms of each a kept separate
+        mate_as = [ self.extendAxes( m, a, i, n_parents ) for m, i in zip( mates, mate_order ) for a in self.aTerms( U, V, m, edge ) if a.size > 0 ]
 
         # B over each child
         child_bs = [ self.b( U, V, c ) for c in children ]
 
         # Multiply all of the terms together
-        integrand = self.multiplyTerms( terms=( *child_bs, *mate_as ) )
-
         # Integrate out the mates latent states
-        ans = self.integrate( integrand, axes=mate_order )
+        ans = self.contract( terms=( *child_bs, *mate_as ), axes=mate_order )
 
         # Squeeze all of the left most dims.  This is because if a parent is in
         # the fbs and we integrate out the other one, there will be an empty dim
@@ -460,15 +467,15 @@ class _filterMixin():
 
     def nodeSmoothed( self, U, V, nodes ):
         # P( x | Y )
-        return [ ( node, val - self.marginalProb( U, V, node=node ) ) for node, val in self.nodeJoint( U, V, nodes ) ]
+        return self.normalizeJoints( self.nodeJoint( U, V, nodes ) )
 
     def parentsSmoothed( self, U, V, nodes ):
         # P( x_p1..pN | Y )
-        return [ ( node, val - self.marginalProb( U, V, node=node ) ) for node, val in self.jointParents( U, V, nodes ) ]
+        return self.normalizeJoints( self.jointParents( U, V, nodes ) )
 
     def parentChildSmoothed( self, U, V, nodes ):
         # P( x_c, x_p1..pN | Y )
-        return [ ( node, val - self.marginalProb( U, V, node=node ) ) for node, val in self.jointParentChild( U, V, nodes ) ]
+        return self.normalizeJoints( self.jointParentChild( U, V, nodes ) )
 
     def conditionalParentChild( self, U, V, nodes ):
         # P( x_c | x_p1..pN, Y )
@@ -487,22 +494,27 @@ class _filterMixin():
 ######################################################################
 ######################################################################
 
-class __FBSFilterMixin():
+class __FBSFilterMixin( _smoothingMixin ):
 
     # The most important difference is use the full graph for down edge operations
     # and the partial for the up edge ones.
 
     ######################################################################
 
-    def vDataFromMask( self, V, mask ):
-        _, _, V_data = V
-        ans = []
+    def newMessageList( self, n ):
+        # Storage for n U or V messages
+        return MessageList( n )
 
-        indices = np.where( mask )[ 0 ]
-        for i in indices:
-            ans.append( V_data[ i ] )
+    def contract( self, terms, axes ):
+        # Multiply the terms and integrate out axes.  Children should
+        # override this with something that doesn't build the full product
+        return self.integrate( self.multiplyTerms( terms=terms ), axes=axes )
 
-        return ans
+    ######################################################################
+
+    def vDataFromSlots( self, V, slots ):
+        _, _, V_data = V
+        return [ V_data[ i ] for i in slots ]
 
     ######################################################################
 
@@ -535,7 +547,6 @@ class __FBSFilterMixin():
     def vData( self, U, V, node, edges=None ):
         # THESE MUST NOT MODIFY U OR V!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         # VERY IMPORTANT!!!!!! PROBABLY ENFORCE THIS SOMEHOW IN THE FURURE
-        V_row, V_col, _ = V
 
         if( self.inFeedbackSet( node, is_partial_graph_index=True ) ):
             # This is going to be empty because by construction,
@@ -549,29 +560,16 @@ class __FBSFilterMixin():
             else:
                 return fbsData( np.array( [] ), -1 )
 
-        if( ~np.any( np.in1d( V_row, node ) ) ):
-            # If the node isn't in the V object (node is a leaf)
-            ans = [ fbsData( np.array( [] ), -1 ) ]
-        elif( edges is None ):
-            # Return the data over all down edges
-            ans = self.vDataFromMask( V, np.in1d( V_row, node ) )
-        elif( isinstance( edges, Iterable ) and len( edges ) > 0 ):
-            # Return over only certain edges
-            mask = np.in1d( V_row, node )
-            for e in edges:
-                mask &= np.in1d( V_col, e )
-            ans = self.vDataFromMask( V, mask )
-        elif( isinstance( edges, Iterable ) and len( edges ) == 0 ):
+        if( isinstance( edges, Iterable ) and len( edges ) == 0 ):
             # This happens when we're not passed a down edge.  In this
             # case, we should return an empty v value, not a leaf v value
             return [ fbsData( np.array( [] ), -1 ) ]
-        else:
-            # Only looking at one edge
-            ans = self.vDataFromMask( V, np.in1d( V_col, edges ) )
+
+        ans = self.vDataFromSlots( V, self.vSlots( node, edges=edges ) )
 
         if( len( ans ) == 0 ):
             # If we're looking at a leaf, return all 0s
-            nVals = 1 if edges is None else len( edges )
+            nVals = 1 if edges is None or isinstance( edges, Iterable ) == False else len( edges )
             ans = []
             for _ in range( nVals ):
                 ans.append( fbsData( np.array( [] ), -1 ) )
@@ -589,6 +587,10 @@ class __FBSFilterMixin():
         if( isinstance( down_edge, Iterable ) ):
             assert len( down_edge ) > 0
 
+        ans = self.multiplyTerms( terms=self.aTerms( U, V, node, down_edge ) )
+        return ans
+
+    def aTerms( self, U, V, node, down_edge ):
         u = self.uData( U, V, node )
 
         down_edges = self.getDownEdges( node, skip_edges=down_edge,
@@ -596,8 +598,7 @@ class __FBSFilterMixin():
                                               use_partial_graph=True )
         vs = self.vData( U, V, node, edges=down_edges )
 
-        ans = self.multiplyTerms( terms=( u, *vs ) )
-        return ans
+        return [ u, *vs ]
 
     ######################################################################
 
@@ -626,8 +627,7 @@ class __FBSFilterMixin():
         # Multiply together the transition, emission and Vs
         # Integrate over node's (last) axis unless node is in the fbs
         # Integrate over the node's latent states which is last axis
-        integrand = self.multiplyTerms( terms=( node_transition, node_emission, *vs ) )
-        ans = self.integrate( integrand, axes=[ n_parents ] )
+        ans = self.contract( terms=( node_transition, node_emission, *vs ), axes=[ n_parents ] )
 
         return ans
 
@@ -653,18 +653,16 @@ class __FBSFilterMixin():
         # Transition prob to node
         node_transition = self.transitionProb( node, is_partial_graph_index=True )
 
-        # A over each parent (aligned according to ordering of parents)
-        parent_as = [ self.a( U, V, p, up_edge ) for p in parents ]
-        parent_as = [ self.extendAxes( p, a, i, n_parents ) for p, a, i in zip( parents, parent_as, parent_order ) if a.size > 0 ]
+        # A over each parent (aligned according to ordering of parents).  Keep
+        # the terms of each a separate so that they get multiplied in the contraction
+        parent_as = [ self.extendAxes( p, a, i, n_parents ) for p, i in zip( parents, parent_order ) for a in self.aTerms( U, V, p, up_edge ) if a.size > 0 ]
 
         # B over each sibling
         sigling_bs = [ self.b( U, V, s ) for s in siblings ]
 
         # Multiply all of the terms together
         # Integrate out the parent latent states
-        integrand = self.multiplyTerms( terms=( node_transition, *parent_as, *sigling_bs ) )
-
-        node_terms = self.integrate( integrand, axes=parent_order )
+        node_terms = self.contract( terms=( node_transition, *parent_as, *sigling_bs ), axes=parent_order )
 
         # Squeeze all of the left most dims.  This is because if a parent is in
         # the fbs and we integrate out the other one, there will be an empty dim
@@ -699,17 +697,15 @@ class __FBSFilterMixin():
                                                   use_partial_graph=False )
 
         # A values over each mate (aligned according to ordering of mates)
-        mate_as = [ self.a( U, V, m, edge ) for m in mates ]
-        mate_as = [ self.extendAxes( m, a, i, n_parents ) for m, a, i in zip( mates, mate_as, mate_order ) if a.size > 0  ]
+        # with the terms of each a kept separate
+        mate_as = [ self.extendAxes( m, a, i, n_parents ) for m, i in zip( mates, mate_order ) for a in self.aTerms( U, V, m, edge ) if a.size > 0 ]
 
         # B over each child
         child_bs = [ self.b( U, V, c ) for c in children ]
 
         # Multiply all of the terms together
-        integrand = self.multiplyTerms( terms=( *child_bs, *mate_as ) )
-
         # Integrate out the mates latent states
-        ans = self.integrate( integrand, axes=mate_order )
+        ans = self.contract( terms=( *child_bs, *mate_as ), axes=mate_order )
 
         # Squeeze all of the left most dims.  This is because if a parent is in
         # the fbs and we integrate out the other one, there will be an empty dim
@@ -1080,15 +1076,15 @@ class __FBSFilterMixin():
 
     def nodeSmoothed( self, U, V, nodes ):
         # P( x | Y )
-        return [ ( node, val - self.marginalProb( U, V, node=node ) ) for node, val in self.nodeJoint( U, V, nodes ) ]
+        return self.normalizeJoints( self.nodeJoint( U, V, nodes ) )
 
     def parentsSmoothed( self, U, V, nodes ):
         # P( x_p1..pN | Y )
-        return [ ( node, val - self.marginalProb( U, V, node=node ) ) for node, val in self.jointParents( U, V, nodes ) ]
+        return self.normalizeJoints( self.jointParents( U, V, nodes ) )
 
     def parentChildSmoothed( self, U, V, nodes ):
         # P( x_c, x_p1..pN | Y )
-        return [ ( node, val - self.marginalProb( U, V, node=node ) ) for node, val in self.jointParentChild( U, V, nodes ) ]
+        return self.normalizeJoints( self.jointParentChild( U, V, nodes ) )
 
     def conditionalParentChild( self, U, V, nodes ):
         # P( x_c | x_p1..pN, Y )
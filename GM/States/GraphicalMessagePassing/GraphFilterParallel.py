@@ -1,13 +1,15 @@
 import itertools
 from functools import partial, lru_cache
 import autograd.numpy as np
-from GenModels.GM.Utility import fbsData, logsumexp
+from GenModels.GM.Utility import fbsData, logsumexp, logContract
 from collections import namedtuple, Iterable
 from .GraphFilterBase import GraphFilterFBS
 import joblib
+import multiprocessing
 from multiprocessing import Pool, cpu_count
 from multiprocessing.pool import ThreadPool
 from threading import Lock
+from .MessageArena import MessageList
 
 __all__ = [ 'GraphFilterFBSParallel', 'GraphFilterFBSSVAE' ]
 
@@ -150,6 +152,38 @@ def nonFBSMultiplyTerms( terms ):
 
 ######################################################################
 
+def alignTerms( terms ):
+    # Remove the empty terms and pad the axes of each term so that
+    # the fbs axes start at the same place for every term.  Returns
+    # the data of the terms and where the fbs axes start
+
+    terms = [ t for t in terms if np.prod( t.shape ) > 1 ]
+
+    if( len( terms ) == 0 ):
+        return [], -1
+
+    # Separate out where the feedback set axes start and get the largest fbs_axis.
+    # Need to handle case where ndim of term > all fbs axes
+    fbs_axes_start = [ term.fbs_axis for term in terms ]
+    terms = [ term.data for term in terms ]
+
+    if( max( fbs_axes_start ) != -1 ):
+        max_fbs_axis = max( [ ax if ax != -1 else term.ndim for ax, term in zip( fbs_axes_start, terms ) ] )
+
+        if( max_fbs_axis > 0 ):
+            # Pad extra dims at each term so that the fbs axes start the same way for every term
+            for i, ax in enumerate( fbs_axes_start ):
+                if( ax == -1 ):
+                    for _ in range( max_fbs_axis - terms[ i ].ndim + 1 ):
+                        terms[ i ] = terms[ i ][ ..., None ]
+                else:
+                    for _ in range( max_fbs_axis - ax ):
+                        terms[ i ] = np.expand_dims( terms[ i ], axis=ax )
+    else:
+        max_fbs_axis = -1
+
+    return terms, max_fbs_axis
+
 def multiplyTerms( terms ):
     # Basically np.einsum but in log space
 
@@ -180,33 +214,11 @@ def multiplyTerms( terms ):
         print( terms )
         assert 0
 
-    # Remove the empty terms
-    terms = [ t for t in terms if np.prod( t.shape ) > 1 ]
+    terms, max_fbs_axis = alignTerms( terms )
 
     if( len( terms ) == 0 ):
         return fbsData( np.array( [] ), 0 )
 
-    # Separate out where the feedback set axes start and get the largest fbs_axis.
-    # Need to handle case where ndim of term > all fbs axes
-    # terms, fbs_axes_start = list( zip( *terms ) )
-    fbs_axes_start = [ term.fbs_axis for term in terms ]
-    terms = [ term.data for term in terms ]
-
-    if( max( fbs_axes_start ) != -1 ):
-        max_fbs_axis = max( [ ax if ax != -1 else term.ndim for ax, term in zip( fbs_axes_start, terms ) ] )
-
-        if( max_fbs_axis > 0 ):
-            # Pad extra dims at each term so that the fbs axes start the same way for every term
-            for i, ax in enumerate( fbs_axes_start ):
-                if( ax == -1 ):
-                    for _ in range( max_fbs_axis - terms[ i ].ndim + 1 ):
-                        terms[ i ] = terms[ i ][ ..., None ]
-                else:
-                    for _ in range( max_fbs_axis - ax ):
-                        terms[ i ] = np.expand_dims( terms[ i ], axis=ax )
-    else:
-        max_fbs_axis = -1
-
     ndim = max( [ len( term.shape ) for term in terms ] )
 
     axes = [ [ i for i, s in enumerate( t.shape ) if s != 1 ] for t in terms ]
@@ -279,6 +291,22 @@ def integrate( integrand, axes ):
 
 ######################################################################
 
+def contract( terms, axes ):
+    # integrate( multiplyTerms( terms ), axes ) without building the full product
+    assert isinstance( axes, Iterable )
+    if( len( axes ) == 0 ):
+        return multiplyTerms( terms )
+
+    terms, fbs_axis = alignTerms( terms )
+    ans = logContract( terms, axes )
+
+    if( fbs_axis > -1 ):
+        fbs_axis -= len( axes )
+
+    return fbsData( ans, fbs_axis )
+
+######################################################################
+
 def extendAxes( term, target_axis, max_dim ):
     # Push the first axis out to target_axis, but don't change
     # the axes past max_dim
@@ -304,6 +332,10 @@ def aWork( full_n_parents, u, vs, order ):
     term = multiplyTerms( terms=( u, *vs ) )
     return extendAxes( term, order, full_n_parents )
 
+def aTermsWork( full_n_parents, u, vs, order ):
+    # The terms of aWork, kept separate so that they get multiplied in the contraction
+    return [ extendAxes( term, order, full_n_parents ) for term in ( u, *vs ) if term.size > 0 ]
+
 ######################################################################
 
 def bWorkFBS( transition, emission ):
@@ -312,20 +344,19 @@ def bWorkFBS( transition, emission ):
 def bWork( full_n_parents, transition, emission, vs ):
     emission = extendAxes( emission, full_n_parents, full_n_parents + 1 )
     vs = [ extendAxes( v, full_n_parents, full_n_parents + 1 ) for v in vs ]
-    integrand = multiplyTerms( terms=( transition, emission, *vs ) )
-    return integrate( integrand, axes=[ full_n_parents ] )
+    return contract( terms=( transition, emission, *vs ), axes=[ full_n_parents ] )
 
 ######################################################################
 
 def uWork( node_data ):
 
     # A over each parent (aligned according to ordering of parents)
-    parent_as = [ None for _ in node_data.partial_parents ]
+    parent_as = []
     for i, order in enumerate( node_data.partial_parents_order ):
-        parent_as[ i ] = aWork( node_data.full_n_parents,
-                                node_data.partial_parent_us[ i ],
-                                node_data.partial_parent_vs[ i ],
-                                order )
+        parent_as.extend( aTermsWork( node_data.full_n_parents,
+                                      node_data.partial_parent_us[ i ],
+                                      node_data.partial_parent_vs[ i ],
+                                      order ) )
     # B over each sibling
     sibling_bs = [ None for _ in node_data.full_siblings ]
     for i, s in enumerate( node_data.full_siblings ):
@@ -341,8 +372,7 @@ def uWork( node_data ):
 
     # Multiply all of the terms together
     # Integrate out the parent latent states
-    integrand = multiplyTerms( terms=( node_data.shape_corrected_transition_distribution, *parent_as, *sibling_bs ) )
-    node_terms = integrate( integrand, axes=node_data.partial_parents_order )
+    node_terms = contract( terms=( node_data.shape_corrected_transition_distribution, *parent_as, *sibling_bs ), axes=node_data.partial_parents_order )
 
     # Squeeze all of the left most dims.  This is because if a parent is in
     # the fbs and we integrate out the other one, there will be an empty dim
@@ -363,12 +393,12 @@ def uWork( node_data ):
 def vWork( node_data ):
 
     # A values over each mate (aligned according to ordering of mates)
-    mate_as = [ None for _ in node_data.partial_mates ]
+    mate_as = []
     for i, order in enumerate( node_data.partial_mates_order ):
-        mate_as[ i ] = aWork( node_data.full_n_parents,
-                              node_data.partial_mate_us[ i ],
-                              node_data.partial_mate_vs[ i ],
-                              order )
+        mate_as.extend( aTermsWork( node_data.full_n_parents,
+                                    node_data.partial_mate_us[ i ],
+                                    node_data.partial_mate_vs[ i ],
+                                    order ) )
     # B over each child
     child_bs = [ None for _ in node_data.full_children ]
     for i, s in enumerate( node_data.full_children ):
@@ -385,8 +415,7 @@ def vWork( node_data ):
 
     # Multiply all of the terms together
     # Integrate out the mates latent states
-    integrand = multiplyTerms( terms=( *child_bs, *mate_as ) )
-    ans = integrate( integrand, axes=node_data.partial_mates_order )
+    ans = contract( terms=( *child_bs, *mate_as ), axes=node_data.partial_mates_order )
 
     # Squeeze all of the left most dims.  This is because if a parent is in
     # the fbs and we integrate out the other one, there will be an empty dim
@@ -566,6 +595,29 @@ def conditionalParentChildSingleNode( node_data ):
 
     return nonFBSMultiplyTerms( terms=( parents_child_joint, -parents_joint ) )
 
+######################################################################
+
+# The filter that a worker process runs on.  It is handed to the workers when
+# they fork, so they already have the graphs and parameters and the tasks
+# only need to say which graphs to filter
+_graph_filter = None
+
+# U and V of a worker process.  A task writes every message of its own graphs
+# and the graphs don't share nodes, so they can be reused between tasks
+_graph_filter_probs = None
+
+def setGraphFilter( graph_filter ):
+    global _graph_filter, _graph_filter_probs
+    _graph_filter = graph_filter
+    _graph_filter_probs = None
+
+def filterGraphsWork( graph_indices ):
+    global _graph_filter_probs
+    if( _graph_filter_probs is None ):
+        _graph_filter_probs = _graph_filter.genFilterProbs()
+    U, V = _graph_filter_probs
+    return _graph_filter.filterGraphs( graph_indices, U=U, V=V )
+
 ######################################################################
 ######################################################################
 ######################################################################
@@ -577,15 +629,23 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
         self.cachedTransition.cache_clear()
         self.cachedEmission.cache_clear()
 
+        # The workers were forked with the old graphs and parameters
+        self.closeFilterPool()
+
     ######################################################################
 
+    def closeFilterPool( self ):
+        if( hasattr( self, '_filter_process_pool' ) ):
+            self._filter_process_pool.close()
+            delattr( self, '_filter_process_pool' )
+
     def cleanup( self ):
-        self.u_filter_process_pool.close()
-        self.v_filter_process_pool.close()
-        self.data_thread_pool.close()
-        delattr( self, '_u_filter_process_pool' )
-        delattr( self, '_v_filter_process_pool' )
-        delattr( self, '_data_thread_pool' )
+        # Only close the pools that were actually created
+        self.closeFilterPool()
+        for name in [ '_u_filter_process_pool', '_v_filter_process_pool', '_data_thread_pool' ]:
+            if( hasattr( self, name ) ):
+                getattr( self, name ).close()
+                delattr( self, name )
 
     def __del__( self ):
         self.cleanup()
@@ -606,6 +666,30 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
 
     ######################################################################
 
+    @property
+    def n_workers( self ):
+        # Number of processes that the graphs are filtered on.  With 1 worker
+        # everything runs in this process
+        if( hasattr( self, '_n_workers' ) == False ):
+            self._n_workers = 1
+        return self._n_workers
+
+    @n_workers.setter
+    def n_workers( self, val ):
+        self.closeFilterPool()
+        self._n_workers = val
+
+    @property
+    def filter_process_pool( self ):
+        if( hasattr( self, '_filter_process_pool' ) == False ):
+            # Fork where we can so that the workers start with the graphs and parameters
+            # instead of unpickling them.  This is only created once the parameters are set
+            context = multiprocessing.get_context( 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None )
+            self._filter_process_pool = context.Pool( self.n_workers, initializer=setGraphFilter, initargs=( self, ) )
+        return self._filter_process_pool
+
+    ######################################################################
+
     @property
     def data_thread_pool( self ):
         if( hasattr( self, '_data_thread_pool' ) == False ):
@@ -707,13 +791,11 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
     def lock( self ):
 
         if( self.u_filter_result is not None ):
-            # new_u = self.u_filter_result.get()
             new_u = self.u_filter_result
             self.updateU( self.last_u_nodes, new_u, self.last_u )
             self.u_filter_result = None
 
         if( self.v_filter_result is not None ):
-            # new_v = self.v_filter_result.get()
             new_v = self.v_filter_result
             self.updateV( self.last_v_nodes, self.last_v_edges, new_v, self.last_v )
             self.v_filter_result = None
@@ -794,7 +876,6 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
             work = uWork
 
         self.u_filter_result = [ work( d ) for d in data ]
-        # self.u_filter_result = self.u_filter_process_pool.map_async( work, data )
 
         self.last_u_nodes = nodes
         self.last_u = U
@@ -849,12 +930,9 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
             # Nothing actually happens here
             return
 
-        # Processing can't pickle this class
-        # data = self.data_thread_pool.starmap( self.vLocalInfo, zip( *nodes_and_edges, itertools.repeat( U ), itertools.repeat( V ) ) )
         data = [ self.vLocalInfo( node, edge, U, V ) for node, edge in zip( *nodes_and_edges ) ]
 
         self.v_filter_result = [ vWork( d ) for d in data ]
-        # self.v_filter_result = self.v_filter_process_pool.map_async( vWork, data )
 
         nodes, edges = nodes_and_edges
         self.last_v_nodes = nodes
@@ -863,8 +941,64 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
 
     ######################################################################
 
+    def filterGraphs( self, graph_indices, U=None, V=None ):
+        # Filter only the graphs in graph_indices.  The graphs don't share any
+        # nodes, so this just skips the nodes of the other graphs.  Returns the
+        # partial graph nodes and V slots that were filled in along with their messages
+        partial_graph_indices = np.searchsorted( self.full_graph.parent_graph_assignments, self.partial_to_full, side='right' ) - 1
+        keep = np.in1d( partial_graph_indices, graph_indices )
+
+        def uFilter( is_base_case, nodes, U, V ):
+            self.uFilter( is_base_case, nodes[ keep[ nodes ] ], U, V )
+
+        def vFilter( is_base_case, nodes_and_edges, U, V ):
+            if( is_base_case ):
+                # Nothing happens for the base case
+                return
+            nodes, edges = nodes_and_edges
+            self.vFilter( is_base_case, ( nodes[ keep[ nodes ] ], edges[ keep[ nodes ] ] ), U, V )
+
+        self.partial_graph.lock = self.lock
+
+        if( U is None ):
+            U, V = self.genFilterProbs()
+        self.partial_graph.upDown( uFilter, vFilter, U=U, V=V )
+
+        V_row, V_col, V_data = V
+        u_nodes = self.partial_graph.nodes[ keep[ self.partial_graph.nodes ] ]
+        v_slots = np.arange( len( V_data ) )[ keep[ V_row ] ]
+        return u_nodes, [ U[ node ] for node in u_nodes ], v_slots, [ V_data[ i ] for i in v_slots ]
+
+    def graphBatches( self ):
+        # Split the graphs into a few tasks per worker with about the same number
+        # of nodes in each.  Having more tasks than workers evens out the graphs
+        # that take longer to filter than their size suggests
+        starts = np.array( self.full_graph.parent_graph_assignments )
+        sizes = np.diff( np.append( starts, self.full_graph.pmask.shape[ 0 ] ) )
+        n_batches = min( len( starts ), 4 * self.n_workers )
+
+        batches = [ [] for _ in range( n_batches ) ]
+        totals = np.zeros( n_batches )
+        for graph_index in np.argsort( -sizes, kind='stable' ):
+            i = np.argmin( totals )
+            batches[ i ].append( int( graph_index ) )
+            totals[ i ] += sizes[ graph_index ]
+        return batches
+
     def filter( self ):
 
+        if( self.n_workers > 1 and len( self.full_graph.parent_graph_assignments ) > 1 ):
+            # Each worker filters whole graphs.  Only the graph indices go to the
+            # workers and only the messages of those graphs come back
+            U, V = self.genFilterProbs()
+            V_row, V_col, V_data = V
+            for u_nodes, us, v_slots, vs in self.filter_process_pool.imap_unordered( filterGraphsWork, self.graphBatches() ):
+                for node, u in zip( u_nodes, us ):
+                    U[ node ] = u
+                for i, v in zip( v_slots, vs ):
+                    V_data[ i ] = v
+            return U, V
+
         self.partial_graph.lock = self.lock
 
         U, V = self.genFilterProbs()
@@ -1042,7 +1176,7 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
         # marginal = self.marginalProb( U, V )
         # return [ ( node, val - marginal ) for node, val in self.nodeJoint( U, V, nodes ) ]
         if( parent_child_smoothed is None ):
-            return [ ( node, val - self.marginalProb( U, V, node=node ) ) for node, val in self.nodeJoint( U, V, nodes ) ]
+            return self.normalizeJoints( self.nodeJoint( U, V, nodes ) )
 
         # Don't need to repeat computations.  In this case, just integrate out the child axis
         ans = []
@@ -1059,7 +1193,7 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
         # P( x_p1..pN | Y )
         # Mostly assuming that these will be called from within the graph
         if( parent_child_smoothed is None ):
-            return [ ( node, val - self.marginalProb( U, V, node=node ) ) for node, val in self.jointParents( U, V, nodes ) ]
+            return self.normalizeJoints( self.jointParents( U, V, nodes ) )
 
         # Don't need to repeat computations.  In this case, just integrate out the child axis
         return [ ( node, nonFBSIntegrate( with_child, axes=[ -1 ] ) ) for node, with_child in parent_child_smoothed ]
@@ -1067,7 +1201,7 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
     def parentChildSmoothed( self, U, V, nodes ):
         # P( x_c, x_p1..pN | Y )
         # Mostly assuming that these will be called from within the graph
-        return [ ( node, val - self.marginalProb( U, V, node=node ) ) for node, val in self.jointParentChild( U, V, nodes ) ]
+        return self.normalizeJoints( self.jointParentChild( U, V, nodes ) )
 
     def conditionalParentChild( self, U, V, nodes, parent_child_smoothed=None ):
         # P( x_c | x_p1..pN, Y )
@@ -1089,7 +1223,11 @@ class GraphFilterFBSParallel( GraphFilterFBS ):
         # data = self.data_thread_pool.starmap( self.jointParentChildLocalInfo, zip( non_roots, itertools.repeat( U ), itertools.repeat( V ) ) )
         # data = [ self.jointParentChildLocalInfo( node, U, V ) for node in non_roots ]
         data = [ self.jointParentChildLocalInfo( n, U, V ) for n in non_roots ]
-        joints = self.u_filter_process_pool.map( conditionalParentChildSingleNode, data )
+        if( self.n_workers > 1 ):
+            joints = self.filter_process_pool.map( conditionalParentChildSingleNode, data )
+        else:
+            # Run here so that this also works inside of a worker process ( like the Gibbs chains )
+            joints = [ conditionalParentChildSingleNode( d ) for d in data ]
         return itertools.chain( zip( non_roots, joints ), self.nodeSmoothed( U, V, roots ) )
 
 ######################################################################
@@ -1103,6 +1241,7 @@ class GraphFilterFBSSVAE( GraphFilterFBSParallel ):
 
     def clearCache( self ):
         super( GraphFilterFBSParallel, self ).clearCache()
+        self.closeFilterPool()
 
     def cachedTransition( self, node ):
         return self.transitionProb( node, is_partial_graph_index=True )
@@ -4,16 +4,20 @@ from GenModels.GM.States.GraphicalMessagePassing.GraphFilterParallel import *
 # import autograd.numpy as np
 import autograd.numpy as np
 from functools import partial
+import itertools
 from scipy.sparse import coo_matrix
 from collections import Iterable
-from GenModels.GM.Utility import fbsData, logsumexp
+from GenModels.GM.Utility import fbsData, logsumexp, logContract
 from .NumbaWrappers import *
+from .GraphFilterParallel import alignTerms, contract
 
 __all__ = [ 'GraphHMM',
             'GraphHMMFBS',
             'GraphHMMFBSParallel',
             'GraphHMMFBSGroup',
             'GraphHMMFBSGroupParallel',
+            'GraphHMMMaxProduct',
+            'GraphHMMFBSMaxProduct',
             'GraphDiscreteSVAE',
             'GraphDiscreteGroupSVAE',
             'GraphDiscreteSVAEConditioned',
@@ -23,9 +27,7 @@ class _graphHMMMixin():
 
     def assignV( self, V, node, val, keep_shape=False ):
         V_row, V_col, V_data = V
-        N = V_row.shape[ 0 ]
-        VIndices = np.where( np.in1d( V_row, node ) )[ 0 ]
-        for i in VIndices:
+        for i in self.vSlots( node ):
             if( keep_shape is False ):
                 V_data[ i ] = val
             else:
@@ -35,21 +37,14 @@ class _graphHMMMixin():
 
     def genFilterProbs( self ):
 
-        # Initialize U and V
-        U = []
-        for node in self.nodes:
-            U.append( np.zeros( ( self.K, ) ) )
+        # U is a ( n_nodes, K ) array and V is a ( nnz( pmask ), K ) array.
+        # The V value for ( node, down edge ) is in row vSlots( node, edge ).
+        # Everything starts off as invalid
+        U = np.full( ( self.pmask.shape[ 0 ], self.K ), np.nan )
 
         V_row = self.pmask.row
         V_col = self.pmask.col
-        V_data = []
-        for node in self.pmask.row:
-            V_data.append( np.zeros( ( self.K, ) ) )
-
-        # Invalidate all data elements
-        for node in self.nodes:
-            U[ node ][ : ] = np.nan
-            self.assignV( ( V_row, V_col, V_data ), node, np.nan, keep_shape=True )
+        V_data = np.full( ( self.pmask.nnz, self.K ), np.nan )
 
         return U, ( V_row, V_col, V_data )
 
@@ -242,6 +237,13 @@ class _graphHMMMixin():
 
         return integrand
 
+    @classmethod
+    def contract( cls, terms, axes ):
+        # Same as integrate( multiplyTerms( terms ), axes ), but the product
+        # is never fully built
+        assert isinstance( terms, Iterable )
+        return logContract( terms, axes )
+
     ######################################################################
 
     def filter( self, **kwargs ):
@@ -265,22 +267,143 @@ class _graphHMMMixin():
             if( edge is None ):
                 continue
 
-            dataIndices = np.in1d( V_row, node ) & np.in1d( V_col, edge )
-
-            for i in np.where( dataIndices )[ 0 ]:
+            for i in self.vSlots( node, edges=edge ):
+                # self.total_deviation += np.logaddexp( V_data[ i ], -v )**2
                 V_data[ i ] = v
 
-            # for i, maskValue in enumerate( dataIndices ):
+######################################################################
+
+class _graphHMMChunkedFBSMixin():
+    # Every fbs node adds an axis to the terms, so the products can get
+    # too big to fit in memory.  These methods condition on blocks of
+    # fbs states at a time, run the filter for each block and then combine
+    # the results with logaddexp.
+
+    # Largest product (in bytes) that multiplyTerms is allowed to build
+    memory_budget = 8e8
+
+    def __init__( self, *args, **kwargs ):
+        super().__init__( *args, **kwargs )
+
+        # Maps a full graph fbs node to the states that the current block allows.
+        # Nodes that aren't in here can take on any state
+        self.fbs_states = {}
+
+    ######################################################################
+
+    def restrictFbsStates( self, term, node_full, axis ):
+        # Keep only the states of node_full that are in the current block
+        if( int( node_full ) not in self.fbs_states ):
+            return term
+
+        states = self.fbs_states[ int( node_full ) ]
+        term = np.take( term, states, axis=axis )
+        if( len( states ) == 1 ):
+            # Axes of size 1 get squeezed out, so pad a block with a single
+            # state with a state that can't happen.  expandFbsStates drops it
+            pad_shape = list( term.shape )
+            pad_shape[ axis ] = 1
+            term = np.concatenate( ( term, np.full( pad_shape, np.NINF ) ), axis=axis )
+        return term
+
+    def expandFbsStates( self, node_full, term ):
+        # Scatter a term over the block states of node_full back into
+        # all of node_full's states.  States outside of the block get -inf
+        if( int( node_full ) not in self.fbs_states ):
+            return term
+        states = self.fbs_states[ int( node_full ) ]
+        positions = np.full( self.getNodeDim( int( node_full ) ), len( states ) )
+        positions[ states ] = np.arange( len( states ) )
+        return np.hstack( ( term, np.array( [ np.NINF ] ) ) )[ positions ]
+
+    ######################################################################
+
+    def fbsBlocks( self, graph_index, memory_budget ):
+        # Split the states of the fbs nodes in a graph into blocks so that
+        # the largest product over a family and the fbs axes fits in memory_budget
+        fbs = [ int( node ) for node in self.feedback_sets[ graph_index ] ]
+        dims = np.array( [ self.getNodeDim( node ) for node in fbs ], dtype=int )
+
+        # Find the largest family (not counting the fbs nodes)
+        starts = self.full_graph.parent_graph_assignments
+        start = starts[ graph_index ]
+        end = starts[ graph_index + 1 ] if graph_index + 1 < len( starts ) else self.full_graph.pmask.shape[ 0 ]
+        family_size = 1
+        for node in range( start, end ):
+            family = [ node ] + [ int( p ) for p in self.getFullParents( node, is_partial_graph_index=False, return_partial_graph_index=False ) ]
+            size = np.prod( [ self.getNodeDim( n ) for n in family if n not in fbs ] )
+            family_size = max( family_size, size )
+
+        # Keep halving the biggest block until the product fits.  Blocks with a
+        # single state are padded out to 2 states by restrictFbsStates, so they
+        # take up as much memory as a block of 2 and nodes with 2 states can't shrink
+        n_splits = np.ones_like( dims )
+        block_dims = lambda: np.maximum( -( -dims // n_splits ), np.minimum( dims, 2 ) )
+        while( family_size * np.prod( block_dims() ) * 8 > memory_budget ):
+            splittable = block_dims() > 2
+            assert np.any( splittable ), 'The smallest fbs blocks don\'t fit in a memory budget of %d bytes'%( int( memory_budget ) )
+            j = np.argmax( np.where( splittable, block_dims(), 0 ) )
+            n_splits[ j ] = min( 2 * n_splits[ j ], dims[ j ] )
+
+        splits = [ np.array_split( np.arange( d ), s ) for d, s in zip( dims, n_splits ) ]
+        return [ dict( zip( fbs, states ) ) for states in itertools.product( *splits ) ]
+
+    def fbsChunks( self, memory_budget=None ):
+        # Run the filter once for every block of fbs states.  The graphs
+        # are independent so every graph advances to its next block on each
+        # pass.  Yields the graphs whose block is new along with U and V
+        memory_budget = self.memory_budget if memory_budget is None else memory_budget
+        blocks = [ self.fbsBlocks( i, memory_budget ) for i in range( len( self.feedback_sets ) ) ]
+
+        try:
+            for i in range( max( [ len( b ) for b in blocks ] ) ):
+                self.fbs_states = {}
+                active = []
+                for graph_index, graph_blocks in enumerate( blocks ):
+                    self.fbs_states.update( graph_blocks[ min( i, len( graph_blocks ) - 1 ) ] )
+                    if( i < len( graph_blocks ) ):
+                        active.append( graph_index )
+
+                self.clearCache()
+                U, V = self.filter()
+                yield active, U, V
+        finally:
+            self.fbs_states = {}
+            self.clearCache()
+
+    ######################################################################
 
-            #     # Don't convert V_data to an np.array even though it makes this
-            #     # step faster because it messes up when we add fbs nodes
-            #     if( maskValue == True ):
-            #         # self.total_deviation += np.logaddexp( V_data[ i ], -v )**2
-            #         V_data[ i ] = v
+    def chunkedMarginalProb( self, memory_budget=None ):
+        # P( Y ), computed without ever holding more than memory_budget bytes
+        starts = self.full_graph.parent_graph_assignments
+        marginals = [ np.NINF for _ in starts ]
+        for active, U, V in self.fbsChunks( memory_budget ):
+            for graph_index in active:
+                marginal = self.marginalProb( U, V, node=starts[ graph_index ] )
+                marginals[ graph_index ] = np.logaddexp( marginals[ graph_index ], marginal )
+        return sum( marginals )
+
+    def chunkedNodeSmoothed( self, nodes, memory_budget=None ):
+        # P( x | Y ), computed without ever holding more than memory_budget bytes
+        starts = self.full_graph.parent_graph_assignments
+
+        marginals = [ np.NINF for _ in starts ]
+        joints = dict( [ ( int( node ), np.NINF ) for node in nodes ] )
+        for active, U, V in self.fbsChunks( memory_budget ):
+            for graph_index in active:
+                marginal = self.marginalProb( U, V, node=starts[ graph_index ] )
+                marginals[ graph_index ] = np.logaddexp( marginals[ graph_index ], marginal )
+
+            active_nodes = [ node for node in nodes if self.graphIndex( node ) in active ]
+            for node, joint in self.nodeJoint( U, V, active_nodes ):
+                joint = self.expandFbsStates( node, joint )
+                joints[ int( node ) ] = np.logaddexp( joints[ int( node ) ], joint )
+
+        return [ ( node, joints[ int( node ) ] - marginals[ self.graphIndex( node ) ] ) for node in nodes ]
 
 ######################################################################
 
-class _graphHMMFBSMixin( _graphHMMMixin ):
+class _graphHMMFBSMixin( _graphHMMChunkedFBSMixin, _graphHMMMixin ):
 
     def preprocessData( self, data_graphs ):
 
@@ -310,9 +433,7 @@ class _graphHMMFBSMixin( _graphHMMMixin ):
 
     def assignV( self, V, node, val, keep_shape=False ):
         V_row, V_col, V_data = V
-        N = V_row.shape[ 0 ]
-        VIndices = np.where( np.in1d( V_row, node ) )[ 0 ]
-        for i in VIndices:
+        for i in self.vSlots( node ):
             if( keep_shape is False ):
                 V_data[ i ].data = val
             else:
@@ -320,26 +441,28 @@ class _graphHMMFBSMixin( _graphHMMMixin ):
 
     def genFilterProbs( self ):
 
-        # Initialize U and V
-        U = []
+        # The messages have a different number of fbs axes for each node, so
+        # they are packed into message lists instead of a dense array.
+        # Everything starts off as invalid
+        U = self.newMessageList( len( self.partial_graph.nodes ) )
         for node in self.partial_graph.nodes:
-            U.append( fbsData( np.zeros( self.K ), -1 ) )
+            U[ node ] = fbsData( np.full( self.K, np.nan ), -1 )
 
         V_row = self.partial_graph.pmask.row
         V_col = self.partial_graph.pmask.col
-        V_data = []
-        for node in self.partial_graph.pmask.row:
-            V_data.append( fbsData( np.zeros( self.K ), -1 ) )
-
-        # Invalidate all data elements
-        for node in self.partial_graph.nodes:
-            U[ node ].data[ : ] = np.nan
-            self.assignV( ( V_row, V_col, V_data ), node, np.nan, keep_shape=True )
+        V_data = self.newMessageList( self.partial_graph.pmask.nnz )
+        for i in range( self.partial_graph.pmask.nnz ):
+            V_data[ i ] = fbsData( np.full( self.K, np.nan ), -1 )
 
         return U, ( V_row, V_col, V_data )
 
     ######################################################################
 
+    def getNodeDim( self, node ):
+        return self.K
+
+    ######################################################################
+
     def transitionProb( self, child, is_partial_graph_index=False ):
         parents, parent_order = self.getFullParents( child, get_order=True, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=False )
         ndim = len( parents ) + 1
@@ -396,6 +519,11 @@ class _graphHMMFBSMixin( _graphHMMMixin ):
                 # If the child is in the fbs, then move it to the appropriate axis
                 pi = np.swapaxes( pi, ndim - 1, fbsOffset( child_full ) + ndim - 1 )
 
+            # Only keep the fbs states in the current block
+            for node in [ *parents, child_full ]:
+                if( self.inFeedbackSet( node, is_partial_graph_index=False ) ):
+                    pi = self.restrictFbsStates( pi, node, axis=fbsOffset( node ) + ndim - 1 )
+
             return fbsData( pi, ndim )
         return fbsData( pi, -1 )
 
@@ -406,6 +534,10 @@ class _graphHMMFBSMixin( _graphHMMMixin ):
         node_full = self.partialGraphIndexToFullGraphIndex( node ) if is_partial_graph_index == True else node
         prob = self.L[ node_full ].reshape( ( -1, ) )
         if( self.inFeedbackSet( node_full, is_partial_graph_index=False ) ):
+            prob = self.restrictFbsStates( prob, node_full, axis=0 )
+            fbs_index = self.fbsIndex( node_full, is_partial_graph_index=False, within_graph=True )
+            for _ in range( fbs_index ):
+                prob = prob[ None ]
             return fbsData( prob, 0 )
         return fbsData( prob, -1 )
 
@@ -455,33 +587,11 @@ class _graphHMMFBSMixin( _graphHMMMixin ):
         if( fbs_data_count == 0 ):
             return GraphHMM.multiplyTerms( terms )
 
-        # Remove the empty terms
-        terms = [ t for t in terms if np.prod( t.shape ) > 1 ]
+        terms, max_fbs_axis = alignTerms( terms )
 
         if( len( terms ) == 0 ):
             return fbsData( np.array( [] ), 0 )
 
-        # Separate out where the feedback set axes start and get the largest fbs_axis.
-        # Need to handle case where ndim of term > all fbs axes
-        # terms, fbs_axes_start = list( zip( *terms ) )
-        fbs_axes_start = [ term.fbs_axis for term in terms ]
-        terms = [ term.data for term in terms ]
-
-        if( max( fbs_axes_start ) != -1 ):
-            max_fbs_axis = max( [ ax if ax != -1 else term.ndim for ax, term in zip( fbs_axes_start, terms ) ] )
-
-            if( max_fbs_axis > 0 ):
-                # Pad extra dims at each term so that the fbs axes start the same way for every term
-                for i, ax in enumerate( fbs_axes_start ):
-                    if( ax == -1 ):
-                        for _ in range( max_fbs_axis - terms[ i ].ndim + 1 ):
-                            terms[ i ] = terms[ i ][ ..., None ]
-                    else:
-                        for _ in range( max_fbs_axis - ax ):
-                            terms[ i ] = np.expand_dims( terms[ i ], axis=ax )
-        else:
-            max_fbs_axis = -1
-
         ndim = max( [ len( term.shape ) for term in terms ] )
 
         axes = [ [ i for i, s in enumerate( t.shape ) if s != 1 ] for t in terms ]
@@ -492,8 +602,8 @@ class _graphHMMFBSMixin( _graphHMMMixin ):
             shape[ np.array( ax ) ] = term.squeeze().shape
 
         total_elts = shape.prod()
-        if( total_elts > 1e8 ):
-            assert 0, 'Don\'t do this on a cpu!  Too many terms: %d'%( int( total_elts ) )
+        if( total_elts * 8 > cls.memory_budget ):
+            assert 0, 'Too many terms: %d.  Use chunkedMarginalProb or chunkedNodeSmoothed to condition on blocks of fbs states'%( int( total_elts ) )
 
         # Build a meshgrid out of each of the terms over the right axes
         # and sum.  Doing it this way because np.einsum doesn't work
@@ -539,17 +649,26 @@ class _graphHMMFBSMixin( _graphHMMMixin ):
 
         return fbsData( integrand, fbs_axis )
 
+    @classmethod
+    def contract( cls, terms, axes ):
+
+        # Check if we need to use the regular contract
+        if( not any( [ isinstance( t, fbsData ) for t in terms ] ) ):
+            return GraphHMM.contract( terms, axes )
+
+        # The integrated axes are never fbs axes, so the fbs axes
+        # just shift over by the number of axes that we integrate
+        return contract( terms, axes )
+
 ######################################################################
 
-class _graphHMMGroupFBSMixin( _graphHMMMixin ):
+class _graphHMMGroupFBSMixin( _graphHMMChunkedFBSMixin, _graphHMMMixin ):
 
     # This variant lets the user specify which set of parameters to apply to a node
 
     def assignV( self, V, node, val, keep_shape=False ):
         V_row, V_col, V_data = V
-        N = V_row.shape[ 0 ]
-        VIndices = np.where( np.in1d( V_row, node ) )[ 0 ]
-        for i in VIndices:
+        for i in self.vSlots( node ):
             if( keep_shape is False ):
                 V_data[ i ].data = val
             else:
@@ -557,23 +676,18 @@ class _graphHMMGroupFBSMixin( _graphHMMMixin ):
 
     def genFilterProbs( self ):
 
-        # Initialize U and V
-        U = []
+        # Same as the non group version, but K depends on the group of the node
+        U = self.newMessageList( len( self.partial_graph.nodes ) )
         for node in self.partial_graph.nodes:
             group = self.node_groups[ node ]
-            U.append( fbsData( np.zeros( self.Ks[ group ] ), -1 ) )
+            U[ node ] = fbsData( np.full( self.Ks[ group ], np.nan ), -1 )
 
         V_row = self.partial_graph.pmask.row
         V_col = self.partial_graph.pmask.col
-        V_data = []
-        for node in self.partial_graph.pmask.row:
+        V_data = self.newMessageList( self.partial_graph.pmask.nnz )
+        for i, node in enumerate( V_row ):
             group = self.node_groups[ node ]
-            V_data.append( fbsData( np.zeros( self.Ks[ group ] ), -1 ) )
-
-        # Invalidate all data elements
-        for node in self.partial_graph.nodes:
-            U[ node ].data[ : ] = np.nan
-            self.assignV( ( V_row, V_col, V_data ), node, np.nan, keep_shape=True )
+            V_data[ i ] = fbsData( np.full( self.Ks[ group ], np.nan ), -1 )
 
         return U, ( V_row, V_col, V_data )
 
@@ -764,6 +878,15 @@ class _graphHMMGroupFBSMixin( _graphHMMMixin ):
                 # If the child is in the fbs, then move it to the appropriate axis
                 pi = np.swapaxes( pi, ndim - 1, fbsOffset( child ) + ndim - 1 )
 
+            # Only keep the fbs states in the current block
+            for parent in parents:
+                if( self.inFeedbackSet( parent, is_partial_graph_index=True ) ):
+                    parent_full = self.partialGraphIndexToFullGraphIndex( parent )
+                    pi = self.restrictFbsStates( pi, parent_full, axis=fbsOffset( parent ) + ndim - 1 )
+
+            if( self.inFeedbackSet( child, is_partial_graph_index=is_partial_graph_index ) ):
+                pi = self.restrictFbsStates( pi, child_full, axis=fbsOffset( child ) + ndim - 1 )
+
             return fbsData( pi, ndim )
         return fbsData( pi, -1 )
 
@@ -781,6 +904,7 @@ class _graphHMMGroupFBSMixin( _graphHMMMixin ):
             prob = np.zeros_like( self.emission_dists[ group ][ :, 0 ] )
 
         if( self.inFeedbackSet( node_full, is_partial_graph_index=False ) ):
+            prob = self.restrictFbsStates( prob, node_full, axis=0 )
             fbs_index = self.fbsIndex( node_full, is_partial_graph_index=False, within_graph=True )
             for _ in range( fbs_index ):
                 prob = prob[ None ]
@@ -804,7 +928,171 @@ class _graphHMMGroupFBSMixin( _graphHMMMixin ):
 
 ######################################################################
 
-class GraphHMM( _graphHMMMixin, GraphFilter ):
+class _graphHMMBatchedMixin():
+    # Computes all of the U or V values in a level at once.  Nodes in the same
+    # level that have the same number of parents have integrands with the same
+    # shape, so they get stacked into a ( batch, K, ..., K ) array and reduced
+    # with a single broadcast add + logsumexp.  Set batched to False to go
+    # node by node instead.
+
+    batched = True
+
+    ######################################################################
+
+    @classmethod
+    def integrateBatch( cls, integrand, axes ):
+        # Same as integrate, except that the first axis indexes independent
+        # integrands.  Shift each one by its own max so that a batch element
+        # that is much smaller than the others doesn't underflow
+        axes = tuple( int( ax ) for ax in axes )
+        if( len( axes ) == 0 ):
+            return integrand
+
+        max_v = np.max( integrand, axis=axes, keepdims=True )
+        max_v = np.where( np.isfinite( max_v ), max_v, 0.0 )
+        with np.errstate( divide='ignore' ):
+            ans = np.log( np.sum( np.exp( integrand - max_v ), axis=axes, keepdims=True ) ) + max_v
+        return np.squeeze( ans, axis=axes )
+
+    ######################################################################
+
+    def vSum( self, V, node, skip_edge=None ):
+        # Sum of V over the down edges of node ( except skip_edge )
+        _, _, V_data = V
+        start, end = self._down_edge_indptr[ node ], self._down_edge_indptr[ node + 1 ]
+        ans = np.zeros( self.K )
+        for pos, edge in zip( self._down_edge_positions[ start:end ], self._down_edge_indices[ start:end ] ):
+            if( skip_edge is not None and np.any( edge == skip_edge ) ):
+                continue
+            ans = ans + V_data[ pos ]
+        return ans
+
+    def aBatch( self, U, V, nodes, skip_edges ):
+        # Stacked a values.  Returns shape ( batch, K )
+        return np.array( [ U[ node ] + self.vSum( V, node, skip_edge=edge ) for node, edge in zip( nodes, skip_edges ) ] )
+
+    def bBatch( self, U, V, nodes, n_parents ):
+        # Stacked b values for nodes that all have n_parents parents.
+        # Returns shape ( batch, K, ..., K ) with n_parents K axes
+        transitions = np.array( [ self.transitionProb( node ) for node in nodes ] )
+        down = np.array( [ self.emissionProb( node ) + self.vSum( V, node ) for node in nodes ] )
+        integrand = transitions + down.reshape( ( len( nodes ), ) + ( 1, ) * n_parents + ( self.K, ) )
+        return self.integrateBatch( integrand, axes=[ n_parents + 1 ] )
+
+    ######################################################################
+
+    def familyBSum( self, U, V, families, n_parents ):
+        # families is a list of node lists.  Compute b for every node once and
+        # return the sum over each family with shape ( batch, K, ..., K )
+        members = np.unique( np.hstack( [ np.array( f, dtype=int ) for f in families ] + [ np.array( [], dtype=int ) ] ) )
+        shape = ( self.K, ) * n_parents
+        if( members.size == 0 ):
+            return np.zeros( ( len( families ), ) + shape )
+
+        # Pad with a row of zeros so that every family can be gathered at once
+        bs = self.bBatch( U, V, members, n_parents )
+        bs = np.concatenate( ( bs, np.zeros( ( 1, ) + shape ) ), axis=0 )
+
+        width = max( len( f ) for f in families )
+        indices = np.full( ( len( families ), width ), members.size, dtype=int )
+        for i, f in enumerate( families ):
+            indices[ i, :len( f ) ] = np.searchsorted( members, f )
+
+        return bs[ indices ].sum( axis=1 )
+
+    @classmethod
+    def addAlongAxes( cls, integrand, terms, orders ):
+        # terms has shape ( batch, len( orders ), K ).  Add terms[ :, i ] along axis orders[ i ] + 1
+        ndim = integrand.ndim
+        for i, order in enumerate( orders ):
+            shape = [ integrand.shape[ 0 ] ] + [ 1 ] * ( ndim - 1 )
+            shape[ order + 1 ] = terms.shape[ -1 ]
+            integrand = integrand + terms[ :, i ].reshape( shape )
+        return integrand
+
+    ######################################################################
+
+    def uBatch( self, U, V, nodes, n_parents ):
+        # Batched version of u for nodes that all have n_parents parents
+
+        siblings, parent_as = [], []
+        for node in nodes:
+            parents, parent_order = self.getParents( node, get_order=True )
+            parents = parents[ np.argsort( parent_order ) ]
+            up_edge = self.getUpEdges( node )
+            parent_as.append( self.aBatch( U, V, parents, [ up_edge ] * n_parents ) )
+            siblings.append( self.getSiblings( node ) )
+
+        transitions = np.array( [ self.transitionProb( node ) for node in nodes ] )
+        sibling_bs = self.familyBSum( U, V, siblings, n_parents )
+
+        integrand = transitions + sibling_bs[ ..., None ]
+        integrand = self.addAlongAxes( integrand, np.array( parent_as ), np.arange( n_parents ) )
+
+        node_terms = self.integrateBatch( integrand, axes=np.arange( 1, n_parents + 1 ) )
+        emissions = np.array( [ self.emissionProb( node ) for node in nodes ] )
+        return node_terms + emissions
+
+    def vBatch( self, U, V, nodes, edges, n_parents, node_order ):
+        # Batched version of v for ( node, edge ) pairs where edge has
+        # n_parents parents and node is the node_order'th parent
+
+        children, mate_as = [], []
+        mate_orders = np.setdiff1d( np.arange( n_parents ), node_order )
+        for node, edge in zip( nodes, edges ):
+            mates, mate_order = self.getMates( node, get_order=True, edges=edge )
+            mates = mates[ np.argsort( mate_order ) ]
+            mate_as.append( self.aBatch( U, V, mates, [ edge ] * mates.shape[ 0 ] ) )
+            children.append( self.getChildren( node, edges=edge ) )
+
+        integrand = self.familyBSum( U, V, children, n_parents )
+        if( mate_orders.size > 0 ):
+            integrand = self.addAlongAxes( integrand, np.array( mate_as ), mate_orders )
+
+        return self.integrateBatch( integrand, axes=mate_orders + 1 )
+
+    ######################################################################
+
+    def uFilter( self, is_base_case, nodes, U, V, parallel=False ):
+        if( self.batched == False or is_base_case ):
+            return super().uFilter( is_base_case, nodes, U, V, parallel=parallel )
+
+        # Group the nodes by the number of parents
+        n_parents = np.array( [ self.nParents( node ) for node in nodes ], dtype=int )
+
+        new_u = [ None for _ in nodes ]
+        for n in np.unique( n_parents ):
+            indices = np.where( n_parents == n )[ 0 ]
+            batch = self.uBatch( U, V, [ nodes[ i ] for i in indices ], n )
+            for i, u in zip( indices, batch ):
+                new_u[ i ] = u
+
+        self.updateU( nodes, new_u, U )
+
+    def vFilter( self, is_base_case, nodes_and_edges, U, V, parallel=False ):
+        if( self.batched == False or is_base_case ):
+            return super().vFilter( is_base_case, nodes_and_edges, U, V, parallel=parallel )
+
+        nodes, edges = nodes_and_edges
+
+        # Group by the number of parents of the edge and the position of the node in the edge
+        keys = []
+        for node, edge in zip( nodes, edges ):
+            parents, parent_order = self._indexedNodesFromEdges( node, edge, get_children=False, get_order=True )
+            keys.append( ( parents.shape[ 0 ], int( parent_order[ parents == node ][ 0 ] ) ) )
+
+        new_v = [ None for _ in nodes ]
+        for key in set( keys ):
+            indices = [ i for i, k in enumerate( keys ) if k == key ]
+            batch = self.vBatch( U, V, [ nodes[ i ] for i in indices ], [ edges[ i ] for i in indices ], *key )
+            for i, v in zip( indices, batch ):
+                new_v[ i ] = v
+
+        self.updateV( nodes, edges, new_v, V )
+
+######################################################################
+
+class GraphHMM( _graphHMMBatchedMixin, _graphHMMMixin, GraphFilter ):
     pass
 
 ######################################################################
@@ -827,6 +1115,117 @@ class GraphHMMFBSGroup( _graphHMMGroupFBSMixin, GraphHMMFBS ):
 class GraphHMMFBSGroupParallel( _graphHMMGroupFBSMixin, GraphHMMFBSParallel ):
     pass
 
+######################################################################
+# Max product
+######################################################################
+
+class _graphHMMMaxProductMixin():
+    # Max product version of the up down pass.  integrate takes the max over
+    # the axes instead of the logsumexp, so the same u, v, a and b messages
+    # become max marginals.  The joints are then max_{ everything else }P( x, Y )
+    # and marginalProb is log P( X*, Y ) for the most likely assignment X*.
+    # With a feedback set the fbs nodes stay on their own axes of every
+    # message, so maximizing over those axes enumerates their states.
+
+    @classmethod
+    def integrate( cls, integrand, axes ):
+        assert isinstance( axes, Iterable )
+        if( len( axes ) == 0 ):
+            return integrand
+
+        is_fbs = isinstance( integrand, fbsData )
+        data, fbs_axis = ( integrand.data, integrand.fbs_axis ) if is_fbs else ( integrand, -1 )
+
+        assert max( axes ) < data.ndim
+        axes = np.array( axes )
+        axes[ axes < 0 ] = data.ndim + axes[ axes < 0 ]
+        data = np.max( data, axis=tuple( axes.tolist() ) )
+
+        if( is_fbs == False ):
+            return data
+
+        if( fbs_axis > -1 ):
+            fbs_axis -= len( axes )
+        return fbsData( data, fbs_axis )
+
+    @classmethod
+    def contract( cls, terms, axes ):
+        # logContract only works in the sum product semiring
+        assert isinstance( axes, Iterable )
+        return cls.integrate( cls.multiplyTerms( terms ), axes )
+
+    ######################################################################
+
+    def rootScores( self, U, V, node, states ):
+        # Max marginal of a root.  If a child of node has parents that are already
+        # decoded, condition on them so that ties are broken the same way
+        for child in self.getChildren( node ):
+            parents, parent_order = self.getParents( child, get_order=True )
+            if( np.all( states[ parents ] == -1 ) ):
+                continue
+
+            ( _, joint ), = self.jointParents( U, V, [ child ] )
+
+            # Fix the decoded parents and maximize over the others
+            index = [ slice( None ) ] * joint.ndim
+            for p, o in zip( parents, parent_order ):
+                if( states[ p ] != -1 ):
+                    index[ o ] = states[ p ]
+            joint = joint[ tuple( index ) ]
+
+            remaining = sorted( [ o for p, o in zip( parents, parent_order ) if states[ p ] == -1 ] )
+            node_axis = remaining.index( parent_order[ list( parents ).index( node ) ] )
+            return self.integrate( joint, axes=[ i for i in range( joint.ndim ) if i != node_axis ] )
+
+        ( _, joint ), = self.nodeJoint( U, V, [ node ] )
+        return joint
+
+    def viterbi( self, U=None, V=None ):
+        # The most likely latent state of every node in the full graph, along
+        # with log P( X*, Y ).  The max marginals are exact, so the nodes are
+        # decoded in topological order where each node maximizes the max
+        # marginal of its family with its parents fixed.  This follows the
+        # back pointers without having to store them during the filter.
+        if( U is None ):
+            U, V = self.filter()
+
+        states = np.full( self.nodes.shape[ 0 ], -1, dtype=int )
+        remaining = [ int( node ) for node in self.nodes ]
+
+        while( len( remaining ) > 0 ):
+            deferred = []
+            for node in remaining:
+                parents, parent_order = self.getParents( node, get_order=True )
+
+                if( len( parents ) == 0 ):
+                    scores = self.rootScores( U, V, node, states )
+                elif( np.any( states[ parents ] == -1 ) ):
+                    deferred.append( node )
+                    continue
+                else:
+                    ( _, joint ), = self.jointParentChild( U, V, [ node ] )
+                    index = [ None ] * len( parents )
+                    for p, o in zip( parents, parent_order ):
+                        index[ o ] = states[ p ]
+                    scores = joint[ tuple( index ) ]
+
+                states[ node ] = np.argmax( scores )
+
+            assert len( deferred ) < len( remaining ), 'The graph has a cycle'
+            remaining = deferred
+
+        return states, self.marginalProb( U, V )
+
+######################################################################
+
+class GraphHMMMaxProduct( _graphHMMMaxProductMixin, _graphHMMMixin, GraphFilter ):
+    pass
+
+######################################################################
+
+class GraphHMMFBSMaxProduct( _graphHMMMaxProductMixin, _graphHMMFBSMixin, GraphFilterFBS ):
+    pass
+
 ######################################################################
 # SVAE Stuff
 ######################################################################
@@ -882,6 +1281,10 @@ class GraphDiscreteSVAE( _graphHMMFBSMixin, GraphFilterFBSSVAE ):
             prob = np.zeros_like( self.pi0 ).reshape( ( -1, ) )
 
         if( self.inFeedbackSet( node_full, is_partial_graph_index=False ) ):
+            prob = self.restrictFbsStates( prob, node_full, axis=0 )
+            fbs_index = self.fbsIndex( node_full, is_partial_graph_index=False, within_graph=True )
+            for _ in range( fbs_index ):
+                prob = prob[ None ]
             return fbsData( prob, 0 )
         return fbsData( prob, -1 )
 
@@ -968,6 +1371,7 @@ class GraphDiscreteGroupSVAE( _graphHMMGroupFBSMixin, GraphFilterFBSSVAE ):
             prob = np.zeros_like( self.pi0s[ group ][ :, 0 ] ).reshape( ( -1, ) )
 
         if( self.inFeedbackSet( node_full, is_partial_graph_index=False ) ):
+            prob = self.restrictFbsStates( prob, node_full, axis=0 )
             fbs_index = self.fbsIndex( node_full, is_partial_graph_index=False, within_graph=True )
             for _ in range( fbs_index ):
                 prob = prob[ None ]
@@ -1010,6 +1414,10 @@ class GraphDiscreteSVAEConditioned( GraphDiscreteSVAE ):
             prob = np.zeros_like( self.pi0 ).reshape( ( -1, ) )
 
         if( self.inFeedbackSet( node_full, is_partial_graph_index=False ) ):
+            prob = self.restrictFbsStates( prob, node_full, axis=0 )
+            fbs_index = self.fbsIndex( node_full, is_partial_graph_index=False, within_graph=True )
+            for _ in range( fbs_index ):
+                prob = prob[ None ]
             return fbsData( prob, 0 )
         return fbsData( prob, -1 )
 
@@ -1048,6 +1456,7 @@ class GraphDiscreteGroupSVAEConditioned( GraphDiscreteGroupSVAE ):
             prob = np.zeros_like( self.pi0s[ group ][ :, 0 ] ).reshape( ( -1, ) )
 
         if( self.inFeedbackSet( node_full, is_partial_graph_index=False ) ):
+            prob = self.restrictFbsStates( prob, node_full, axis=0 )
             fbs_index = self.fbsIndex( node_full, is_partial_graph_index=False, within_graph=True )
             for _ in range( fbs_index ):
                 prob = prob[ None ]
@@ -90,6 +90,58 @@ class GraphMessagePasser():
 
         self.nodes = np.arange( self.pmask.shape[ 0 ] )
 
+        self.buildAdjacencyIndex()
+
+        # The message passing schedule only depends on the topology, so it is
+        # compiled lazily and kept until the masks change again.  clearCache is
+        # called whenever the parameters change, so don't reset it there.
+        self._schedule = None
+        self._forward_levels = None
+
+    ######################################################################
+
+    @staticmethod
+    def _compressIndex( keys, values, n_keys ):
+        # Group values by key.  Returns ( indptr, values ) so that the values
+        # for key k are values[ indptr[ k ]:indptr[ k + 1 ] ].  The sort is stable
+        # so values keep the order that they appear in the coo matrix.
+        order = np.argsort( keys, kind='stable' )
+        indptr = np.zeros( n_keys + 1, dtype=int )
+        indptr[ 1: ] = np.cumsum( np.bincount( keys, minlength=n_keys ) )
+        values = values[ order ]
+        indptr.setflags( write=False )
+        values.setflags( write=False )
+        return indptr, values
+
+    @staticmethod
+    def _gatherIndex( indptr, values, keys ):
+        # Concatenate the values for every key without a python loop
+        keys = np.asarray( keys, dtype=int ).ravel()
+        if( keys.size == 1 ):
+            k = keys[ 0 ]
+            return values[ indptr[ k ]:indptr[ k + 1 ] ]
+
+        starts = indptr[ keys ]
+        counts = indptr[ keys + 1 ] - starts
+        offsets = np.repeat( starts - np.cumsum( counts ) + counts, counts ) + np.arange( counts.sum() )
+        return values[ offsets ]
+
+    def buildAdjacencyIndex( self ):
+        # The masks are stored as coo matrices, so looking up the family of a node
+        # means scanning every non zero.  Build compressed views of the masks once
+        # per topology so that the family lookups are O( degree ):
+        #   node -> up edges   ( csr over cmask )
+        #   node -> down edges ( csr over pmask, also as positions into pmask )
+        #   edge -> parents    ( csc over pmask, stored as positions into pmask )
+        #   edge -> children   ( csc over cmask, stored as positions into cmask )
+        n_nodes, n_edges = self.pmask.shape
+
+        self._up_edge_indptr, self._up_edge_indices = self._compressIndex( self.cmask.row, self.cmask.col, n_nodes )
+        self._down_edge_indptr, self._down_edge_indices = self._compressIndex( self.pmask.row, self.pmask.col, n_nodes )
+        _, self._down_edge_positions = self._compressIndex( self.pmask.row, np.arange( self.pmask.nnz ), n_nodes )
+        self._edge_parent_indptr, self._edge_parent_positions = self._compressIndex( self.pmask.col, np.arange( self.pmask.nnz ), n_edges )
+        self._edge_child_indptr, self._edge_child_positions = self._compressIndex( self.cmask.col, np.arange( self.cmask.nnz ), n_edges )
+
     ######################################################################
 
     @staticmethod
@@ -111,10 +163,27 @@ class GraphMessagePasser():
     ######################################################################
 
     def getUpEdges( self, nodes, split=False ):
-        return GraphMessagePasser._upEdges( self.cmask, nodes, split=split )
+        if( split ):
+            return [ self.getUpEdges( n, split=False ) for n in nodes ]
+        return np.unique( self._gatherIndex( self._up_edge_indptr, self._up_edge_indices, nodes ) )
 
     def getDownEdges( self, nodes, skip_edges=None, split=False ):
-        return GraphMessagePasser._downEdges( self.pmask, nodes, skip_edges=skip_edges, split=split )
+        if( split ):
+            return [ self.getDownEdges( n, skip_edges=skip_edges, split=False ) for n in nodes ]
+        edges = np.unique( self._gatherIndex( self._down_edge_indptr, self._down_edge_indices, nodes ) )
+        if( skip_edges is not None ):
+            return np.setdiff1d( edges, skip_edges )
+        return edges
+
+    def vSlots( self, node, edges=None ):
+        # The V messages are stored in the same order as the pmask entries, so
+        # the slot of ( node, down edge ) is its position in the pmask.
+        # Returns the slots of node, optionally only over edges
+        start, end = self._down_edge_indptr[ node ], self._down_edge_indptr[ node + 1 ]
+        slots = self._down_edge_positions[ start:end ]
+        if( edges is None ):
+            return slots
+        return slots[ np.in1d( self._down_edge_indices[ start:end ], edges ) ]
 
     ######################################################################
 
@@ -218,6 +287,78 @@ class GraphMessagePasser():
 
     ######################################################################
 
+    def _indexedNodesFromEdges( self, nodes, edges, get_children=True, diff_nodes=False, get_order=False ):
+        # Same as _nodesFromEdges, but only looks at the entries of the requested edges
+
+        if( get_children ):
+            mask, indptr, positions = self.cmask, self._edge_child_indptr, self._edge_child_positions
+        else:
+            mask, indptr, positions = self.pmask, self._edge_parent_indptr, self._edge_parent_positions
+
+        positions = self._gatherIndex( indptr, positions, edges )
+
+        if( diff_nodes ):
+            positions = positions[ ~np.in1d( mask.row[ positions ], nodes ) ]
+
+        if( get_order is False ):
+            # Order doesn't matter
+            return np.unique( mask.row[ positions ] )
+
+        # Keep the coo ordering so that the result matches a scan over the mask
+        positions = np.sort( positions )
+        return mask.row[ positions ], mask.data[ positions ] - 1 # Subtract one to use 0 indexing
+
+    def _indexedNodeSelectFromEdge( self,
+                                    nodes,
+                                    edges=None,
+                                    up_edge=False,
+                                    get_children=True,
+                                    diff_nodes=False,
+                                    split_by_edge=False,
+                                    split=False,
+                                    get_order=False ):
+        # Same as _nodeSelectFromEdge, but uses the adjacency index
+
+        if( split ):
+            if( edges is None ):
+                return [ self._indexedNodeSelectFromEdge( n,
+                                                          edges=None,
+                                                          up_edge=up_edge,
+                                                          get_children=get_children,
+                                                          diff_nodes=diff_nodes,
+                                                          split_by_edge=split_by_edge,
+                                                          split=False,
+                                                          get_order=get_order ) for n in nodes ]
+            else:
+                return [ self._indexedNodeSelectFromEdge( n,
+                                                          edges=e,
+                                                          up_edge=up_edge,
+                                                          get_children=get_children,
+                                                          diff_nodes=diff_nodes,
+                                                          split_by_edge=split_by_edge,
+                                                          split=False,
+                                                          get_order=get_order ) for n, e in zip( nodes, edges ) ]
+
+        _edges = self.getUpEdges( nodes ) if up_edge else self.getDownEdges( nodes )
+
+        if( edges is not None ):
+            _edges = np.intersect1d( _edges, edges )
+
+        if( split_by_edge == True ):
+            return [ [ e, self._indexedNodesFromEdges( nodes,
+                                                       e,
+                                                       get_children=get_children,
+                                                       diff_nodes=diff_nodes,
+                                                       get_order=get_order ) ] for e in _edges ]
+
+        return self._indexedNodesFromEdges( nodes,
+                                            _edges,
+                                            get_children=get_children,
+                                            diff_nodes=diff_nodes,
+                                            get_order=get_order )
+
+    ######################################################################
+
     @staticmethod
     def _parents( cmask, pmask, nodes, split=False, get_order=False ):
         return GraphMessagePasser._nodeSelectFromEdge( cmask,
@@ -273,34 +414,42 @@ class GraphMessagePasser():
     ######################################################################
 
     def getParents( self, nodes, split=False, get_order=False ):
-        return GraphMessagePasser._parents( self.cmask,
-                                            self.pmask,
-                                            nodes,
-                                            split=split,
-                                            get_order=get_order )
+        return self._indexedNodeSelectFromEdge( nodes,
+                                                edges=None,
+                                                up_edge=True,
+                                                get_children=False,
+                                                diff_nodes=False,
+                                                split_by_edge=False,
+                                                split=split,
+                                                get_order=get_order )
 
     def getSiblings( self, nodes, split=False ):
-        return GraphMessagePasser._siblings( self.cmask,
-                                             self.pmask,
-                                             nodes,
-                                             split=split )
+        return self._indexedNodeSelectFromEdge( nodes,
+                                                edges=None,
+                                                up_edge=True,
+                                                get_children=True,
+                                                diff_nodes=True,
+                                                split_by_edge=False,
+                                                split=split )
 
     def getChildren( self, nodes, edges=None, split_by_edge=False, split=False ):
-        return GraphMessagePasser._children( self.cmask,
-                                             self.pmask,
-                                             nodes,
-                                             edges=edges,
-                                             split_by_edge=split_by_edge,
-                                             split=split )
+        return self._indexedNodeSelectFromEdge( nodes,
+                                                edges=edges,
+                                                up_edge=False,
+                                                get_children=True,
+                                                diff_nodes=False,
+                                                split_by_edge=split_by_edge,
+                                                split=split )
 
     def getMates( self, nodes, edges=None, split_by_edge=False, split=False, get_order=False ):
-        return GraphMessagePasser._mates( self.cmask,
-                                          self.pmask,
-                                          nodes,
-                                          edges=edges,
-                                          split_by_edge=split_by_edge,
-                                          split=split,
-                                          get_order=get_order )
+        return self._indexedNodeSelectFromEdge( nodes,
+                                                edges=edges,
+                                                up_edge=False,
+                                                get_children=False,
+                                                diff_nodes=True,
+                                                split_by_edge=split_by_edge,
+                                                split=split,
+                                                get_order=get_order )
 
     ######################################################################
 
@@ -364,7 +513,44 @@ class GraphMessagePasser():
     ######################################################################
 
     def countSemaphoreInit( self ):
-        # Counting semaphores for U and V
+        # Counting semaphores for U and V.  Same counts as countSemaphoreInitLoop,
+        # but computed with sparse matrix products over binary versions of the masks.
+        #   P[ n, e ] = 1 if n is a parent of e
+        #   C[ n, e ] = 1 if n is a child of e
+        #   d[ n ]    = number of down edges of n
+        #
+        # U[ n ] = sum_{ p in parents }( 1 + d[ p ] - |down( p ) ∩ up( n )| ) + sum_{ s in siblings }( d[ s ] )
+        # V[ n, e ] = sum_{ m in mates }( 1 + d[ m ] - 1 ) + sum_{ c in children( e ) }( d[ c ] )
+        #           = sum_{ p in parents( e ) }( d[ p ] ) - d[ n ] + sum_{ c in children( e ) }( d[ c ] )
+
+        P = coo_matrix( ( np.ones_like( self.pmask.data ), ( self.pmask.row, self.pmask.col ) ), shape=self.pmask.shape, dtype=int ).tocsr()
+        C = coo_matrix( ( np.ones_like( self.cmask.data ), ( self.cmask.row, self.cmask.col ) ), shape=self.cmask.shape, dtype=int ).tocsr()
+
+        n_down_edges = np.asarray( P.sum( axis=1 ) ).ravel()
+        has_up_edge = np.asarray( C.sum( axis=1 ) ).ravel() > 0
+
+        # shared_edges[ n, p ] is the number of n's up edges that p is a parent of
+        shared_edges = C.dot( P.T )
+        is_parent = ( shared_edges > 0 ).astype( int )
+
+        # C.dot( C.T ) includes every node as its own sibling, so remove that term
+        is_sibling_or_self = ( C.dot( C.T ) > 0 ).astype( int )
+
+        u_sem_data = np.asarray( is_parent.sum( axis=1 ) ).ravel()
+        u_sem_data += is_parent.dot( n_down_edges )
+        u_sem_data -= np.asarray( shared_edges.sum( axis=1 ) ).ravel()
+        u_sem_data += is_sibling_or_self.dot( n_down_edges ) - has_up_edge * n_down_edges
+
+        edge_counts = P.T.dot( n_down_edges ) + C.T.dot( n_down_edges )
+        v_sem_data = edge_counts[ self.pmask.col ] - n_down_edges[ self.pmask.row ]
+
+        u_semaphore = u_sem_data.astype( int )
+        v_semaphore = coo_matrix( ( v_sem_data, ( self.pmask.row, self.pmask.col ) ), shape=self.pmask.shape, dtype=int )
+
+        return u_semaphore, v_semaphore
+
+    def countSemaphoreInitLoop( self ):
+        # Reference implementation of countSemaphoreInit that walks over every node
 
         u_sem_data = np.zeros( self.pmask.shape[ 0 ], dtype=int )
 
@@ -598,81 +784,148 @@ class GraphMessagePasser():
 
     ######################################################################
 
-    def upDown( self, uWork, vWork, enable_loopy=False, loopyHasConverged=None, **kwargs ):
-        # Run the up down algorithm for latent state space models
+    def compileSchedule( self ):
+        # Simulate the up down algorithm without doing any work and record the
+        # ( u_list, v_list ) that are ready at each step.  The first level is the
+        # base case.  If there is a cycle, the schedule stops at the last level
+        # that could be computed and loopy belief propagation has to take over.
 
         u_done, v_done = self.progressInit()
         u_semaphore, v_semaphore = self.countSemaphoreInit()
         u_list, v_list = self.baseCaseNodes()
 
-        # Do work for base case nodes
-        uWork( True, u_list, **kwargs )
-        vWork( True, v_list, **kwargs )
+        levels = []
+        has_cycle = False
 
-        i = 1
-        loopy = False
-
-        # Filter over all of the graphs
         while( u_list.size > 0 or v_list[ 0 ].size > 0 ):
 
-            print( 'u_list', u_list )
-            print( 'v_list', v_list )
-
-            if( i > 1 ):
-
-                # In case we're pre-fetching values
-                self.lock()
-
-                # Do work for each of the nodes
-                uWork( False, u_list, **kwargs )
-                vWork( False, v_list, **kwargs )
+            levels.append( ( u_list, v_list ) )
 
             # Mark that we're done with the current nodes
             self.UDone( u_list, u_semaphore, v_semaphore, u_done )
             self.VDone( v_list, u_semaphore, v_semaphore, v_done )
 
-            last_u_list = u_list
-            last_v_list = v_list
-
             # Find the next nodes that are ready
             u_list = self.readyForU( u_semaphore, u_done )
             v_list = self.readyForV( v_semaphore, v_done )
 
-            i += 1
-
-            # Check if we need to do loopy propagation belief
             if( ( u_list.size == 0 and v_list[ 0 ].size == 0 ) and \
                 ( not np.any( u_done ) or not np.any( v_done.data ) ) ):
+                has_cycle = True
+                break
 
-                if( not enable_loopy ):
-                    assert 0, 'Cycle encountered.  Set enable_loopy to True'
-                if( loopyHasConverged is None ):
-                    assert 0, 'Need to specify the convergence function loopyHasConverged!'
+        if( has_cycle == False ):
+            assert np.any( u_semaphore != 0 ) == False
+            assert np.any( v_semaphore.data != 0 ) == False
 
-                print( 'Cycle encountered!  Starting loopy belief propagation...' )
+        self._schedule = levels
+        self._schedule_has_cycle = has_cycle
 
-                # The loopy algorithm will just forcibly keep adding mates, parents, siblings and children
-                # to be computed
-                u_list = last_u_list
-                v_list = last_v_list
+    @property
+    def schedule( self ):
+        # List of ( u_list, v_list ) levels.  Everything in a level can be computed at the same time
+        if( getattr( self, '_schedule', None ) is None ):
+            self.compileSchedule()
+        return self._schedule
 
-                while( loopyHasConverged() == False ):
+    @property
+    def scheduleHasCycle( self ):
+        self.schedule
+        return self._schedule_has_cycle
 
-                    u_list, v_list = self.loopyNextNodes( u_list, v_list )
+    @property
+    def n_levels( self ):
+        return len( self.schedule )
 
-                    uWork( False, u_list, **kwargs )
-                    vWork( False, v_list, **kwargs )
+    def levelWidths( self ):
+        # Number of U and V computations at each level
+        return np.array( [ [ len( u_list ), len( v_list[ 0 ] ) ] for u_list, v_list in self.schedule ], dtype=int ).reshape( ( -1, 2 ) )
 
-                loopy = True
-                break
+    ######################################################################
+
+    def compileForwardLevels( self ):
+        # Record the node lists that forwardPass visits along with a table of the
+        # parents of every node in the order of the transition axes ( padded with -1 ).
+        # Lets code that walks down the graph ( like sampling ) work a level at a time
+        levels = []
+        self.forwardPass( lambda node_list: levels.append( node_list ) )
+
+        n_nodes, n_edges = self.pmask.shape
+        max_parents = self.pmask.data.max() if self.pmask.nnz > 0 else 0
+
+        # The parents of each edge, ordered by position
+        edge_parents = np.full( ( n_edges, max_parents ), -1, dtype=int )
+        edge_parents[ self.pmask.col, self.pmask.data - 1 ] = self.pmask.row
+
+        # Every node is the child of at most one edge
+        assert np.all( np.bincount( self.cmask.row, minlength=n_nodes ) <= 1 )
+        parent_table = np.full( ( n_nodes, max_parents ), -1, dtype=int )
+        parent_table[ self.cmask.row ] = edge_parents[ self.cmask.col ]
+
+        parent_table.setflags( write=False )
+        self._forward_levels = levels
+        self._parent_table = parent_table
+
+    @property
+    def forwardLevels( self ):
+        # List of node lists.  The parents of every node in a level are in earlier levels
+        if( getattr( self, '_forward_levels', None ) is None ):
+            self.compileForwardLevels()
+        return self._forward_levels
+
+    @property
+    def parentTable( self ):
+        # parentTable[ node, i ] is the parent on the i'th axis of node's transition.  -1 if there isn't one
+        if( getattr( self, '_forward_levels', None ) is None ):
+            self.compileForwardLevels()
+        return self._parent_table
+
+    ######################################################################
+
+    def upDown( self, uWork, vWork, enable_loopy=False, loopyHasConverged=None, **kwargs ):
+        # Run the up down algorithm for latent state space models.  The order that
+        # the nodes are visited in is compiled once per topology and replayed here
+
+        levels = self.schedule
+
+        for i, ( u_list, v_list ) in enumerate( levels ):
+
+            if( i == 0 ):
+                # Do work for base case nodes
+                uWork( True, u_list, **kwargs )
+                vWork( True, v_list, **kwargs )
+            else:
+                # In case we're pre-fetching values
+                self.lock()
+
+                # Do work for each of the nodes
+                uWork( False, u_list, **kwargs )
+                vWork( False, v_list, **kwargs )
+
+        # Check if we need to do loopy propagation belief
+        if( self.scheduleHasCycle ):
+
+            if( not enable_loopy ):
+                assert 0, 'Cycle encountered.  Set enable_loopy to True'
+            if( loopyHasConverged is None ):
+                assert 0, 'Need to specify the convergence function loopyHasConverged!'
+
+            print( 'Cycle encountered!  Starting loopy belief propagation...' )
+
+            # The loopy algorithm will just forcibly keep adding mates, parents, siblings and children
+            # to be computed
+            u_list, v_list = levels[ -1 ]
+
+            while( loopyHasConverged() == False ):
+
+                u_list, v_list = self.loopyNextNodes( u_list, v_list )
+
+                uWork( False, u_list, **kwargs )
+                vWork( False, v_list, **kwargs )
 
         # Wait for all of the filter values to be written
         self.lock()
 
-        if( loopy == False ):
-            assert np.any( u_semaphore != 0 ) == False
-            assert np.any( v_semaphore.data != 0 ) == False
-
     ######################################################################
 
     def nParents( self, node ):
@@ -687,14 +940,16 @@ class GraphMessagePasser():
     def nChildren( self, node, edges=None ):
         return self.getChildren( node ).shape[ 0 ]
 
+    ######################################################################
+
+    def graphIndex( self, node ):
+        # Which of the graphs passed to updateMasks node belongs to
+        return int( np.searchsorted( self.parent_graph_assignments, node, side='right' ) - 1 )
+
 ##########################################################################################################
 
 class GraphMessagePasserFBS( GraphMessagePasser ):
 
-    def clearCache( self ):
-        super().clearCache()
-        self._infbs.cache_clear()
-
     def toGraph( self, use_partial=False ):
         if( use_partial ):
             return self.partial_graph.toGraph()
@@ -783,26 +1038,18 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
             for i, node in enumerate( fbs ):
                 self.fbs_indices[ node ] = i
 
-        # Create a mapping from the full graph indices to the partial graph indices
+        # Lookup arrays to map between the full and partial graph indices.  The
+        # nodes that aren't in the fbs keep their order and the fbs nodes are
+        # re-indexed starting from the number of non fbs nodes
         non_fbs = self.full_graph.nodes[ ~self.fbs_mask ]
-        non_fbs_reindexed = ( self.full_graph.nodes - self.fbs_mask.cumsum() )[ ~self.fbs_mask ]
-        index_map = dict( zip( non_fbs, non_fbs_reindexed ) )
-        index_map_reversed = dict( zip( non_fbs_reindexed, non_fbs ) )
-
-        # Re-index the fbs nodes starting from non_fbs.size
-        fbs_index_map = dict( zip( self.fbs, np.arange( self.fbs.shape[ 0 ] ) + non_fbs.shape[ 0 ] ) )
-        fns_index_map_reversed = dict( zip( np.arange( self.fbs.shape[ 0 ] ) + non_fbs.shape[ 0 ], self.fbs ) )
-        index_map.update( fbs_index_map )
-        index_map_reversed.update( fns_index_map_reversed )
+        self.full_to_partial = np.empty( self.full_graph.nodes.shape[ 0 ], dtype=int )
+        self.full_to_partial[ non_fbs ] = np.arange( non_fbs.shape[ 0 ] )
+        self.full_to_partial[ self.fbs ] = np.arange( self.fbs.shape[ 0 ] ) + non_fbs.shape[ 0 ]
+        self.partial_to_full = np.empty_like( self.full_to_partial )
+        self.partial_to_full[ self.full_to_partial ] = self.full_graph.nodes
 
-        print( 'self.fbs', self.fbs )
-        print( 'index_map', index_map )
-
-        # Create a functions to map:
-        # full_graph -> partial_graph
-        # partial_graph -> full_graph
-        self.fullGraphIndexToPartialGraphIndex = np.vectorize( lambda x: index_map[ x ] )
-        self.partialGraphIndexToFullGraphIndex = np.vectorize( lambda x: index_map_reversed[ x ] )
+        # Whether or not each partial graph index is in the fbs
+        self.partial_fbs_mask = self.fbs_mask[ self.partial_to_full ]
 
         # Create the partial graph
         mask = ~np.in1d( self.full_graph.pmask.row, self.fbs )
@@ -825,15 +1072,20 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
         self.partial_graph = GraphMessagePasser()
         self.partial_graph.updateMasks( [ parital_pmask ], [ parital_cmask ] )
 
+        # forwardPass walks the full graph
+        self._forward_levels = None
+
     ######################################################################
 
-    @lru_cache()
-    def _infbs( self, node, is_partial_graph_index ):
-        full_node = self.partialGraphIndexToFullGraphIndex( node ) if is_partial_graph_index else node
-        return full_node in self.fbs
+    def fullGraphIndexToPartialGraphIndex( self, nodes ):
+        return self.full_to_partial[ np.asarray( nodes, dtype=int ) ]
+
+    def partialGraphIndexToFullGraphIndex( self, nodes ):
+        return self.partial_to_full[ np.asarray( nodes, dtype=int ) ]
 
     def inFeedbackSet( self, node, is_partial_graph_index ):
-        return self._infbs( int( node ), is_partial_graph_index )
+        mask = self.partial_fbs_mask if is_partial_graph_index else self.fbs_mask
+        return bool( mask[ int( node ) ] )
 
     def fbsIndex( self, node, is_partial_graph_index, within_graph=True ):
         full_node = self.partialGraphIndexToFullGraphIndex( node ) if is_partial_graph_index else node
@@ -844,6 +1096,9 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
 
         return self.fbs_indices[ int( full_node ) ]
 
+    def graphIndex( self, node ):
+        return self.full_graph.graphIndex( node )
+
     ######################################################################
 
     @property
@@ -864,7 +1119,7 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
         return self.full_graph.getParents( nodes, split=split, get_order=get_order )
 
     def getSiblings( self, nodes, split=False ):
-        return self.full_graph.getSiblings( nodes, split=split, get_order=get_order )
+        return self.full_graph.getSiblings( nodes, split=split )
 
     def getChildren( self, nodes, edges=None ):
         return self.full_graph.getChildren( nodes, edges=edges )
@@ -875,93 +1130,45 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
     ######################################################################
 
     def convertIndices( self, nodes, partial_to_full=True ):
-        converter = self.partialGraphIndexToFullGraphIndex if partial_to_full else self.fullGraphIndexToPartialGraphIndex
+        lookup = self.partial_to_full if partial_to_full else self.full_to_partial
+        return lookup[ np.asarray( nodes, dtype=int ) ]
 
-        # Handle different type possibilities for nodes
-        if( isinstance( nodes, np.ndarray ) and nodes.ndim == 0 ):
-            nodes = converter( nodes )
-        else:
-            nodes = [ converter( n ) for n in nodes ] if isinstance( nodes, Iterable ) else converter( nodes )
-        return nodes
-
-    def convertResultIndices( self, nodes_maybe_order, get_order=False, split=False, split_by_edge=False, partial_to_full=True, filterFunc=None ):
+    def convertResultIndices( self, nodes_maybe_order, get_order=False, split=False, split_by_edge=False, partial_to_full=True, keepMask=None ):
+        # Convert the result of a fetch to the other graph's indices.  keepMask
+        # maps an array of nodes to a boolean array of the nodes to keep
         if( partial_to_full is None ):
-            converter = lambda n: n
-        else:
-            converter = self.partialGraphIndexToFullGraphIndex if partial_to_full else self.fullGraphIndexToPartialGraphIndex
-        filterFunc = filterFunc if filterFunc is not None else lambda x: True
-
-        # Handle case where ans is split by node and/or edge, or order is included
-        if( get_order ):
-            if( split ):
-                if( split_by_edge ):
-                    nodes, order = [], []
-                    for nodes_in_group in nodes_maybe_order:
-                        _nodes, _order = [], []
-                        for nodes_in_edge in nodes_in_group:
-                            if( len( nodes_in_edge ) > 0 ):
-                                __nodes__order = [ ( converter( n ), o ) for n, o in zip( *nodes_in_edge ) if filterFunc( n ) ]
-                                __nodes, __order = zip( *__nodes__order ) if len( __nodes__order ) > 0 else ( [], [] )
-                            else:
-                                __nodes, __order = [], []
-                            _nodes.append( np.array( __nodes ) )
-                            _order.append( np.array( __order ) )
-                        nodes.append( _nodes )
-                        order.append( _order )
-                    return nodes, order
-                else:
-                    nodes, order = [], []
-                    for nodes_in_group in nodes_maybe_order:
-                        if( len( nodes_in_group ) > 0 ):
-                            _nodes_order = [ ( converter( n ), o ) for n, o in zip( *nodes_in_group ) if filterFunc( n ) ]
-                            _nodes, _order = zip( *_nodes_order ) if len( _nodes_order ) > 0 else ( [], [] )
-                        else:
-                            _nodes, _order = [], []
-                        nodes.append( np.array( _nodes ) )
-                        order.append( np.array( _order ) )
-                    return nodes, order
-            else:
-                if( split_by_edge ):
-                    nodes, order = [], []
-                    for nodes_in_edge in nodes_maybe_order:
-                        if( len( nodes_in_edge ) > 0 ):
-                            _nodes_order = [ ( converter( n ), o ) for n, o in zip( *nodes_in_edge ) if filterFunc( n ) ]
-                            _nodes, _order = zip( *_nodes_order ) if len( _nodes_order ) > 0 else ( [], [] )
-                        else:
-                            _nodes, _order = [], []
-                        nodes.append( np.array( _nodes ) )
-                        order.append( np.array( _order ) )
-                    return nodes, order
-                else:
-                    if( len( nodes_maybe_order ) > 0 ):
-                        nodesorder = [ ( converter( n ), o ) for n, o in zip( *nodes_maybe_order ) if filterFunc( n ) ]
-                        nodes, order = zip( *nodesorder ) if len( nodesorder ) > 0 else ( [], [] )
-                    else:
-                        nodes, order = [], []
-                    return np.array( nodes ), np.array( order )
+            lookup = None
         else:
-            if( split ):
-                if( split_by_edge ):
-                    nodes = []
-                    for nodes_in_group in nodes_maybe_order:
-                        _nodes = []
-                        for nodes_in_edge in nodes_in_group:
-                            _nodes.append( np.array( [ converter( n ) for n in nodes_in_edge if filterFunc( n ) ] ) )
-                        nodes.append( _nodes )
-                    return nodes
-                else:
-                    nodes = []
-                    for nodes_in_group in nodes_maybe_order:
-                        nodes.append( np.array( [ converter( n ) for n in nodes_in_group if filterFunc( n ) ] ) )
-                    return nodes
-            else:
-                if( split_by_edge ):
-                    nodes = []
-                    for nodes_in_edge in nodes_maybe_order:
-                        nodes.append( np.array( [ converter( n ) for n in nodes_in_edge if filterFunc( n ) ] ) )
-                    return nodes
-                else:
-                    return np.array( [ converter( n ) for n in nodes_maybe_order if filterFunc( n ) ] )
+            lookup = self.partial_to_full if partial_to_full else self.full_to_partial
+
+        def convert( nodes, order=None ):
+            nodes = np.asarray( nodes, dtype=int ).ravel()
+            if( keepMask is not None ):
+                keep = keepMask( nodes )
+                nodes = nodes[ keep ]
+                order = order[ keep ] if order is not None else None
+            if( lookup is not None ):
+                nodes = lookup[ nodes ]
+            return nodes if order is None else ( nodes, order )
+
+        def convertLeaf( leaf ):
+            if( get_order == False ):
+                return convert( leaf )
+            if( len( leaf ) == 0 ):
+                return convert( [], np.array( [], dtype=int ) )
+            nodes, order = leaf
+            return convert( nodes, np.asarray( order, dtype=int ).ravel() )
+
+        # The result is nested once if its split by node and once more if its split by edge
+        def convertLevel( fetched, depth ):
+            if( depth == 0 ):
+                return convertLeaf( fetched )
+            converted = [ convertLevel( f, depth - 1 ) for f in fetched ]
+            if( get_order ):
+                return [ c[ 0 ] for c in converted ], [ c[ 1 ] for c in converted ]
+            return converted
+
+        return convertLevel( nodes_maybe_order, int( split ) + int( split_by_edge ) )
 
     def shouldConvertPartialToFull( self, input_is_parital_index, output_partial_index ):
         if( input_is_parital_index == True ):
@@ -982,7 +1189,7 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
 
     ######################################################################
 
-    def fetchGraphNodes( self, nodes, fetchFunc, filterFunc=None, get_order=False, split=False, split_by_edge=False, is_partial_graph_index=False, return_partial_graph_index=False, use_partial_graph=False ):
+    def fetchGraphNodes( self, nodes, fetchFunc, keepMask=None, get_order=False, split=False, split_by_edge=False, is_partial_graph_index=False, return_partial_graph_index=False, use_partial_graph=False ):
 
         # Ensure that the nodes are using the correct indices before passing to fetchFunc
         partial_to_full = self.shouldConvertPartialToFull( is_partial_graph_index, use_partial_graph )
@@ -994,8 +1201,8 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
 
         # Return the nodes using the correct indices
         partial_to_full = self.shouldConvertPartialToFull( use_partial_graph, return_partial_graph_index )
-        if( partial_to_full is not None or filterFunc is not None ):
-            fetched = self.convertResultIndices( fetched, get_order=get_order, split=split, split_by_edge=split_by_edge, partial_to_full=partial_to_full, filterFunc=filterFunc )
+        if( partial_to_full is not None or keepMask is not None ):
+            fetched = self.convertResultIndices( fetched, get_order=get_order, split=split, split_by_edge=split_by_edge, partial_to_full=partial_to_full, keepMask=keepMask )
 
         return fetched
 
@@ -1085,8 +1292,8 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
 
         # Otherwise, just fetch nodes from the full graph and filter out the fbs nodes
         fetchFunc = partial( self.full_graph.getParents, split=split, get_order=get_order )
-        filterFunc = lambda n: not self.inFeedbackSet( n, is_partial_graph_index=False )
-        return self.fetchGraphNodes( nodes, fetchFunc, filterFunc=filterFunc, get_order=get_order, split=split, split_by_edge=False, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=False )
+        keepMask = lambda nodes: ~self.fbs_mask[ nodes ]
+        return self.fetchGraphNodes( nodes, fetchFunc, keepMask=keepMask, get_order=get_order, split=split, split_by_edge=False, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=False )
 
     def getPartialSiblings( self,
                             nodes,
@@ -1103,8 +1310,8 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
             return self.fetchGraphNodes( nodes, fetchFunc, get_order=False, split=split, split_by_edge=False, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=True )
 
         fetchFunc = partial( self.full_graph.getSiblings, split=split )
-        filterFunc = lambda n: not self.inFeedbackSet( n, is_partial_graph_index=False )
-        return self.fetchGraphNodes( nodes, fetchFunc, filterFunc=filterFunc, get_order=False, split=split, split_by_edge=False, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=False )
+        keepMask = lambda nodes: ~self.fbs_mask[ nodes ]
+        return self.fetchGraphNodes( nodes, fetchFunc, keepMask=keepMask, get_order=False, split=split, split_by_edge=False, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=False )
 
     def getPartialChildren( self,
                             nodes,
@@ -1123,8 +1330,8 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
             return self.fetchGraphNodes( nodes, fetchFunc, get_order=False, split=split, split_by_edge=split_by_edge, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=True )
 
         fetchFunc = partial( self.full_graph.getChildren, edges=edges, split_by_edge=split_by_edge, split=split )
-        filterFunc = lambda n: not self.inFeedbackSet( n, is_partial_graph_index=False )
-        return self.fetchGraphNodes( nodes, fetchFunc, filterFunc=filterFunc, get_order=False, split=split, split_by_edge=split_by_edge, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=False )
+        keepMask = lambda nodes: ~self.fbs_mask[ nodes ]
+        return self.fetchGraphNodes( nodes, fetchFunc, keepMask=keepMask, get_order=False, split=split, split_by_edge=split_by_edge, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=False )
 
     def getPartialMates( self,
                          nodes,
@@ -1144,8 +1351,8 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
             return self.fetchGraphNodes( nodes, fetchFunc, get_order=get_order, split=split, split_by_edge=split_by_edge, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=True )
 
         fetchFunc = partial( self.full_graph.getMates, edges=edges, split_by_edge=split_by_edge, split=split, get_order=get_order )
-        filterFunc = lambda n: not self.inFeedbackSet( n, is_partial_graph_index=False )
-        return self.fetchGraphNodes( nodes, fetchFunc, filterFunc=filterFunc, get_order=get_order, split=split, split_by_edge=split_by_edge, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=False )
+        keepMask = lambda nodes: ~self.fbs_mask[ nodes ]
+        return self.fetchGraphNodes( nodes, fetchFunc, keepMask=keepMask, get_order=get_order, split=split, split_by_edge=split_by_edge, is_partial_graph_index=is_partial_graph_index, return_partial_graph_index=return_partial_graph_index, use_partial_graph=False )
 
     ######################################################################
 
@@ -1173,6 +1380,10 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
         else:
             return self.full_graph.getDownEdges( nodes, split=split, skip_edges=skip_edges )
 
+    def vSlots( self, node, edges=None ):
+        # V is stored over the partial graph, so node and edges are partial graph indices
+        return self.partial_graph.vSlots( node, edges=edges )
+
     ######################################################################
 
     def nParents( self, node, is_partial_graph_index=False, use_partial_graph=False ):
@@ -1201,6 +1412,17 @@ class GraphMessagePasserFBS( GraphMessagePasser ):
 
     ######################################################################
 
+    @property
+    def schedule( self ):
+        return self.partial_graph.schedule
+
+    @property
+    def n_levels( self ):
+        return self.partial_graph.n_levels
+
+    def levelWidths( self ):
+        return self.partial_graph.levelWidths()
+
     def upDown( self, uWork, vWork, enable_loopy=False, loopyHasConverged=None, **kwargs ):
         # Message passing is from the partial graph!
         return self.partial_graph.upDown( uWork, vWork, enable_loopy=enable_loopy, loopyHasConverged=loopyHasConverged, **kwargs )
@@ -0,0 +1,94 @@
+import autograd.numpy as np
+from GenModels.GM.Utility import fbsData
+
+__all__ = [ 'Arena', 'MessageList' ]
+
+######################################################################
+
+class Arena():
+    # Bump allocator over blocks of memory.  Nothing is freed until release
+    # is called ( or the arena is garbage collected ).
+
+    def __init__( self, block_size=2**16 ):
+        self.block_size = block_size
+        self.blocks = []
+        self.offset = 0
+        self.capacity = 0
+
+    def newBlock( self, size ):
+        return np.empty( size )
+
+    def view( self, block, offset, shape ):
+        # offset is in number of elements
+        size = int( np.prod( shape ) )
+        return block[ offset:offset + size ].reshape( shape )
+
+    def allocate( self, shape ):
+        shape = tuple( int( s ) for s in shape )
+        size = int( np.prod( shape ) )
+
+        if( len( self.blocks ) == 0 or self.offset + size > self.capacity ):
+            self.capacity = max( self.block_size, size, 1 )
+            self.blocks.append( self.newBlock( self.capacity ) )
+            self.offset = 0
+
+        ans = self.view( self.blocks[ -1 ], self.offset, shape )
+        self.offset += size
+        return ans
+
+    def put( self, value ):
+        # Copy value into the arena
+        if( isinstance( value, fbsData ) ):
+            return fbsData( self.put( value.data ), value.fbs_axis )
+        value = np.asarray( value, dtype=float )
+        ans = self.allocate( value.shape )
+        ans[ ... ] = value
+        return ans
+
+    def release( self ):
+        self.blocks = []
+        self.offset = 0
+        self.capacity = 0
+
+######################################################################
+
+class MessageList():
+    # Ragged storage for the fbsData messages of the FBS filters.  The number
+    # of feedback set axes is different for every node, so the messages can't
+    # go in one dense array.  Instead their data is packed into the blocks of
+    # an arena and the list only holds views.  Writing a message that has
+    # the same shape as the one already in its slot reuses the memory.
+    # Anything that isn't a numpy array ( like an autograd box ) is kept as is.
+
+    def __init__( self, n, arena=None ):
+        self.arena = Arena() if arena is None else arena
+        self.messages = [ None for _ in range( n ) ]
+
+    def __len__( self ):
+        return len( self.messages )
+
+    def __iter__( self ):
+        return iter( self.messages )
+
+    def __getitem__( self, i ):
+        return self.messages[ i ]
+
+    def __setitem__( self, i, value ):
+        current = self.messages[ i ]
+        data = value.data
+
+        if( isinstance( data, np.ndarray ) == False ):
+            self.messages[ i ] = value
+        elif( current is not None and isinstance( current.data, np.ndarray ) and current.data.shape == data.shape ):
+            current.data[ ... ] = data
+            self.messages[ i ] = fbsData( current.data, value.fbs_axis )
+        else:
+            self.messages[ i ] = self.arena.put( value )
+
+    def copy( self, arena=None ):
+        # Copy of the messages in a new arena
+        ans = MessageList( len( self ), arena=arena )
+        for i, message in enumerate( self.messages ):
+            if( message is not None ):
+                ans[ i ] = message
+        return ans
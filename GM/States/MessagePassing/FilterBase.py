@@ -1,5 +1,25 @@
 from abc import ABC, abstractmethod
 import autograd.numpy as np
+import multiprocessing.pool
+from multiprocessing import Pool
+
+######################################################################
+
+# Each task is ( msg, data ) where msg is the filter to run the block with
+
+def _blockTotalWork( task ):
+    msg, ts = task
+    return msg.blockTotal( ts )
+
+def _forwardBlockWork( task ):
+    msg, data = task
+    return msg.forwardBlock( *data )
+
+def _backwardBlockWork( task ):
+    msg, data = task
+    return msg.backwardBlock( *data )
+
+######################################################################
 
 class MessagePasser( ABC ):
     # Base message passing class for forward backward
@@ -68,6 +88,71 @@ class MessagePasser( ABC ):
     def log_marginalFromAlphaBeta( cls, alpha, beta ):
         pass
 
+    @abstractmethod
+    def combineElements( self, a, b ):
+        # The element that does step a and then step b
+        pass
+
+    @abstractmethod
+    def applyForward( self, element, alpha ):
+        pass
+
+    @abstractmethod
+    def applyBackward( self, element, beta ):
+        pass
+
+    ######################################################################
+
+    @property
+    def n_workers( self ):
+        # Number of processes to run the blocks of the scan on.  With 1
+        # worker everything runs in this process
+        if( hasattr( self, '_n_workers' ) == False ):
+            self._n_workers = 1
+        return self._n_workers
+
+    @n_workers.setter
+    def n_workers( self, val ):
+        if( hasattr( self, '_scan_pool' ) ):
+            self._scan_pool.close()
+            delattr( self, '_scan_pool' )
+        self._n_workers = val
+
+    @property
+    def scan_pool( self ):
+        if( hasattr( self, '_scan_pool' ) == False ):
+            self._scan_pool = Pool( self.n_workers )
+        return self._scan_pool
+
+    def cleanup( self ):
+        if( hasattr( self, '_scan_pool' ) ):
+            self._scan_pool.close()
+            self._scan_pool.join()
+            delattr( self, '_scan_pool' )
+
+        # Let the other bases close their pools too
+        if( hasattr( super( MessagePasser, self ), 'cleanup' ) ):
+            super( MessagePasser, self ).cleanup()
+
+    def __del__( self ):
+        self.cleanup()
+
+    def __getstate__( self ):
+        # Process pools stay in the process that made them
+        return { key: val for key, val in self.__dict__.items() if not isinstance( val, multiprocessing.pool.Pool ) }
+
+    @property
+    def n_blocks( self ):
+        # Number of blocks that the scan splits the sequence into.  The
+        # filters only use the scan when there is more than 1 block
+        if( hasattr( self, '_n_blocks' ) == False ):
+            return self.n_workers
+        return self._n_blocks
+
+    @n_blocks.setter
+    def n_blocks( self, val ):
+        self._n_blocks = val
+
     ######################################################################
 
     def forwardStep( self, t, alpha ):
@@ -107,6 +192,9 @@ class MessagePasser( ABC ):
 
     def forwardFilter( self ):
 
+        if( self.n_blocks > 1 ):
+            return self.forwardFilterScan()
+
         alphas = self.genFilterProbs()
         alphas[ 0 ] = self.forwardBaseCase()
 
@@ -119,6 +207,9 @@ class MessagePasser( ABC ):
 
     def backwardFilter( self ):
 
+        if( self.n_blocks > 1 ):
+            return self.backwardFilterScan()
+
         betas = self.genFilterProbs()
         betas[ -1 ] = self.backwardBaseCase()
 
@@ -127,6 +218,110 @@ class MessagePasser( ABC ):
 
         return betas
 
+    ######################################################################
+    # Blocked prefix scan.  Step t of the filter is an element that maps the
+    # message over x_t-1 to the message over x_t ( and the reverse for the
+    # backward filter ) and combining elements is associative.  The sequence
+    # is split into blocks and
+    #   1. Each block combines its elements into a single element ( in parallel )
+    #   2. The block elements are applied in order to get the message going
+    #      into each block ( sequential, but only n_blocks steps )
+    #   3. Each block runs the regular filter starting from its incoming
+    #      message ( in parallel )
+
+    def scanElement( self, t ):
+        # P( y_t | x_t ) * P( x_t | x_t-1 )
+        transition = self.transitionProb( t - 1, t, forward=False )
+        emission = self.emissionProb( t, forward=False )
+        return self.multiplyTerms( ( transition, emission ) )
+
+    def blockTotal( self, ts ):
+        total = self.scanElement( ts[ 0 ] )
+        for t in ts[ 1: ]:
+            total = self.combineElements( total, self.scanElement( t ) )
+        return total
+
+    def forwardBlock( self, ts, alpha ):
+        alphas = []
+        for t in ts:
+            alpha = self.forwardStep( t, alpha )
+            alphas.append( alpha )
+        return alphas
+
+    def backwardBlock( self, ts, beta ):
+        # ts is in increasing order and beta is the message at ts[ -1 ]
+        betas = []
+        for t in reversed( ts[ :-1 ] ):
+            beta = self.backwardStep( t, beta )
+            betas.append( beta )
+        return betas[ ::-1 ]
+
+    def scanBlocks( self ):
+        # Split t = 1:T-1 into contiguous blocks
+        n_blocks = max( 1, min( self.n_blocks, self.T - 1 ) )
+        return [ ts for ts in np.array_split( np.arange( 1, self.T ), n_blocks ) if ts.size > 0 ]
+
+    def scanMap( self, work, data ):
+        # Run work over ( self, d ) for every d in data, either here or on the scan
+        # pool.  The pool gets one batch of tasks per worker, so this filter is
+        # only pickled once per worker instead of once per block
+        tasks = [ ( self, d ) for d in data ]
+        if( self.n_workers == 1 ):
+            return [ work( task ) for task in tasks ]
+
+        chunksize = max( 1, -( -len( tasks ) // self.n_workers ) )
+        return self.scan_pool.map( work, tasks, chunksize=chunksize )
+
+    def forwardFilterScan( self ):
+
+        alphas = self.genFilterProbs()
+        alphas[ 0 ] = self.forwardBaseCase()
+        if( self.T == 1 ):
+            return alphas
+
+        blocks = self.scanBlocks()
+        totals = self.scanMap( _blockTotalWork, blocks )
+
+        # The message going into each block
+        incoming = [ alphas[ 0 ] ]
+        for total in totals[ :-1 ]:
+            incoming.append( self.applyForward( total, incoming[ -1 ] ) )
+
+        results = self.scanMap( _forwardBlockWork, list( zip( blocks, incoming ) ) )
+        for ts, block_alphas in zip( blocks, results ):
+            for t, alpha in zip( ts, block_alphas ):
+                alphas[ t ] = alpha
+
+        return alphas
+
+    def backwardFilterScan( self ):
+
+        betas = self.genFilterProbs()
+        betas[ -1 ] = self.backwardBaseCase()
+        if( self.T == 1 ):
+            return betas
+
+        # Block i of the backward filter computes the betas at ts[ i ] - 1
+        blocks = self.scanBlocks()
+        totals = self.scanMap( _blockTotalWork, blocks )
+
+        # The message coming out of the end of each block
+        incoming = [ betas[ -1 ] ]
+        for total in reversed( totals[ 1: ] ):
+            incoming.append( self.applyBackward( total, incoming[ -1 ] ) )
+        incoming = incoming[ ::-1 ]
+
+        # Include the last time step of the previous block so that
+        # backwardBlock computes every beta in the block
+        data = [ ( np.hstack( ( ts[ 0 ] - 1, ts ) ), beta ) for ts, beta in zip( blocks, incoming ) ]
+        results = self.scanMap( _backwardBlockWork, data )
+        for ( ts, _ ), block_betas, beta in zip( data, results, incoming ):
+            for t, _beta in zip( ts[ :-1 ], block_betas ):
+                betas[ t ] = _beta
+            betas[ ts[ -1 ] ] = beta
+
+        return betas
+
     ######################################################################
 
     def childParentJoint( self, t, alphas, betas ):
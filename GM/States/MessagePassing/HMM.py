@@ -10,7 +10,15 @@ __all__ = [ 'CategoricalHMM',
 #########################################################################################
 
 class CategoricalHMM( MessagePasser ):
-    # Categorical emissions.  Everything is done in log space
+    # Categorical emissions.  The messages are always in log space, but
+    # with backend = 'scaled' they're computed with the scaled forward backward
+    # algorithm ( normalized probabilities and a log scale per step ) and
+    # fall back to the log space recursion if the probabilities underflow
+
+    backend = 'log'
+
+    # Known latent states from the last forward or backward filter
+    chainCuts = None
 
     @property
     def K( self ):
@@ -90,7 +98,9 @@ class CategoricalHMM( MessagePasser ):
                 x1 = self.chainCuts[ t1Index, 1 ]
                 ans[ :, x1 ] = 0.0
 
-        return ans if forward == True else ans.T
+        # pi is indexed by [ x_t, x_t1 ], but the forward pass integrates
+        # out the last axis so it needs [ x_t1, x_t ]
+        return ans.T if forward == True else ans
 
     ######################################################################
 
@@ -165,6 +175,12 @@ class CategoricalHMM( MessagePasser ):
         else:
             self.chainCuts = None
 
+        # The scan runs its blocks in log space
+        if( self.useScaled() and self.n_blocks == 1 ):
+            alphas = self.scaledForwardFilter()
+            if( alphas is not None ):
+                return alphas
+
         return super( CategoricalHMM, self ).forwardFilter()
 
     ######################################################################
@@ -183,8 +199,114 @@ class CategoricalHMM( MessagePasser ):
         else:
             self.chainCuts = None
 
+        # The scan runs its blocks in log space
+        if( self.useScaled() and self.n_blocks == 1 ):
+            betas = self.scaledBackwardFilter()
+            if( betas is not None ):
+                return betas
+
         return super( CategoricalHMM, self ).backwardFilter()
 
+    ######################################################################
+    # Scaled forward backward.  The messages are kept as probabilities that
+    # are normalized at every step so that the transitions are just a dot
+    # product.  The log of the normalizers are accumulated and added back on
+    # when writing out the log space messages.  These return None if anything
+    # underflows so that the caller can redo the filter in log space.
+
+    def useScaled( self ):
+        assert self.backend in [ 'log', 'scaled' ], 'Invalid backend %s'%( self.backend )
+        return self.backend == 'scaled'
+
+    def scaledEmissions( self ):
+        # Shift each time step by its max so that exp doesn't underflow
+        log_E = self.emissionLogLikelihoods()
+        shift = np.max( log_E, axis=1 )
+        shift = np.where( np.isfinite( shift ), shift, 0.0 )
+        return np.exp( log_E - shift[ :, None ] ), shift, np.isfinite( log_E )
+
+    def scaledTransition( self, t, t1, P ):
+        # P( x_t1 | x_t ) indexed by [ x_t, x_t1 ]
+        if( self.chainCuts is None ):
+            return P
+        return np.exp( self.transitionProb( t, t1, forward=False ) )
+
+    @classmethod
+    def scaledUnderflow( cls, probs, reachable ):
+        # An entry that is ( almost ) 0 is only ok if it couldn't have been reached.
+        # reachable is only evaluated when there are small entries
+        if( probs.min() >= np.finfo( float ).tiny ):
+            return False
+        return np.any( ( probs < np.finfo( float ).tiny ) & reachable() )
+
+    @classmethod
+    def scaledNormalize( cls, probs ):
+        total = float( probs.sum() )
+        if( not( 0.0 < total < np.inf ) ):
+            return None, None
+        return probs / total, np.log( total )
+
+    def scaledForwardFilter( self ):
+
+        E, shift, E_support = self.scaledEmissions()
+        P = np.exp( self.pi )
+
+        # The normalized messages and the log normalizer of each step
+        probs = self.genFilterProbs()
+        log_scales = np.empty( self.T )
+
+        base = self.forwardBaseCase()
+        base_shift = np.max( base )
+        if( not np.isfinite( base_shift ) ):
+            return None
+
+        alpha, log_scales[ 0 ] = self.scaledNormalize( np.exp( base - base_shift ) )
+        if( alpha is None or self.scaledUnderflow( alpha, lambda: np.isfinite( base ) ) ):
+            return None
+        log_scales[ 0 ] += base_shift
+        probs[ 0 ] = alpha
+
+        for t in range( 1, self.T ):
+            P_t = self.scaledTransition( t - 1, t, P )
+
+            alpha_t, log_scales[ t ] = self.scaledNormalize( alpha.dot( P_t ) * E[ t ] )
+            if( alpha_t is None ):
+                return None
+
+            if( self.scaledUnderflow( alpha_t, lambda: ( ( alpha > 0 ).dot( P_t > 0 ) > 0 ) & E_support[ t ] ) ):
+                return None
+
+            alpha = probs[ t ] = alpha_t
+
+        with np.errstate( divide='ignore' ):
+            return np.log( probs ) + np.cumsum( log_scales + np.hstack( ( 0.0, shift[ 1: ] ) ) )[ :, None ]
+
+    def scaledBackwardFilter( self ):
+
+        E, shift, E_support = self.scaledEmissions()
+        P = np.exp( self.pi )
+
+        probs = self.genFilterProbs()
+        log_scales = np.zeros( self.T )
+
+        beta = probs[ -1 ] = np.ones( self.K )
+
+        for t in reversed( range( self.T - 1 ) ):
+            P_t = self.scaledTransition( t, t + 1, P )
+
+            beta_t, log_scales[ t ] = self.scaledNormalize( P_t.dot( E[ t + 1 ] * beta ) )
+            if( beta_t is None ):
+                return None
+
+            if( self.scaledUnderflow( beta_t, lambda: ( P_t > 0 ).dot( ( beta > 0 ) & E_support[ t + 1 ] ) > 0 ) ):
+                return None
+
+            log_scales[ t ] += shift[ t + 1 ]
+            beta = probs[ t ] = beta_t
+
+        with np.errstate( divide='ignore' ):
+            return np.log( probs ) + np.cumsum( log_scales[ ::-1 ] )[ ::-1, None ]
+
     ######################################################################
 
     def childParentJoint( self, t, alphas, betas, ys=None ):
@@ -203,6 +325,215 @@ class CategoricalHMM( MessagePasser ):
     def log_marginalFromAlphaBeta( cls, alpha, beta ):
         return np.logaddexp.reduce( alpha + beta )
 
+    ######################################################################
+    # Elements of the parallel scan are log transition matrices indexed by
+    # [ x_start, x_end ] and combining them is matrix multiplication in log space
+
+    @classmethod
+    def logMatMul( cls, A, B ):
+        # log( exp( A ).dot( exp( B ) ) ).  The rows of A and columns of B are
+        # shifted by their max so that this can use dot
+        max_A = np.max( A, axis=1, keepdims=True )
+        max_A = np.where( np.isfinite( max_A ), max_A, 0.0 )
+        max_B = np.max( B, axis=0, keepdims=True )
+        max_B = np.where( np.isfinite( max_B ), max_B, 0.0 )
+
+        with np.errstate( divide='ignore' ):
+            ans = np.log( np.exp( A - max_A ).dot( np.exp( B - max_B ) ) ) + max_A + max_B
+
+            # A -inf is only real if every term in the sum is -inf
+            underflow = np.isneginf( ans ) & ( ( A > np.NINF ).dot( B > np.NINF ) > 0 )
+            if( np.any( underflow ) ):
+                full = A[ :, :, None ] + B[ None, :, : ]
+                max_full = np.max( full, axis=1 )
+                max_full = np.where( np.isfinite( max_full ), max_full, 0.0 )
+                exact = np.log( np.sum( np.exp( full - max_full[ :, None, : ] ), axis=1 ) ) + max_full
+                ans = np.where( underflow, exact, ans )
+
+        return ans
+
+    def combineElements( self, a, b ):
+        return self.logMatMul( a, b )
+
+    def blockTotal( self, ts ):
+        # Same as combining the elements one by one, but the running product is
+        # kept as probabilities with a log scale per row so that each step is
+        # just a dot.  Falls back to log space if anything underflows.
+        E, shift, E_support = self.scaledEmissions()
+        P = np.exp( self.pi )
+
+        start = ts[ 0 ]
+        element = self.scanElement( start )
+        row_scale = np.max( element, axis=1 )
+        if( not np.all( np.isfinite( row_scale ) ) ):
+            return super( CategoricalHMM, self ).blockTotal( ts )
+        total = np.exp( element - row_scale[ :, None ] )
+
+        for t in ts[ 1: ]:
+            P_t = self.scaledTransition( t - 1, t, P )
+            total_t = total.dot( P_t ) * E[ t ]
+
+            max_t = np.max( total_t, axis=1 )
+            if( not np.all( max_t > 0.0 ) ):
+                return super( CategoricalHMM, self ).blockTotal( ts )
+            total_t /= max_t[ :, None ]
+
+            if( self.scaledUnderflow( total_t, lambda: ( ( total > 0 ).dot( P_t > 0 ) > 0 ) & E_support[ t ] ) ):
+                return super( CategoricalHMM, self ).blockTotal( ts )
+
+            total = total_t
+            row_scale += np.log( max_t ) + shift[ t ]
+
+        with np.errstate( divide='ignore' ):
+            return np.log( total ) + row_scale[ :, None ]
+
+    def applyForward( self, element, alpha ):
+        return self.logMatMul( alpha[ None ], element )[ 0 ]
+
+    def applyBackward( self, element, beta ):
+        return self.logMatMul( element, beta[ :, None ] )[ :, 0 ]
+
+    ######################################################################
+    # Single observations for OnlineFilter.  y is the same as ys[ :, t ] and
+    # last_y is the observation at the previous time step
+
+    def onlineEmission( self, y ):
+        return self._L.T[ y ].sum( axis=0 )
+
+    def onlineBaseCase( self, y ):
+        return self.pi0 + self.onlineEmission( y )
+
+    def onlineElement( self, y, u=None, last_y=None ):
+        return self.pi + self.onlineEmission( y )[ None ]
+
+    ######################################################################
+    # Batched forward backward.  All of the sequences are padded out to the
+    # longest one and every time step is done for the whole batch at once,
+    # so the cost is T_max vectorized steps instead of N * T python steps.
+    # Doesn't handle known latent states.
+
+    def emissionLogLikelihoods( self ):
+        # P( y_t | x_t ) as a [ t, x_t ] array for the last preprocessed sequence
+        return self.L
+
+    def preprocessBatch( self, ys, **kwargs ):
+        # kwargs are passed to preprocessData for every sequence
+
+        emissions = []
+        for _ys in ys:
+            self.preprocessData( _ys, **kwargs )
+            emissions.append( self.emissionLogLikelihoods() )
+
+        self.lengths = np.array( [ e.shape[ 0 ] for e in emissions ] )
+        N, T_max = self.lengths.shape[ 0 ], self.lengths.max()
+
+        # Padded emissions are 0 ( P( y | x ) = 1 ) so they don't change anything
+        self.batch_L = np.zeros( ( N, T_max, self.K ) )
+        for i, e in enumerate( emissions ):
+            self.batch_L[ i, :e.shape[ 0 ] ] = e
+
+        # batch_mask[ i, t ] is true when t is a real time step of sequence i
+        self.batch_mask = np.arange( T_max )[ None ] < self.lengths[ :, None ]
+
+    @classmethod
+    def batchIntegrate( cls, log_x, P ):
+        # log( exp( log_x ).dot( P ) ) where each row of log_x is shifted by its max first
+        max_x = np.max( log_x, axis=1, keepdims=True )
+        max_x = np.where( np.isfinite( max_x ), max_x, 0.0 )
+        with np.errstate( divide='ignore' ):
+            return np.log( np.exp( log_x - max_x ).dot( P ) ) + max_x
+
+    def forwardFilterBatch( self ):
+
+        N, T_max, K = self.batch_L.shape
+        P = np.exp( self.pi )
+
+        alphas = np.empty( ( N, T_max, K ) )
+        alphas[ :, 0 ] = self.pi0 + self.batch_L[ :, 0 ]
+
+        # The padded steps past the end of a sequence are never used
+        for t in range( 1, T_max ):
+            alphas[ :, t ] = self.batchIntegrate( alphas[ :, t - 1 ], P ) + self.batch_L[ :, t ]
+
+        return alphas
+
+    def backwardFilterBatch( self ):
+
+        N, T_max, K = self.batch_L.shape
+        P_T = np.exp( self.pi ).T
+
+        betas = np.zeros( ( N, T_max, K ) )
+
+        for t in reversed( range( T_max - 1 ) ):
+            beta = self.batchIntegrate( self.batch_L[ :, t + 1 ] + betas[ :, t + 1 ], P_T )
+
+            # The last step of each sequence is the base case
+            betas[ :, t ] = np.where( self.batch_mask[ :, t + 1, None ], beta, 0.0 )
+
+        return betas
+
+    def unpackBatch( self, batch ):
+        # Split the padded array back up into one array per sequence
+        return tuple( [ b[ :T ] for b, T in zip( batch, self.lengths ) ] )
+
+    def filterBatch( self, ys, **kwargs ):
+        self.preprocessBatch( ys, **kwargs )
+        alphas = self.forwardFilterBatch()
+        betas = self.backwardFilterBatch()
+        return self.unpackBatch( alphas ), self.unpackBatch( betas )
+
+    ######################################################################
+    # Viterbi.  The forward filter with max instead of logsumexp, where each
+    # step keeps the best x_t-1 for every x_t as a back pointer.  Batched over
+    # sequences the same way as forwardFilterBatch
+
+    def viterbiDecode( self, batch_L, lengths ):
+        # batch_L is padded like in preprocessBatch.  Returns the most likely
+        # latent states of each sequence and log P( x*, y )
+        N, T_max, K = batch_L.shape
+        rows = np.arange( N )
+        mask = np.arange( T_max )[ None ] < lengths[ :, None ]
+
+        deltas = self.pi0 + batch_L[ :, 0 ]
+        pointers = np.zeros( ( N, T_max, K ), dtype=int )
+
+        for t in range( 1, T_max ):
+            # [ n, x_t-1, x_t ]
+            scores = deltas[ :, :, None ] + self.pi
+            pointers[ :, t ] = np.argmax( scores, axis=1 )
+
+            # Sequences that have already ended keep their last delta
+            deltas = np.where( mask[ :, t, None ], np.max( scores, axis=1 ) + batch_L[ :, t ], deltas )
+
+        last = lengths - 1
+        states = np.zeros( ( N, T_max ), dtype=int )
+        states[ rows, last ] = np.argmax( deltas, axis=1 )
+
+        for t in reversed( range( T_max - 1 ) ):
+            back = pointers[ rows, t + 1, states[ :, t + 1 ] ]
+            states[ :, t ] = np.where( t < last, back, states[ :, t ] )
+
+        return tuple( [ x[ :T ] for x, T in zip( states, lengths ) ] ), np.max( deltas, axis=1 )
+
+    def viterbiBatch( self, ys ):
+        self.preprocessBatch( ys )
+        return self.viterbiDecode( self.batch_L, self.lengths )
+
+    def viterbi( self, knownLatentStates=None ):
+        # The most likely latent states for the last preprocessed sequence.  Known
+        # latent states ( same format as forwardFilter ) are enforced by making
+        # every other state impossible at those time steps
+        L = self.emissionLogLikelihoods()
+        if( knownLatentStates is not None and knownLatentStates.size > 0 ):
+            knownLatentStates = knownLatentStates.astype( int )
+            L = np.array( L )
+            impossible = np.ones( ( knownLatentStates.shape[ 0 ], self.K ), dtype=bool )
+            impossible[ np.arange( knownLatentStates.shape[ 0 ] ), knownLatentStates[ :, 1 ] ] = False
+            L[ knownLatentStates[ :, 0 ] ] = np.where( impossible, np.NINF, L[ knownLatentStates[ :, 0 ] ] )
+
+        ( states, ), ( log_prob, ) = self.viterbiDecode( L[ None ], np.array( [ L.shape[ 0 ] ] ) )
+        return states, log_prob
+
     ######################################################################
 
     def filterAndGradient( self ):
@@ -346,6 +677,11 @@ class GaussianHMM( CategoricalHMM ):
 
     ######################################################################
 
+    def onlineEmission( self, y ):
+        return np.array( [ Normal.log_likelihood( y, nat_params=( n1, n2 ) ) for n1, n2 in zip( self.n1Emiss, self.n2Emiss ) ] )
+
+    ######################################################################
+
     def emissionProb( self, t, forward=False, ys=None ):
 
         if( ys is None ):
@@ -383,16 +719,7 @@ class SLDSHMM( CategoricalHMM ):
         # Compute P( x_t | x_t-1, z ) for all of the observations over each z
 
         self.L0 = Normal.log_likelihood( xs[ 0 ], nat_params=( self.n1_0, self.n2_0 ) )
-
-        self.L = np.empty( ( self.T - 1, self.K ) )
-
-        for i, ( n1, n2, n3 ) in enumerate( zip( self.n1Trans, self.n2Trans, self.n3Trans ) ):
-
-            def ll( _x ):
-                x, x1 = np.split( _x, 2 )
-                return Regression.log_likelihood( ( x, x1 ), nat_params=( n1, n2, n3 ) )
-
-            self.L[ :, i ] = np.apply_along_axis( ll, -1, np.hstack( ( xs[ :-1 ], xs[ 1: ] ) ) )
+        self.L = self.regimeLogLikelihoods( xs )
 
     def updateParams( self, initialDist, transDist, mu0, sigma0, u, As, sigmas, xs=None, computeMarginal=True ):
 
@@ -418,6 +745,7 @@ class SLDSHMM( CategoricalHMM ):
         self.n1Trans = nat1Trans
         self.n2Trans = nat2Trans
         self.n3Trans = nat3Trans
+        self.updateRegimes()
 
         if( xs is not None ):
             self.preprocessData( xs, u=u )
@@ -426,6 +754,26 @@ class SLDSHMM( CategoricalHMM ):
 
     ######################################################################
 
+    def updateRegimes( self ):
+        # Stack the standard parameters of every regime along with the inverse of
+        # the cholesky factor of each covariance so that the likelihoods of every
+        # regime can be computed at once
+        As, sigmas = zip( *[ Regression.natToStandard( n1, n2, n3 ) for n1, n2, n3 in zip( self.n1Trans, self.n2Trans, self.n3Trans ) ] )
+        chols = np.linalg.cholesky( np.array( sigmas ) )
+
+        self.regimeAs = np.array( As )
+        self.regimeCholInvs = np.linalg.inv( chols )
+        self.regimeLogNorms = np.log( np.diagonal( chols, axis1=1, axis2=2 ) ).sum( axis=1 ) + \
+                              self.regimeAs.shape[ 1 ] * 0.5 * np.log( 2 * np.pi )
+
+    def regimeLogLikelihoods( self, xs ):
+        # log P( x_t | x_t-1, z_t=k ) as a [ t, k ] array for t = 1 to T-1
+        residuals = xs[ None, 1: ] - np.einsum( 'kij,tj->kti', self.regimeAs, xs[ :-1 ] )
+        whitened = np.einsum( 'kij,ktj->kti', self.regimeCholInvs, residuals )
+        return ( -0.5 * np.sum( whitened**2, axis=-1 ) - self.regimeLogNorms[ :, None ] ).T
+
+    ######################################################################
+
     def childParentJoint( self, t, alphas, betas, xs=None ):
         alpha = np.broadcast_to( alphas[ t ], ( self.K, self.K ) ).T
         transition = self.transitionProb( t, t + 1, forward=False )
@@ -440,20 +788,24 @@ class SLDSHMM( CategoricalHMM ):
         if( xs is None ):
             emiss = self.L[ t - 1 ]
         else:
+            emiss = self.regimeLogLikelihoods( np.asarray( xs )[ t - 1:t + 1 ] )[ 0 ]
 
-            emiss = np.zeros( self.K )
-
-            for i, ( n1, n2, n3 ) in enumerate( zip( self.n1Trans, self.n2Trans, self.n3Trans ) ):
+        return emiss if forward == True else np.broadcast_to( emiss, ( self.K, self.K ) )
 
-                def ll( _x ):
-                    x, x1 = np.split( _x, 2 )
-                    return Regression.log_likelihood( ( x, x1 ), nat_params=( n1, n2, n3 ) )
+    ######################################################################
 
-                emiss[ i ] = np.apply_along_axis( ll, -1, np.hstack( ( xs[ :-1, t ], xs[ 1: , t ] ) ) )
+    def onlineEmission( self, y, last_y=None ):
+        # y is the same as xs[ t ].  The first observation doesn't depend on the latent state
+        if( last_y is None ):
+            return np.broadcast_to( Normal.log_likelihood( y, nat_params=( self.n1_0, self.n2_0 ) ), ( self.K, ) )
+        return self.regimeLogLikelihoods( np.vstack( ( last_y, y ) ) )[ 0 ]
 
-        return emiss if forward == True else np.broadcast_to( emiss, ( self.K, self.K ) )
+    def onlineElement( self, y, u=None, last_y=None ):
+        return self.pi + self.onlineEmission( y, last_y=last_y )[ None ]
 
-    ######################################################################
+    def emissionLogLikelihoods( self ):
+        # The first term doesn't depend on the latent state
+        return np.vstack( ( np.broadcast_to( self.L0, ( 1, self.K ) ), self.L ) )
 
     def forwardBaseCase( self ):
         return self.pi0 + self.L0
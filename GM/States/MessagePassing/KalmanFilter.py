@@ -149,6 +149,8 @@ class KalmanFilter( MessagePasser ):
     def updateNatParams( self, n1Trans, n2Trans, n3Trans, n1Emiss, n2Emiss, n3Emiss, n1Init, n2Init, u=None, ys=None, computeMarginal=True ):
         # This doesn't exactly use natural parameters, but uses J = -2 * n1 and h = n2
 
+        self.computeMarginal = computeMarginal
+        self.clearSteadyState()
         self._D_latent = n1Trans.shape[ 0 ]
         self._D_obs = n1Emiss.shape[ 0 ]
 
@@ -246,14 +248,64 @@ class KalmanFilter( MessagePasser ):
 
     ######################################################################
 
+    # For a time invariant model the information matrices of the filter messages
+    # converge to a fixed point ( the steady state Kalman gain ), so once the matrix
+    # being integrated stops changing we can reuse its factorization and only update
+    # the vectors.  The tolerance is relative to the largest entry.  Set this to None
+    # to refactor at every step.
+    steady_state_tol = 1e-10
+
+    def clearSteadyState( self ):
+        self._steady_state = {}
+
+    def steadyState( self, name, J, compute, exact=() ):
+        # Returns compute(), or the cached result if J is within the tolerance of the
+        # last J that was used for name and everything in exact is unchanged
+
+        if( not hasattr( self, '_steady_state' ) ):
+            self.clearSteadyState()
+
+        cached = self._steady_state.get( name )
+        if( self.steady_state_tol is not None and cached is not None ):
+            J_last, exact_last, vals = cached
+            if( np.abs( J - J_last ).max() <= self.steady_state_tol * np.abs( J_last ).max() and \
+                all( a is b or ( a == b ).all() for a, b in zip( exact, exact_last ) ) ):
+                return vals
+
+        vals = compute()
+        self._steady_state[ name ] = ( J, exact, vals )
+        return vals
+
+    ######################################################################
+
     def integrate( self, integrand, forward=True ):
 
         if( forward ):
-            # Integrate x_t-1
-            J, h, log_Z = Normal.marginalizeX2( *integrand, computeMarginal=self.computeMarginal )
+            # Integrate x_t-1.  Swap to the marginalizeX1 order
+            J11, J12, J22, h1, h2, log_Z = integrand
+            J11, J12, J22, h1, h2 = J22, J12.T, J11, h2, h1
         else:
             # Integrate x_t+1
-            J, h, log_Z = Normal.marginalizeX1( *integrand, computeMarginal=self.computeMarginal )
+            J11, J12, J22, h1, h2, log_Z = integrand
+
+        # Same as Normal.marginalizeX1, but only refactor J11 when it changes
+        def compute():
+            J11Chol = cho_factor( J11, lower=True )
+            G = cho_solve( J11Chol, J12 )
+            return J11Chol, G, J22 - J12.T @ G, np.log( np.diag( J11Chol[ 0 ] ) ).sum()
+
+        J11Chol, G, J, log_det = self.steadyState( forward, J11, compute, exact=( J12, J22 ) )
+
+        h = h2 - G.T.dot( h1 )
+
+        if( self.computeMarginal ):
+            K = h1.shape[ 0 ]
+            log_Z = log_Z - \
+                    0.5 * h1.dot( cho_solve( J11Chol, h1 ) ) + \
+                    log_det - \
+                    K * _HALF_LOG_2_PI
+        else:
+            log_Z = 0
 
         return J, h, log_Z
 
@@ -272,6 +324,51 @@ class KalmanFilter( MessagePasser ):
                  np.zeros( self.D_latent ), \
                  0. ]
 
+    ######################################################################
+    # Elements of the parallel scan are potentials over [ x_end, x_start ] in
+    # information form.  Combining two of them multiplies them and integrates
+    # out the shared middle variable.
+
+    def combineElements( self, a, b ):
+        aJ11, aJ12, aJ22, ah1, ah2, alog_Z = a
+        bJ11, bJ12, bJ22, bh1, bh2, blog_Z = b
+        D = self.D_latent
+
+        # Write the product as a function of [ x_mid, ( x_end, x_start ) ]
+        J11 = aJ11 + bJ22
+        J12 = np.hstack( ( bJ12.T, aJ12 ) )
+        J22 = np.zeros( ( 2 * D, 2 * D ) )
+        J22[ :D, :D ] = bJ11
+        J22[ D:, D: ] = aJ22
+        h1 = ah1 + bh2
+        h2 = np.hstack( ( bh1, ah2 ) )
+
+        J, h, log_Z = Normal.marginalizeX1( J11, J12, J22, h1, h2, alog_Z + blog_Z, computeMarginal=self.computeMarginal )
+        return J[ :D, :D ], J[ :D, D: ], J[ D:, D: ], h[ :D ], h[ D: ], log_Z
+
+    def applyForward( self, element, alpha ):
+        return self.integrate( self.multiplyTerms( ( element, self.alignOnLower( *alpha ) ) ), forward=True )
+
+    def applyBackward( self, element, beta ):
+        return self.integrate( self.multiplyTerms( ( element, self.alignOnUpper( *beta ) ) ), forward=False )
+
+    ######################################################################
+    # Single observations for OnlineFilter.  y has the shape ( measurements, D_obs )
+    # and u is the control input going into this time step
+
+    def onlineEmission( self, y ):
+        h = np.reshape( y, ( -1, self.D_obs ) ).dot( self._hy ).sum( axis=0 )
+        log_Z = Normal.log_partition( nat_params=( -0.5 * self.Jy, h ) ) if self.computeMarginal else 0
+        return self.Jy, h, log_Z
+
+    def onlineBaseCase( self, y ):
+        return self.multiplyTerms( ( ( self.J0, self.h0, self.log_Z0 ), self.onlineEmission( y ) ) )
+
+    def onlineElement( self, y, u=None, last_y=None ):
+        u = np.zeros( ( 1, self.D_latent ) ) if u is None else np.reshape( u, ( 1, self.D_latent ) )
+        transition = self.transitionProb( 0, 1, u=u )
+        return self.multiplyTerms( ( transition, self.alignOnUpper( *self.onlineEmission( y ) ) ) )
+
     ######################################################################
 
     def childParentJoint( self, t, alphas, betas, ys=None, u=None ):
@@ -293,6 +390,87 @@ class KalmanFilter( MessagePasser ):
         Jb, hb, log_Zb = beta
         return Normal.log_partition( nat_params=( -0.5*( Ja + Jb ), ( ha + hb ) ) ) - ( log_Za + log_Zb )
 
+    ######################################################################
+    # Smoother that writes P( x_0:T-1 | Y ) as one Gaussian whose precision is
+    # block tridiagonal and solves it with block forward elimination and back
+    # substitution.  The precision only depends on the parameters, so the block
+    # factorization is done once for every sequence of the same length and only
+    # the vectors are batched.  Needs time invariant parameters.
+
+    def smoothBatch( self, ys, u=None ):
+        # ys has the shape ( N, measurements, T, D_obs ) and u is ( N, T, D_latent ).
+        # Returns E[ x_t ] for each sequence, Cov[ x_t ] and Cov[ x_t+1, x_t ],
+        # which are the same for every sequence, and log P( Y ) for each sequence
+        ys = np.array( ys )
+        assert ys.ndim == 4
+        N, M, T, _ = ys.shape
+        D = self.D_latent
+
+        if( u is None ):
+            u = np.zeros( ( N, T, D ) )
+        else:
+            # Same as MaskedData, a time step with any nan has no control input
+            assert u.shape == ( N, T, D )
+            u = np.where( np.isnan( u ).any( axis=-1, keepdims=True ), 0.0, u )
+
+        # Diagonal blocks of the posterior precision.  The off diagonal block
+        # between x_t and x_t-1 is J12 for every t
+        diag = np.broadcast_to( self.Jy, ( T, D, D ) ).copy()
+        diag[ 0 ] += self.J0
+        diag[ 1: ] += self.J11
+        diag[ :-1 ] += self.J22
+
+        h = np.einsum( 'nmti,ij->ntj', ys, self._hy )
+        log_Z = np.full( N, self.log_Z0 )
+
+        if( self.computeMarginal ):
+            JyInv = np.linalg.inv( self.Jy )
+            log_Z += 0.5 * np.einsum( 'nti,ij,ntj->n', h, JyInv, h ) + \
+                     T * ( -0.5 * np.linalg.slogdet( self.Jy )[ 1 ] + D * _HALF_LOG_2_PI )
+            log_Z += 0.5 * np.einsum( 'nti,ij,ntj->n', u[ :, :-1 ], self.J11, u[ :, :-1 ] ) + ( T - 1 ) * self.log_Z
+
+        h[ :, 0 ] += self.h0
+        h[ :, 1: ] += u[ :, :-1 ] @ self.J11
+        h[ :, :-1 ] += u[ :, :-1 ] @ self.J12
+
+        # Forward elimination.  S_t is the Schur complement after eliminating x_0:t-1
+        S_inv = np.empty( ( T, D, D ) )
+        g = np.empty( ( N, T, D ) )
+        log_det = 0.0
+
+        S = diag[ 0 ]
+        g[ :, 0 ] = h[ :, 0 ]
+        for t in range( 1, T ):
+            S_inv[ t - 1 ] = np.linalg.inv( S )
+            log_det += np.linalg.slogdet( S )[ 1 ]
+            K = self.J12 @ S_inv[ t - 1 ]
+            S = diag[ t ] - K @ self.J12.T
+            g[ :, t ] = h[ :, t ] - g[ :, t - 1 ] @ K.T
+        S_inv[ T - 1 ] = np.linalg.inv( S )
+        log_det += np.linalg.slogdet( S )[ 1 ]
+
+        # Back substitution for the means and selected inversion for the covariances
+        mus = np.empty( ( N, T, D ) )
+        sigmas = np.empty( ( T, D, D ) )
+        cross = np.empty( ( max( T - 1, 0 ), D, D ) )
+
+        mus[ :, T - 1 ] = g[ :, T - 1 ] @ S_inv[ T - 1 ]
+        sigmas[ T - 1 ] = S_inv[ T - 1 ]
+        for t in reversed( range( T - 1 ) ):
+            mus[ :, t ] = ( g[ :, t ] - mus[ :, t + 1 ] @ self.J12 ) @ S_inv[ t ]
+            G = S_inv[ t ] @ self.J12.T
+            cross[ t ] = -sigmas[ t + 1 ] @ G.T
+            sigmas[ t ] = S_inv[ t ] + G @ sigmas[ t + 1 ] @ G.T
+
+        # log P( Y ) is the log partition of the posterior minus the normalizers
+        # of every potential.  h.T @ J^-1 @ h = sum_t g_t.T @ S_t^-1 @ g_t
+        log_marginal = 0.5 * np.einsum( 'nti,tij,ntj->n', g, S_inv, g ) - \
+                       0.5 * log_det + \
+                       T * D * _HALF_LOG_2_PI - \
+                       log_Z
+
+        return mus, sigmas, cross, log_marginal
+
 #########################################################################################
 
 class SwitchingKalmanFilter( KalmanFilter ):
@@ -347,15 +525,19 @@ class SwitchingKalmanFilter( KalmanFilter ):
 
     def updateNatParams( self, z, n1Trans, n2Trans, n3Trans, n1Emiss, n2Emiss, n3Emiss, n1Init, n2Init, u=None, ys=None, computeMarginal=True ):
 
+        self.computeMarginal = computeMarginal
+        self.clearSteadyState()
         self._D_latent = n2Init.shape[ 0 ]
         self._D_obs = n1Emiss.shape[ 0 ]
 
-        self.z = z
+        self.z = np.asarray( z )
 
-        self.J11s = [ -2 * n for n in n1Trans ]
-        self.J12s = [ -n.T for n in n3Trans ]
-        self.J22s = [ -2 * n for n in n2Trans ]
-        self.log_Zs = [ 0.5 * np.linalg.slogdet( np.linalg.inv( J11 ) )[ 1 ] for J11 in self.J11s ] if computeMarginal else [ 0 for _ in self.J11s ]
+        # The information blocks of every regime, stacked so that the regime
+        # sequence only has to index into them
+        self.J11s = -2 * np.array( n1Trans )
+        self.J12s = -np.swapaxes( np.array( n3Trans ), 1, 2 )
+        self.J22s = -2 * np.array( n2Trans )
+        self.log_Zs = -0.5 * np.linalg.slogdet( self.J11s )[ 1 ] if computeMarginal else np.zeros( self.J11s.shape[ 0 ] )
 
         self.J1Emiss = -2 * n1Emiss
         self.Jy = -2 * n2Emiss
@@ -378,23 +560,91 @@ class SwitchingKalmanFilter( KalmanFilter ):
             uMask = np.zeros( self.T, dtype=bool )
             self.u = ( None, uMask, self.D_latent )
 
+        self.transitionVectors = self.regimeVectors( self.u )
+
     ######################################################################
 
-    def transitionProb( self, t, t1, forward=False ):
-        u = self.u[ t ]
+    def regimeVectors( self, u ):
+        # h1, h2 and log_Z for every transition t -> t + 1, which uses the regime
+        # z[ t + 1 ] and the control input u[ t ].  Computed one regime at a time
+        T = self.z.shape[ 0 ]
+        D = self.D_latent
+
+        if( isinstance( u, MaskedData ) ):
+            # Same as MaskedData, a time step with any nan has no control input
+            us = np.zeros( ( T, D ) ) if u.data is None else np.where( u.mask.any( axis=-1, keepdims=True ), 0.0, u.data )
+        else:
+            us = np.asarray( u )
+
+        ks = self.z[ 1: ]
+        us = us[ :T - 1 ]
+        h1 = np.empty( ( T - 1, D ) )
+        h2 = np.empty( ( T - 1, D ) )
+        for k in np.unique( ks ):
+            which = ks == k
+            h1[ which ] = us[ which ] @ self.J11s[ k ].T
+            h2[ which ] = us[ which ] @ self.J12s[ k ]
+
+        if( self.computeMarginal ):
+            log_Z = 0.5 * np.einsum( 'ti,ti->t', us, h1 ) + self.log_Zs[ ks ]
+        else:
+            log_Z = np.zeros( T - 1 )
+
+        return h1, h2, log_Z
+
+    def regimeRuns( self ):
+        # ( k, start, end ) for every run of time steps start <= t < end whose
+        # transitions into t all use regime k
+        ks = self.z[ 1: ]
+        if( ks.shape[ 0 ] == 0 ):
+            return []
+        starts = np.flatnonzero( np.hstack( ( True, ks[ 1: ] != ks[ :-1 ] ) ) )
+        ends = np.hstack( ( starts[ 1: ], ks.shape[ 0 ] ) )
+        return [ ( ks[ start ], start + 1, end + 1 ) for start, end in zip( starts, ends ) ]
+
+    ######################################################################
+
+    def transitionProb( self, t, t1, forward=False, u=None ):
         k = self.z[ t1 ]
 
         J11 = self.J11s[ k ]
         J12 = self.J12s[ k ]
         J22 = self.J22s[ k ]
 
-        h1 = J11.dot( u )
-        h2 = J12.T.dot( u )
+        if( u is None ):
+            h1s, h2s, log_Zs = self.transitionVectors
+            return J11, J12, J22, h1s[ t ], h2s[ t ], log_Zs[ t ]
 
-        log_Z = 0.5 * u.dot( h1 ) + self.log_Zs[ k ] if self.computeMarginal else 0
+        _u = u[ t ]
+        h1 = J11.dot( _u )
+        h2 = J12.T.dot( _u )
+        log_Z = 0.5 * _u.dot( h1 ) + self.log_Zs[ k ] if self.computeMarginal else 0
 
         return J11, J12, J22, h1, h2, log_Z
 
+    ######################################################################
+
+    def forwardFilter( self ):
+        # Same as the regular filter, but the regime blocks are looked up once for
+        # every run of the same regime so that the steady state factorization
+        # in integrate can be reused within the run
+
+        if( self.n_blocks > 1 ):
+            return self.forwardFilterScan()
+
+        alphas = self.genFilterProbs()
+        alphas[ 0 ] = self.forwardBaseCase()
+
+        h1s, h2s, log_Zs = self.transitionVectors
+        for k, start, end in self.regimeRuns():
+            J11, J12, J22 = self.J11s[ k ], self.J12s[ k ], self.J22s[ k ]
+            for t in range( start, end ):
+                transition = ( J11, J12, J22, h1s[ t - 1 ], h2s[ t - 1 ], log_Zs[ t - 1 ] )
+                out = self.integrate( self.multiplyTerms( ( transition, self.alignOnLower( *alphas[ t - 1 ] ) ) ), forward=True )
+                alphas[ t ] = self.multiplyTerms( ( self.emissionProb( t, forward=True ), out ) )
+
+        return alphas
+
 #########################################################################################
 
 class StableKalmanFilter( KalmanFilter ):
@@ -421,31 +671,37 @@ class StableKalmanFilter( KalmanFilter ):
         J, h, logZ = alpha
         u = self.u[ t - 1 ]
 
-        M = self.AInv.T @ J @ self.AInv
-        # H = np.linalg.solve( M.T + self.J11.T, M.T ).T
-        H = rightSolve( M + self.J11, M )
-        L = -H
-        L[ np.diag_indices( L.shape[ 0 ] ) ] += 1
+        # Everything that only depends on J.  This is reused once the filter
+        # reaches its steady state
+        def compute():
+            M = self.AInv.T @ J @ self.AInv
+            # H = np.linalg.solve( M.T + self.J11.T, M.T ).T
+            H = rightSolve( M + self.J11, M )
+            L = -H
+            L[ np.diag_indices( L.shape[ 0 ] ) ] += 1
+
+            _J = L @ M @ L.T
+            _J += H @ self.J11 @ H.T
+            _J += self.Jy
+
+            JChol = cho_factor( J + self.J22, lower=True )
+            return _J, L @ self.AInv.T, J @ self.AInv, JChol, np.log( np.diag( JChol[ 0 ] ) ).sum()
 
-        _J = L @ M @ L.T
-        _J += H @ self.J11 @ H.T
-        _J += self.Jy
+        _J, LAInvT, JAInv, JChol, log_det = self.steadyState( 'stable_forward', J, compute )
 
-        _h = h + J @ self.AInv.dot( u )
-        _h = L @ self.AInv.T @ _h
+        _h = h + JAInv.dot( u )
+        _h = LAInvT @ _h
         _h += self.hy[ t ]
 
         # Transition and last
         _logZ = 0.5 * u.dot( self.J11.dot( u ) ) + self.log_Z + logZ
 
-        JInt = J + self.J22
         hInt = self.J12.T.dot( u ) + h
-        JChol = cho_factor( JInt, lower=True )
         JInvh = cho_solve( JChol, hInt )
 
         # Marginalization
         _logZ += -0.5 * hInt.dot( JInvh ) + \
-                 np.log( np.diag( JChol[ 0 ] ) ).sum() - \
+                 log_det - \
                  self.D_latent * _HALF_LOG_2_PI
 
         # Emission
@@ -460,33 +716,42 @@ class StableKalmanFilter( KalmanFilter ):
         J, h, logZ = beta
         u = self.u[ t ]
 
-        J = J + self.Jy
-        h = h + self.hy[ t + 1 ]
+        def compute():
+            _J = J + self.Jy
+
+            # H = np.linalg.solve( J.T + self.J11.T, J.T ).T
+            H = rightSolve( _J + self.J11, _J )
+            L = -H
+            L[ np.diag_indices( L.shape[ 0 ] ) ] += 1
 
-        # H = np.linalg.solve( J.T + self.J11.T, J.T ).T
-        H = rightSolve( J + self.J11, J )
-        L = -H
-        L[ np.diag_indices( L.shape[ 0 ] ) ] += 1
+            JNext = L @ _J @ L.T
+            JNext += H @ self.J11 @ H.T
+            JNext = self.A.T @ JNext @ self.A
 
-        _J = L @ J @ L.T
-        _J += H @ self.J11 @ H.T
-        _J = self.A.T @ _J @ self.A
+            if( self.computeMarginal ):
+                JChol = cho_factor( _J + self.J11, lower=True )
+                log_det = np.log( np.diag( JChol[ 0 ] ) ).sum()
+            else:
+                JChol, log_det = None, 0
+            return JNext, self.A.T @ L, _J, JChol, log_det
+
+        _J, ATL, J, JChol, log_det = self.steadyState( 'stable_backward', J, compute )
+
+        h = h + self.hy[ t + 1 ]
 
         _h = h - J @ u
-        _h = self.A.T @ L @ _h
+        _h = ATL @ _h
 
         if( self.computeMarginal ):
             # Transition, emission and last
             _logZ = 0.5 * u.dot( self.J11.dot( u ) ) + self.log_Z + self.log_Zy[ t + 1 ] + logZ
 
-            JInt = J + self.J11
             hInt = self.J11.dot( u ) + h
-            JChol = cho_factor( JInt, lower=True )
             JInvh = cho_solve( JChol, hInt )
 
             # Marginalization
             _logZ += -0.5 * hInt.dot( JInvh ) + \
-                     np.log( np.diag( JChol[ 0 ] ) ).sum() - \
+                     log_det - \
                      self.D_latent * _HALF_LOG_2_PI
         else:
             _logZ = 0
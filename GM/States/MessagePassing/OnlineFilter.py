@@ -0,0 +1,74 @@
+import autograd.numpy as np
+from collections import deque
+
+__all__ = [ 'OnlineFilter' ]
+
+#########################################################################################
+
+class OnlineFilter():
+    # Runs the forward filter of a chain message passer ( CategoricalHMM, GaussianHMM,
+    # SLDSHMM or KalmanFilter ) one observation at a time.  Only the last alpha is kept, along
+    # with the scan elements of the last lag time steps for fixed lag smoothing, so
+    # memory doesn't grow with the number of observations.
+
+    def __init__( self, msg, lag=0 ):
+        assert lag >= 0
+        self.msg = msg
+        self.lag = lag
+        self.reset()
+
+    def reset( self ):
+        self.t = -1
+        self.alpha = None
+        self.last_y = None
+
+        # ( t, alpha, element ) for the last lag + 1 time steps
+        self.window = deque( maxlen=self.lag + 1 )
+
+    ######################################################################
+
+    def update( self, y, u=None ):
+        # y is the observation at this time step ( the same as ys[ :, t ] ) and
+        # u is the control input going into this time step ( u[ t - 1 ] )
+        self.t += 1
+
+        if( self.alpha is None ):
+            element = None
+            self.alpha = self.msg.onlineBaseCase( y )
+        else:
+            element = self.msg.onlineElement( y, u=u, last_y=self.last_y )
+            self.alpha = self.msg.applyForward( element, self.alpha )
+        self.last_y = y
+
+        self.window.append( ( self.t, self.alpha, element ) )
+        return self.alpha
+
+    def extend( self, ys, us=None ):
+        # Update with a batch of observations.  ys is indexed by time first
+        us = [ None ] * len( ys ) if us is None else us
+        assert len( us ) == len( ys )
+        for y, u in zip( ys, us ):
+            self.update( y, u=u )
+        return self.alpha
+
+    ######################################################################
+
+    @property
+    def log_marginal( self ):
+        # log P( y_1:t )
+        assert self.alpha is not None
+        return self.msg.log_marginalFromAlphaBeta( self.alpha, self.msg.backwardBaseCase() )
+
+    def smooth( self ):
+        # P( x_s, y_1:t ) for every s in the window.  The first one is the
+        # fixed lag smoothed estimate of x_t-lag
+        assert self.alpha is not None
+
+        beta = self.msg.backwardBaseCase()
+        ans = []
+        for t, alpha, element in reversed( self.window ):
+            ans.append( ( t, self.msg.multiplyTerms( ( alpha, beta ) ) ) )
+            if( element is not None ):
+                beta = self.msg.applyBackward( element, beta )
+
+        return ans[ ::-1 ]
@@ -1,3 +1,4 @@
 from GenModels.GM.States.MessagePassing.FilterBase import MessagePasser
 from GenModels.GM.States.MessagePassing.HMM import CategoricalHMM, GaussianHMM, SLDSHMM
-from GenModels.GM.States.MessagePassing.KalmanFilter import KalmanFilter, SwitchingKalmanFilter, StableKalmanFilter
\ No newline at end of file
+from GenModels.GM.States.MessagePassing.KalmanFilter import KalmanFilter, SwitchingKalmanFilter, StableKalmanFilter
+from GenModels.GM.States.MessagePassing.OnlineFilter import OnlineFilter
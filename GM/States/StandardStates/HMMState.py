@@ -279,6 +279,48 @@ class HMMState( CategoricalHMM, StateBase ):
 
     ######################################################################
 
+    def EStepChunk( self, ys, preprocessKwargs={}, filterKwargs={} ):
+
+        # The batched filter can't cut the chain at known states
+        if( filterKwargs.get( 'knownLatentStates' ) is not None ):
+            return super( HMMState, self ).EStepChunk( ys, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
+
+        return list( zip( *self.filterBatch( ys, **preprocessKwargs ) ) )
+
+    ######################################################################
+
+    def expectedJointSum( self, ys, alphas, betas, marginal ):
+        # log sum_{ t=1:T-1 }P( x_t, x_t+1 | Y ) for a single sequence.  This is
+        # childParentJoint for every t at once as a [ t, x_t, x_t+1 ] array
+        T = alphas.shape[ 0 ]
+        if( T == 1 ):
+            return np.full( ( self.D_latent, self.D_latent ), np.NINF )
+
+        if( self.chainCuts is not None ):
+            transitions = np.array( [ self.transitionProb( t, t + 1 ) for t in range( T - 1 ) ] )
+        else:
+            transitions = self.pi[ None ]
+
+        emissions = self._L.T[ ys[ :, 1: ] ].sum( axis=0 )
+        joint = alphas[ :-1, :, None ] + transitions + ( betas[ 1: ] + emissions )[ :, None, : ] - marginal
+        return np.logaddexp.reduce( joint, axis=0 )
+
+    def expectedEmissionSum( self, ys, smoothed ):
+        # log sum_{ m, t where y_mt = j }P( x_t = i | Y ) as a [ i, j ] array for a
+        # single sequence.  Each latent state is shifted by its max so that the sums
+        # can be a single scatter add in probability space
+        shift = np.max( smoothed, axis=0 )
+        shift = np.where( np.isfinite( shift ), shift, 0.0 )
+        probs = np.exp( smoothed - shift )
+
+        # Flat index of [ y_mt, x_t ] for every measurement, time and latent state
+        index = ys[ :, :, None ] * self.D_latent + np.arange( self.D_latent )
+        weights = np.broadcast_to( probs, index.shape )
+        sums = np.bincount( index.ravel(), weights=weights.ravel(), minlength=self.D_obs * self.D_latent )
+
+        with np.errstate( divide='ignore' ):
+            return np.log( sums.reshape( ( self.D_obs, self.D_latent ) ).T ) + shift[ :, None ]
+
     def conditionedExpectedSufficientStats( self, ys, alphas, betas, forMStep=False ):
 
         totalMarginal = 0
@@ -315,17 +357,10 @@ class HMMState( CategoricalHMM, StateBase ):
             smoothSum = np.logaddexp( smoothSum, np.logaddexp.reduce( smoothed, axis=0 ) )
 
             # sum_{ t=1:T-1 }E[ P( x_t, x_t+1 | Y ) ]
-            T = smoothed.shape[ 0 ]
-            joint = np.logaddexp.reduce( [ self.childParentJoint( t, _alphas, _betas, ys=_ys ) - marginal for t in range( T - 1 ) ] )
-            jointSum = np.logaddexp( jointSum, joint )
+            jointSum = np.logaddexp( jointSum, self.expectedJointSum( _ys, _alphas, _betas, marginal ) )
 
             # sum_{ t=1:T }E[ P( x_t, y_t | Y ) ]
-            for _ys_ in _ys:
-                for i in range( self.D_latent ):
-                    for j in range( self.D_obs ):
-                        relevantVals = smoothed[ :, i ][ _ys_ == j ]
-                        if( relevantVals.size > 0 ):
-                            smoothedSumsForY[ i, j ] = np.logaddexp( smoothedSumsForY[ i, j ], np.logaddexp.reduce( relevantVals, axis=0 ) )
+            smoothedSumsForY = np.logaddexp( smoothedSumsForY, self.expectedEmissionSum( _ys, smoothed ) )
 
             totalObs += len( _ys )
 
@@ -347,14 +382,23 @@ class HMMState( CategoricalHMM, StateBase ):
 
     ######################################################################
 
+    def combineStats( self, a, b ):
+        # The expectations are in log space and the last 2 are counts
+        return tuple( [ np.logaddexp( _a, _b ) for _a, _b in zip( a[ :5 ], b[ :5 ] ) ] ) + ( a[ 5 ] + b[ 5 ], a[ 6 ] + b[ 6 ] )
+
     def MStep( self, ys, alphas, betas ):
 
         N = self.dataN( ys, conditionOnY=True, checkY=True )
 
-        smoothSum0, jointSum, smoothSumNotLast, smoothedSumsForY, smoothSum, totalObs = self.conditionedExpectedSufficientStats( ys, alphas, betas, forMStep=True )
+        stats = self.conditionedExpectedSufficientStats( ys, alphas, betas, forMStep=True )
+        return self.MStepFromStats( stats + ( N, ) )
+
+    def MStepFromStats( self, stats ):
+
+        smoothSum0, jointSum, smoothSumNotLast, smoothedSumsForY, smoothSum, totalObs, N = stats
 
         pi0 = smoothSum0 - np.log( N )
         pi = jointSum - smoothSumNotLast[ :, None ]
-        L =  smoothedSumsForY - smoothSum[ :, None ] - np.log( totalObs ) + np.log( len( ys ) )
+        L =  smoothedSumsForY - smoothSum[ :, None ] - np.log( totalObs ) + np.log( N )
 
         return pi0, pi, L
@@ -16,6 +16,11 @@ class LDSState( StableKalmanFilter, StateBase ):
 
     priorClass = None
 
+    # 'block' computes the expected sufficient statistics in EStepStats with the
+    # block tridiagonal smoother ( smoothBatch ).  'filter' uses the forward and
+    # backward filters.  EStep always returns the filter messages
+    smoother = 'block'
+
     def __init__( self, A=None, sigma=None, C=None, R=None, mu0=None, sigma0=None, prior=None, hypers=None ):
         definePrior()
         super( LDSState, self ).__init__( A, sigma, C, R, mu0, sigma0, prior=prior, hypers=hypers )
@@ -605,6 +610,98 @@ class LDSState( StableKalmanFilter, StateBase ):
         J, h, _ = np.add( alphas[ 0 ], betas[ 0 ] )
         return Normal.expectedSufficientStats( nat_params=( -0.5 * J, h ) )
 
+    def blockSmoother( self, ys, u=None ):
+        # Run smoothBatch on every group of sequences with the same shape.  Returns
+        # ( indices, u, E[ x_t ], Cov[ x_t ], Cov[ x_t+1, x_t ] ) for each group
+        # and the total log marginal
+
+        if( u is not None and u.ndim == 3 ):
+            # Multiple u's
+            assert len( ys ) == len( u )
+        else:
+            assert u is None or u.ndim == 2
+
+        groups = {}
+        for i, _ys in enumerate( ys ):
+            groups.setdefault( np.shape( _ys ), [] ).append( i )
+
+        moments = []
+        log_marginal = 0.0
+        for shape, indices in groups.items():
+            _ys = np.array( [ ys[ i ] for i in indices ] )
+            N, M, T, _ = _ys.shape
+
+            if( u is None ):
+                _u = np.zeros( ( N, T, self.D_latent ) )
+            else:
+                _u = np.array( [ u[ i ] for i in indices ] ) if u.ndim == 3 else np.broadcast_to( u, ( N, ) + u.shape )
+                _u = np.where( np.isnan( _u ).any( axis=-1, keepdims=True ), 0.0, _u )
+
+            mus, sigmas, cross, marginals = self.smoothBatch( _ys, _u )
+            moments.append( ( indices, _u, mus, sigmas, cross ) )
+            log_marginal += marginals.sum()
+
+        return moments, log_marginal
+
+    def blockExpectedSufficientStats( self, ys, moments, forMStep=False ):
+        # Same as conditionedExpectedSufficientStats, but using the moments from blockSmoother.
+        # E[ x_t * x_s^T ] = Cov[ x_t, x_s ] + E[ x_t ] * E[ x_s ]^T summed over every sequence
+
+        Ext1_xt1 = np.zeros( ( self.D_latent, self.D_latent ) )
+        Ext1_xt = np.zeros( ( self.D_latent, self.D_latent ) )
+        Ext_xt = np.zeros( ( self.D_latent, self.D_latent ) )
+        Eut_ut = np.zeros( ( self.D_latent, self.D_latent ) )
+        Ext_ut = np.zeros( ( self.D_latent, self.D_latent ) )
+        Ext1_ut = np.zeros( ( self.D_latent, self.D_latent ) )
+        allT = 0
+        allM = 0
+
+        Eyt_yt = np.zeros( ( self.D_obs, self.D_obs ) )
+        Eyt_xt = np.zeros( ( self.D_obs, self.D_latent ) )
+        Ext_xt_y = np.zeros( ( self.D_latent, self.D_latent ) )
+
+        Ex0_x0 = np.zeros( ( self.D_latent, self.D_latent ) )
+        Ex0 = np.zeros( self.D_latent )
+
+        for indices, u, mus, sigmas, cross in moments:
+            _ys = np.array( [ ys[ i ] for i in indices ] )
+            N, M, T, _ = _ys.shape
+
+            allT += N * ( T - 1 )
+            allM += N * T * M
+
+            Ext1_xt1 += N * sigmas[ 1: ].sum( axis=0 ) + np.einsum( 'nti,ntj->ij', mus[ :, 1: ], mus[ :, 1: ] )
+            Ext1_xt += N * cross.sum( axis=0 ) + np.einsum( 'nti,ntj->ij', mus[ :, 1: ], mus[ :, :-1 ] )
+            Ext_xt += N * sigmas[ :-1 ].sum( axis=0 ) + np.einsum( 'nti,ntj->ij', mus[ :, :-1 ], mus[ :, :-1 ] )
+
+            Eut_ut += np.einsum( 'nti,ntj->ij', u[ :, :-1 ], u[ :, :-1 ] )
+            Ext_ut += np.einsum( 'nti,ntj->ij', mus[ :, :-1 ], u[ :, :-1 ] )
+            Ext1_ut += np.einsum( 'nti,ntj->ij', mus[ :, 1: ], u[ :, :-1 ] )
+
+            Eyt_yt += np.einsum( 'nmti,nmtj->ij', _ys, _ys )
+            Eyt_xt += np.einsum( 'nmti,ntj->ij', _ys, mus )
+            Ext_xt_y += N * sigmas.sum( axis=0 ) + np.einsum( 'nti,ntj->ij', mus, mus )
+
+            Ex0_x0 += N * sigmas[ 0 ] + mus[ :, 0 ].T @ mus[ :, 0 ]
+            Ex0 += mus[ :, 0 ].sum( axis=0 )
+
+        if( forMStep ):
+            return Ext1_xt1, Ext1_xt, Ext_xt, Eyt_yt, Eyt_xt, Ext_xt_y, Ex0_x0, Ex0, Eut_ut, Ext_ut, Ext1_ut, allT, allM
+
+        return Ext1_xt1, Ext1_xt, Ext_xt, Eyt_yt, Eyt_xt, Ext_xt_y, Ex0_x0, Ex0
+
+    def useBlockSmoother( self, preprocessKwargs, filterKwargs ):
+        # The block smoother only understands computeMarginal, so anything
+        # else goes through the filters
+        return self.smoother == 'block' and len( filterKwargs ) == 0 and set( preprocessKwargs.keys() ) <= set( [ 'computeMarginal' ] )
+
+    def blockEStepStats( self, ys, u=None, computeMarginal=True ):
+        # The expected sufficient statistics for the M-step and log P( Y ) using
+        # the block smoother
+        self.computeMarginal = computeMarginal
+        moments, log_marginal = self.blockSmoother( ys, u )
+        return self.blockExpectedSufficientStats( ys, moments, forMStep=True ), log_marginal
+
     def conditionedExpectedSufficientStats( self, ys, u, alphas, betas, forMStep=False ):
 
         Ext1_xt1 = np.zeros( ( self.D_latent, self.D_latent ) )
@@ -631,9 +728,11 @@ class LDSState( StableKalmanFilter, StateBase ):
         else:
             assert u is None or u.ndim == 2
             if( u is None ):
-                J, _, _ = alphas[ 0 ][ 0 ]
-                u = np.zeros( ( len( alphas[ 0 ] ), J.shape[ 0 ] ) )
-            it = zip( ys, alphas, betas, itertools.repeat( u, len( ys ) ) )
+                # The sequences can have different lengths
+                us = [ np.zeros( ( len( _alphas ), self.D_latent ) ) for _alphas in alphas ]
+            else:
+                us = itertools.repeat( u, len( ys ) )
+            it = zip( ys, alphas, betas, us )
 
         for i, ( _ys, _alphas, _betas, _u ) in enumerate( it ):
 
@@ -696,6 +795,7 @@ class LDSState( StableKalmanFilter, StateBase ):
             self.J12 = -n3.T
             self.J22 = -2 * n2
             self.log_Z = 0.5 * np.linalg.slogdet( np.linalg.inv( self.J11 ) )[ 1 ]
+            self.clearSteadyState()
 
         ans = super( LDSState, self ).fullSample( **kwargs )
 
@@ -705,6 +805,7 @@ class LDSState( StableKalmanFilter, StateBase ):
             self.J12 = J12
             self.J22 = J22
             self.log_Z = 0.5 * np.linalg.slogdet( np.linalg.inv( self.J11 ) )[ 1 ]
+            self.clearSteadyState()
 
         return ans
 
@@ -746,11 +847,44 @@ class LDSState( StableKalmanFilter, StateBase ):
 
     ######################################################################
 
+    def EStepStatsChunk( self, ys, u=None, pairedU=False, preprocessKwargs={}, filterKwargs={} ):
+        # With pairedU, ys is a list of ( ys, u ) for each sequence
+        if( pairedU ):
+            ys, u = zip( *ys )
+            u = np.array( u )
+        ys = tuple( ys )
+
+        if( self.useBlockSmoother( preprocessKwargs, filterKwargs ) ):
+            stats, self.last_normalizer = self.blockEStepStats( ys, u, **preprocessKwargs )
+            return stats + ( len( ys ), ), self.last_normalizer
+
+        alphas, betas = self.EStep( ys=ys, u=u, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
+        stats = self.conditionedExpectedSufficientStats( ys, u, alphas, betas, forMStep=True ) + ( len( ys ), )
+        return stats, self.last_normalizer
+
+    def EStepStats( self, ys=None, u=None, preprocessKwargs={}, filterKwargs={} ):
+
+        if( u is not None and u.ndim == 3 ):
+            # Multiple u's
+            assert len( ys ) == len( u )
+            data, u, pairedU = list( zip( ys, u ) ), None, True
+        else:
+            assert u is None or u.ndim == 2
+            data, pairedU = ys, False
+
+        stats, self.last_normalizer = self.sequenceReduce( 'EStepStatsChunk', data, self.combineEStepStats, u=u, pairedU=pairedU, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
+        return stats
+
+    def combineStats( self, a, b ):
+        return tuple( [ _a + _b for _a, _b in zip( a, b ) ] )
+
     def MStep( self, ys, u, alphas, betas ):
+        stats = self.conditionedExpectedSufficientStats( ys, u, alphas, betas, forMStep=True )
+        return self.MStepFromStats( stats + ( len( ys ), ) )
 
-        Ext1_xt1, Ext1_xt, Ext_xt, Eyt_yt, Eyt_xt, Ext_xt_y, Ex0_x0, Ex0, Eut_ut, Ext_ut, Ext1_ut, allT, allM = self.conditionedExpectedSufficientStats( ys, u, alphas, betas, forMStep=True )
+    def MStepFromStats( self, stats ):
 
-        D = len( ys )
+        Ext1_xt1, Ext1_xt, Ext_xt, Eyt_yt, Eyt_xt, Ext_xt_y, Ex0_x0, Ex0, Eut_ut, Ext_ut, Ext1_ut, allT, allM, D = stats
 
         mu0 = Ex0 / D
         sigma0 = np.outer( mu0, mu0 ) + ( Ex0_x0 - 2 * np.outer( Ex0, mu0 ) ) / D
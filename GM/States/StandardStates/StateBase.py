@@ -2,6 +2,21 @@ import autograd.numpy as np
 from GenModels.GM.Distributions import ExponentialFam
 from abc import ABC, abstractmethod
 import itertools
+from functools import reduce
+import multiprocessing.pool
+from multiprocessing import Pool
+
+######################################################################
+
+# Each task comes with its own copy of the state, so preprocessData can change
+# it without touching the one in the main process.  Every chunk is sampled with
+# its own seed, otherwise each worker would start from the same random state
+def _sequenceWork( data ):
+    state, name, chunk, kwargs, seed = data
+    np.random.seed( seed.generate_state( 1 )[ 0 ] )
+    return getattr( state, name )( chunk, **kwargs )
+
+######################################################################
 
 class StateBase( ExponentialFam ):
 
@@ -88,6 +103,104 @@ class StateBase( ExponentialFam ):
 
     ######################################################################
 
+    @property
+    def n_sequence_workers( self ):
+        # Number of processes to run the sequences on.  With 1 worker
+        # everything runs in this process
+        if( hasattr( self, '_n_sequence_workers' ) == False ):
+            self._n_sequence_workers = 1
+        return self._n_sequence_workers
+
+    @n_sequence_workers.setter
+    def n_sequence_workers( self, val ):
+        if( hasattr( self, '_sequence_pool' ) ):
+            self._sequence_pool.close()
+            delattr( self, '_sequence_pool' )
+        self._n_sequence_workers = val
+
+    @property
+    def sequence_pool( self ):
+        if( hasattr( self, '_sequence_pool' ) == False ):
+            self._sequence_pool = Pool( self.n_sequence_workers )
+        return self._sequence_pool
+
+    def cleanup( self ):
+        if( hasattr( self, '_sequence_pool' ) ):
+            self._sequence_pool.close()
+            self._sequence_pool.join()
+            delattr( self, '_sequence_pool' )
+
+        # Let the other bases close their pools too
+        if( hasattr( super( StateBase, self ), 'cleanup' ) ):
+            super( StateBase, self ).cleanup()
+
+    def __del__( self ):
+        self.cleanup()
+
+    def __getstate__( self ):
+        # Process pools stay in the process that made them
+        return { key: val for key, val in self.__dict__.items() if not isinstance( val, multiprocessing.pool.Pool ) }
+
+    @property
+    def sequence_chunksize( self ):
+        # Number of sequences sent to a worker at once.  None splits the
+        # sequences into 4 chunks per worker
+        if( hasattr( self, '_sequence_chunksize' ) == False ):
+            self._sequence_chunksize = None
+        return self._sequence_chunksize
+
+    @sequence_chunksize.setter
+    def sequence_chunksize( self, val ):
+        self._sequence_chunksize = val
+
+    def sequenceChunks( self, data, maxChunksize=None ):
+        chunksize = self.sequence_chunksize
+        if( chunksize is None ):
+            # Only split the data up for the worker processes
+            nChunks = 1 if self.n_sequence_workers == 1 else 4 * self.n_sequence_workers
+            chunksize = max( 1, -( -len( data ) // nChunks ) )
+            if( maxChunksize is not None ):
+                chunksize = min( chunksize, maxChunksize )
+        return [ data[ i:i + chunksize ] for i in range( 0, len( data ), chunksize ) ]
+
+    def sequenceTasks( self, name, chunks, kwargs ):
+        # The pool tasks for chunks and how many to send to a worker at once.  Sending
+        # one batch per worker means that the state is only pickled once per worker.
+        # The seeds come from the global random state, so seeding numpy in this
+        # process makes the results reproducible
+        seeds = np.random.SeedSequence( np.random.randint( 2**31 ) ).spawn( len( chunks ) )
+        tasks = [ ( self, name, chunk, kwargs, seed ) for chunk, seed in zip( chunks, seeds ) ]
+        return tasks, max( 1, -( -len( tasks ) // self.n_sequence_workers ) )
+
+    def sequenceMap( self, name, data, **kwargs ):
+        # Call the chunk worker self.name( chunk, **kwargs ) over data and concatenate
+        # the results.  Chunk workers return a list with 1 result per sequence
+        data = list( data )
+
+        if( self.n_sequence_workers == 1 or len( data ) <= 1 ):
+            return getattr( self, name )( data, **kwargs )
+
+        tasks, chunksize = self.sequenceTasks( name, self.sequenceChunks( data ), kwargs )
+        results = self.sequence_pool.map( _sequenceWork, tasks, chunksize=chunksize )
+
+        return list( itertools.chain( *results ) )
+
+    def sequenceReduce( self, name, data, combine, **kwargs ):
+        # Call the chunk worker self.name( chunk, **kwargs ) over data and fold the results
+        # together with combine as they come in.  Here the chunk workers return 1 result
+        # for the whole chunk, so only a chunk's worth of per-sequence results ( 128 sequences
+        # unless sequence_chunksize is set ) is ever in memory at once
+        data = list( data )
+        chunks = self.sequenceChunks( data, maxChunksize=128 )
+
+        if( self.n_sequence_workers == 1 ):
+            return reduce( combine, ( getattr( self, name )( chunk, **kwargs ) for chunk in chunks ) )
+
+        tasks, chunksize = self.sequenceTasks( name, chunks, kwargs )
+        return reduce( combine, self.sequence_pool.imap( _sequenceWork, tasks, chunksize=chunksize ) )
+
+    ######################################################################
+
     @property
     @abstractmethod
     def T( self ):
@@ -272,19 +385,11 @@ class StateBase( ExponentialFam ):
             accumulated[ 1 ][ 3 ] += T * M
         return accumulated
 
-    def conditionedSample( self, ys=None, forwardFilter=True, preprocessKwargs={}, filterKwargs={}, returnStats=False ):
-        # Sample x given y
+    def conditionedSampleChunk( self, ys, forwardFilter=True, preprocessKwargs={}, filterKwargs={}, returnStats=False ):
+        # Sample x given y for every sequence in ys.  Returns ( x, y ) or ( stats, M, T ) for each
 
-        size = self.dataN( ys, conditionOnY=True, checkY=True )
-
-        if( size > 1 ):
-            it = iter( ys )
-        else:
-            it = iter( ys )
-            # it = iter( [ ys ] )
-
-        ans = [] if returnStats == False else [ [], [] ]
-        for y in it:
+        ans = []
+        for y in ys:
 
             self.preprocessData( ys=y, computeMarginal=False, **preprocessKwargs )
 
@@ -325,14 +430,28 @@ class StateBase( ExponentialFam ):
             if( returnStats == False ):
                 ans.append( ( x, y ) )
             else:
-                # Accumulate the statistics
                 M, T = y.shape[ 0:2 ]
+                ans.append( ( x, M, T ) )
+
+        return ans
+
+    def conditionedSample( self, ys=None, forwardFilter=True, preprocessKwargs={}, filterKwargs={}, returnStats=False ):
+        # Sample x given y
+
+        size = self.dataN( ys, conditionOnY=True, checkY=True )
+
+        samples = self.sequenceMap( 'conditionedSampleChunk', ys, forwardFilter=forwardFilter, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs, returnStats=returnStats )
+
+        if( returnStats == True ):
+            # Accumulate the statistics
+            ans = [ [], [] ]
+            for x, M, T in samples:
                 ans = self.accumulateStats( ans, x, M, T )
+            return ans
 
         # Make sure that the sampled states are in the expected form
-        if( returnStats == False ):
-            ans = tuple( list( zip( *ans ) ) )
-            self.checkShape( ans )
+        ans = tuple( list( zip( *samples ) ) )
+        self.checkShape( ans )
 
         return ans
 
@@ -419,25 +538,12 @@ class StateBase( ExponentialFam ):
         dummy = cls( *params )
         return dummy.ilog_likelihood( x, forwardFilter=forwardFilter, conditionOnY=conditionOnY, seperateLikelihoods=seperateLikelihoods, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
 
-    def ilog_likelihood( self, x, forwardFilter=True, conditionOnY=False, expFam=False, preprocessKwargs={}, filterKwargs={}, seperateLikelihoods=False ):
-
-        if( expFam ):
-            return self.log_likelihoodExpFam( x, constParams=self.constParams, nat_params=self.nat_params )
-
-        size = self.dataN( x )
-
-        x, ys = x
-
-        if( size > 1 ):
-            it = zip( x, ys )
-        else:
-            # Need to add for case where size is 1 and unpacked vs size is 1 and packed
-            it = zip( x, ys )
-            # it = iter( [ [ x, ys ] ] )
+    def logLikelihoodChunk( self, data, forwardFilter=True, conditionOnY=False, preprocessKwargs={}, filterKwargs={} ):
+        # log P( x, y | ϴ ) or log P( x | y, ϴ ) for every ( x, y ) in data
 
-        ans = np.zeros( size )
+        ans = np.zeros( len( data ) )
 
-        for i, ( x, ys ) in enumerate( it ):
+        for i, ( x, ys ) in enumerate( data ):
 
             self.preprocessData( ys=ys, **preprocessKwargs )
 
@@ -460,6 +566,20 @@ class StateBase( ExponentialFam ):
                     assert conditionOnY == True
                     self.backwardFilterForwardRecurse( workFunc, **filterKwargs )
 
+        return list( ans )
+
+    def ilog_likelihood( self, x, forwardFilter=True, conditionOnY=False, expFam=False, preprocessKwargs={}, filterKwargs={}, seperateLikelihoods=False ):
+
+        if( expFam ):
+            return self.log_likelihoodExpFam( x, constParams=self.constParams, nat_params=self.nat_params )
+
+        size = self.dataN( x )
+
+        x, ys = x
+
+        # Need to add for case where size is 1 and unpacked vs size is 1 and packed
+        ans = np.array( self.sequenceMap( 'logLikelihoodChunk', zip( x, ys ), forwardFilter=forwardFilter, conditionOnY=conditionOnY, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs ) )
+
         if( seperateLikelihoods == True ):
             return ans
 
@@ -475,18 +595,19 @@ class StateBase( ExponentialFam ):
         dummy = cls( *params )
         return dummy.ilog_marginal( x, seperateMarginals=seperateMarginals, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs, alphas=alphas, betas=betas )
 
-    def ilog_marginal( self, ys, seperateMarginals=False, preprocessKwargs={}, filterKwargs={}, alphas=None, betas=None ):
-
-        size = self.dataN( ys, conditionOnY=True, checkY=True )
-
-        def work( _ys ):
+    def logMarginalChunk( self, ys, preprocessKwargs={}, filterKwargs={} ):
+        # log P( y | ϴ ) for every sequence in ys
+        ans = []
+        for _ys in ys:
             self.preprocessData( ys=_ys, **preprocessKwargs )
             alpha = self.forwardFilter( **filterKwargs )
             beta = self.backwardFilter( **filterKwargs )
-            return self.log_marginalFromAlphaBeta( alpha[ 0 ], beta[ 0 ] )
+            ans.append( self.log_marginalFromAlphaBeta( alpha[ 0 ], beta[ 0 ] ) )
+        return ans
 
-        # if( size == 1 ):
-        #     return work( ys )
+    def ilog_marginal( self, ys, seperateMarginals=False, preprocessKwargs={}, filterKwargs={}, alphas=None, betas=None ):
+
+        size = self.dataN( ys, conditionOnY=True, checkY=True )
 
         ans = np.empty( size )
 
@@ -495,8 +616,7 @@ class StateBase( ExponentialFam ):
             for i, ( _ys, _alpha, _beta ) in enumerate( zip( ys, alphas, betas ) ):
                 ans[ i ] = self.log_marginalFromAlphaBeta( _alpha[ 0 ], _beta[ 0 ] )
         else:
-            for i, _ys in enumerate( ys ):
-                ans[ i ] = work( _ys )
+            ans[ : ] = self.sequenceMap( 'logMarginalChunk', ys, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
 
         if( seperateMarginals == False ):
             ans = ans.sum()
@@ -505,24 +625,54 @@ class StateBase( ExponentialFam ):
 
     ######################################################################
 
-    def EStep( self, ys=None, preprocessKwargs={}, filterKwargs={} ):
-
-        def work( _ys ):
+    def EStepChunk( self, ys, preprocessKwargs={}, filterKwargs={} ):
+        # ( alphas, betas ) for every sequence in ys
+        ans = []
+        for _ys in ys:
             self.preprocessData( ys=_ys, **preprocessKwargs )
             a = self.forwardFilter( **filterKwargs )
             b = self.backwardFilter( **filterKwargs )
+            ans.append( ( a, b ) )
+        return ans
 
-            return a, b
+    def EStep( self, ys=None, preprocessKwargs={}, filterKwargs={} ):
 
-        if( self.dataN( ys, conditionOnY=True, checkY=True ) > 1 ):
-            alphas, betas = zip( *[ work( _ys ) for _ys in ys ] )
-        else:
-            alphas, betas = zip( *[ work( _ys ) for _ys in ys ] )
-            # alphas, betas = work( ys )
+        self.dataN( ys, conditionOnY=True, checkY=True )
+        alphas, betas = zip( *self.sequenceMap( 'EStepChunk', ys, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs ) )
 
         self.last_normalizer = self.ilog_marginal( ys, alphas=alphas, betas=betas )
         return alphas, betas
 
+    ######################################################################
+    # E-step that reduces each chunk of sequences to its expected sufficient
+    # statistics right away, so that the alphas and betas for the whole
+    # dataset are never kept around.  The statistics are what MStepFromStats
+    # expects, with the number of sequences as the last element
+
+    def EStepStatsChunk( self, ys, preprocessKwargs={}, filterKwargs={} ):
+        ys = tuple( ys )
+        alphas, betas = zip( *self.EStepChunk( ys, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs ) )
+        normalizer = self.ilog_marginal( ys, alphas=alphas, betas=betas )
+        stats = self.conditionedExpectedSufficientStats( ys, alphas, betas, forMStep=True ) + ( len( ys ), )
+        return stats, normalizer
+
+    def combineEStepStats( self, a, b ):
+        ( statsA, normalizerA ), ( statsB, normalizerB ) = a, b
+        return self.combineStats( statsA, statsB ), normalizerA + normalizerB
+
+    def EStepStats( self, ys=None, preprocessKwargs={}, filterKwargs={} ):
+        self.dataN( ys, conditionOnY=True, checkY=True )
+        stats, self.last_normalizer = self.sequenceReduce( 'EStepStatsChunk', ys, self.combineEStepStats, preprocessKwargs=preprocessKwargs, filterKwargs=filterKwargs )
+        return stats
+
+    @abstractmethod
+    def combineStats( self, a, b ):
+        pass
+
+    @abstractmethod
+    def MStepFromStats( self, stats ):
+        pass
+
     @abstractmethod
     def MStep( self, ys, alphas, betas ):
         pass
@@ -24,7 +24,10 @@ __all__ = [ 'multigammalnDerivative',
             'monitored_adam',
             'extendAxes',
             'logMultiplyTerms',
-            'logIntegrate' ]
+            'logIntegrate',
+            'logContract',
+            'rHat',
+            'effectiveSampleSize' ]
 
 ######################################################################
 
@@ -83,6 +86,107 @@ def logIntegrate( integrand, axes ):
 
     return integrand
 
+_einsum_letters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# Products smaller than this are cheaper to just build
+LOG_CONTRACT_DENSE_SIZE = 4096
+
+def logContract( terms, axes ):
+    # Same as logIntegrate( logMultiplyTerms( terms ), axes ) but without
+    # building the full product when it is big.  Each term is shifted by its
+    # max over the integrated axes, the product and sum happen in exp space
+    # with np.einsum ( which also picks the order to contract the terms in )
+    # and the shifts are added back on.  Anything that underflows in exp space
+    # is recomputed in log space, one chunk of output entries at a time.
+
+    # Remove the empty terms
+    terms = [ t for t in terms if np.prod( t.shape ) > 1 ]
+
+    if( len( axes ) == 0 or len( terms ) == 0 ):
+        return logMultiplyTerms( terms )
+
+    ndim = max( [ len( term.shape ) for term in terms ] )
+    axes = sorted( set( [ int( ax ) if ax >= 0 else ndim + int( ax ) for ax in axes ] ) )
+    assert axes[ -1 ] < ndim
+    kept = [ i for i in range( ndim ) if i not in axes ]
+
+    # Align every term on the left and get the shape of the full product
+    padded = []
+    shape = np.ones( ndim, dtype=int )
+    for term in terms:
+        for _ in range( ndim - term.ndim ):
+            term = term[ ..., None ]
+        term_axes = [ i for i, s in enumerate( term.shape ) if s != 1 ]
+        shape[ term_axes ] = [ term.shape[ i ] for i in term_axes ]
+        padded.append( ( term, term_axes ) )
+
+    if( np.prod( shape ) <= LOG_CONTRACT_DENSE_SIZE ):
+        integrand = 0.0
+        for term, _ in padded:
+            integrand = integrand + term
+        return logIntegrate( integrand, axes )
+
+    operands, subscripts = [], []
+    shift = 0.0
+    for term, term_axes in padded:
+        max_t = np.max( term, axis=tuple( axes ), keepdims=True )
+        max_t = np.where( np.isfinite( max_t ), max_t, 0.0 )
+
+        operands.append( np.reshape( np.exp( term - max_t ), shape[ term_axes ] ) )
+        subscripts.append( ''.join( [ _einsum_letters[ i ] for i in term_axes ] ) )
+        shift = shift + np.squeeze( max_t, axis=tuple( axes ) )
+
+    out_subscript = ''.join( [ _einsum_letters[ i ] for i in kept if shape[ i ] != 1 ] )
+    contraction = ','.join( subscripts ) + '->' + out_subscript
+    optimize = 'greedy' if len( operands ) > 2 else False
+
+    with np.errstate( divide='ignore' ):
+        ans = np.log( np.einsum( contraction, *operands, optimize=optimize ) )
+    ans = np.reshape( ans, shape[ kept ] ) + shift
+
+    # A -inf is only real if every term in the sum is -inf
+    underflow = np.isneginf( ans )
+    if( np.any( underflow ) ):
+        support = [ np.reshape( ( term > np.NINF ).astype( float ), shape[ term_axes ] ) for term, term_axes in padded ]
+        support = np.reshape( np.einsum( contraction, *support, optimize=optimize ), ans.shape )
+        underflow = underflow & ( support > 0 )
+        if( np.any( underflow ) ):
+            ans = _logContractEntries( ans, underflow, padded, shape, kept, axes )
+
+    return ans
+
+def _logContractEntries( ans, entries, padded, shape, kept, axes ):
+    # Recompute the entries of ans where entries is True with a logsumexp over
+    # the integrated axes.  Only the integrand of those entries is built, in chunks
+    # of at most LOG_CONTRACT_DENSE_SIZE elements
+    index = np.argwhere( entries )
+    chunksize = max( 1, LOG_CONTRACT_DENSE_SIZE // int( np.prod( shape[ axes ] ) ) )
+
+    vals = []
+    for start in range( 0, index.shape[ 0 ], chunksize ):
+        chunk = index[ start:start + chunksize ]
+
+        # Gather every term at the chunk's kept indices.  Each result has
+        # shape ( len( chunk ), *integrated axes )
+        integrand = 0.0
+        for term, _ in padded:
+            term = np.transpose( term, kept + axes )
+            selector = tuple( [ chunk[ :, i ] if term.shape[ i ] != 1 else np.zeros( chunk.shape[ 0 ], dtype=int ) for i in range( len( kept ) ) ] )
+            integrand = integrand + term[ selector ]
+
+        sum_axes = tuple( range( 1, integrand.ndim ) )
+        max_v = np.max( integrand, axis=sum_axes, keepdims=True )
+        max_v = np.where( np.isfinite( max_v ), max_v, 0.0 )
+        vals.append( np.log( np.sum( np.exp( integrand - max_v ), axis=sum_axes ) ) + np.reshape( max_v, -1 ) )
+    vals = np.concatenate( vals )
+
+    # argwhere is in row major order, so the rank of an entry among the
+    # recomputed ones is where its value is in vals.  Gather instead of
+    # assigning so that this works with autograd
+    flat_entries = np.reshape( entries, -1 )
+    rank = np.maximum( np.cumsum( flat_entries ) - 1, 0 )
+    return np.reshape( np.where( flat_entries, vals[ rank ], np.reshape( ans, -1 ) ), ans.shape )
+
 ######################################################################
 
 # THIS IS TAKEN DIRECTLY FROM https://github.com/HIPS/autograd/blob/master/autograd/misc/optimizers.py
@@ -198,9 +302,9 @@ class fbsData( FbsData ):
 ##########################################################################
 
 def toBlocks( mat, d ):
-    J11 = mat[ np.ix_( [ 0, d - 1 ], [ 0, d - 1 ] ) ]
-    J12 = mat[ np.ix_( [ 0, d - 1 ], [ d, mat.shape[ 0 ] - 1 ] ) ]
-    J22 = mat[ np.ix_( [ d, mat.shape[ 0 ] - 1 ], [ d, mat.shape[ 0 ] - 1 ] ) ]
+    J11 = mat[ :d, :d ]
+    J12 = mat[ :d, d: ]
+    J22 = mat[ d:, d: ]
     return J11, J12, J22
 
 ##########################################################################
@@ -353,4 +457,65 @@ def cheatPrecisionHelper( x, N ):
     # Assumes that x is psd matrix
     x = ( x + x.T ) / 2.0
     x[ np.diag_indices( N ) ] += np.ones( N ) * 1e-8
-    return x
\ No newline at end of file
+    return x
+
+##########################################################################
+
+def _splitChains( samples ):
+    # Split every chain in half so that chains that are still drifting
+    # look like they disagree with themselves
+    half = samples.shape[ 1 ] // 2
+    return np.concatenate( ( samples[ :, :half ], samples[ :, samples.shape[ 1 ] - half: ] ), axis=0 )
+
+def _chainVariances( samples ):
+    # The mean within chain variance and the pooled estimate of the variance
+    n = samples.shape[ 1 ]
+    W = samples.var( axis=1, ddof=1 ).mean( axis=0 )
+    B = samples.mean( axis=1 ).var( axis=0, ddof=1 )
+    return W, ( n - 1 ) / n * W + B
+
+def rHat( samples ):
+    # Split R-hat ( Gelman et al. ) of samples with shape ( n_chains, n_samples, ... ).
+    # Computed for every trailing index.  Goes to 1 as the chains mix
+    samples = _splitChains( np.asarray( samples, dtype=float ) )
+    W, var_plus = _chainVariances( samples )
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        ans = np.sqrt( var_plus / W )
+
+    # Anything that never changed has nothing left to mix
+    return np.where( var_plus == 0, 1.0, ans )
+
+def effectiveSampleSize( samples ):
+    # Multi chain effective sample size of samples with shape ( n_chains, n_samples, ... ).
+    # The autocorrelations are truncated with Geyer's initial monotone sequence
+    samples = np.asarray( samples, dtype=float )
+    n_chains, n = samples.shape[ :2 ]
+    stat_shape = samples.shape[ 2: ]
+    samples = samples.reshape( ( n_chains, n, -1 ) )
+
+    # Autocovariance of every chain using an fft
+    centered = samples - samples.mean( axis=1, keepdims=True )
+    f = np.fft.rfft( centered, n=2 * n, axis=1 )
+    acov = np.fft.irfft( f * np.conj( f ), n=2 * n, axis=1 )[ :, :n ] / n
+
+    W, var_plus = _chainVariances( samples )
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        rho = 1.0 - ( W - acov.mean( axis=0 ) ) / var_plus
+
+    total = n_chains * n
+    ans = np.full( rho.shape[ 1 ], float( total ) )
+    for i in np.nonzero( var_plus > 0 )[ 0 ]:
+
+        # Sum the autocorrelations in pairs until a pair is negative and
+        # make the pairs non increasing
+        pairs = rho[ :-1:2, i ] + rho[ 1::2, i ]
+        n_positive = np.argmin( pairs > 0 ) if np.any( pairs <= 0 ) else pairs.shape[ 0 ]
+        tau = -1.0
+        last = np.inf
+        for pair in pairs[ :n_positive ]:
+            last = min( last, pair )
+            tau += 2.0 * last
+
+        ans[ i ] = total / max( tau, 1.0 / np.log10( total ) )
+
+    return ans.reshape( stat_shape )
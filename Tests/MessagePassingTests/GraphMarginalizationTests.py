@@ -4,9 +4,11 @@ from GenModels.GM.Distributions import *
 from GenModels.GM.Models.DiscreteGraphModels import *
 import time
 from collections import Iterable
+from multiprocessing import cpu_count
 import itertools
 from autograd.extend import primitive, defvjp
 from autograd import jacobian as jac
+from GenModels.GM.Utility import fbsData, logsumexp
 
 __all__ = [ 'graphMarginalizationTest' ]
 
@@ -402,6 +404,369 @@ def testGraphHMMNoFBS():
 
 ##################################################################################################
 
+def widePedigree( n_children=200 ):
+    # Two founders with a lot of children.  Each child then has
+    # a child with someone from outside of the family
+    graph = DataGraph()
+    children = list( range( 2, n_children + 2 ) )
+    graph.addEdge( parents=[ 0, 1 ], children=children )
+    for i, child in enumerate( children ):
+        mate = n_children + 2 + 2 * i
+        graph.addEdge( parents=[ child, mate ], children=[ mate + 1 ] )
+    return graph
+
+def testGraphHMMBatched():
+
+    np.random.seed( 2 )
+
+    d_latent = 3
+    d_obs = 5
+    measurements = 2
+
+    # The batched kernels should give the same filter values as going node by node
+    graphs = [ graph1(), graph2(), graph3(), graph4(), graph5(), graph6(), graph7(), widePedigree( 50 ) ]
+    tester = MarginalizationTester( graphs, d_latent, d_obs, measurements, random_latent_states=True )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    msg = GraphHMM()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+
+    msg.batched = False
+    start = time.time()
+    U_loop, V_loop = msg.filter()
+    end_loop = time.time() - start
+
+    msg.batched = True
+    start = time.time()
+    U, V = msg.filter()
+    end_batched = time.time() - start
+
+    for u, u_loop in zip( U, U_loop ):
+        assert np.allclose( u, u_loop )
+    for v, v_loop in zip( V[ 2 ], V_loop[ 2 ] ):
+        assert np.allclose( v, v_loop )
+
+    print( 'Node by node filter took', end_loop, 'seconds' )
+    print( 'Batched filter took', end_batched, 'seconds' )
+
+##################################################################################################
+
+def testLogContract():
+
+    np.random.seed( 2 )
+
+    # The fused contraction should match multiplying and then integrating
+    K = 4
+    terms = [ np.random.random( ( K, K, K ) ), np.random.random( ( K, 1, 1 ) ), np.random.random( ( 1, K ) ), np.random.random( ( K, K, 1 ) ) ]
+    terms[ 0 ][ 0, 1 ] = np.NINF
+    for axes in [ [ 0 ], [ 1 ], [ 0, 1 ], [ 0, 2 ], [ 0, 1, 2 ] ]:
+        expected = GraphHMM.integrate( GraphHMM.multiplyTerms( terms ), axes )
+        assert np.allclose( GraphHMM.contract( terms, axes ), expected )
+
+    # Also with fbs axes
+    fbs_terms = [ fbsData( terms[ 0 ], 2 ), fbsData( np.random.random( ( K, K ) ), -1 ), fbsData( np.random.random( K ), 0 ) ]
+    expected = GraphHMMFBS.integrate( GraphHMMFBS.multiplyTerms( fbs_terms ), [ 0, 1 ] )
+    ans = GraphHMMFBS.contract( fbs_terms, [ 0, 1 ] )
+    assert ans.fbs_axis == expected.fbs_axis
+    assert np.allclose( ans.data, expected.data )
+
+    # The full product here has 30^6 elements, which is too big to build
+    K = 30
+    a, b, c = np.random.random( ( K, K ) ), np.random.random( ( K, K ) ), np.random.random( ( K, K ) )
+    terms = [ a[ :, :, None, None, None, None ], b[ None, None, :, :, None, None ], c[ None, None, None, None, :, : ] ]
+    expected = sum( [ np.log( np.exp( t ).sum() ) for t in ( a, b, c ) ] )
+    assert np.isclose( GraphHMM.contract( terms, range( 6 ) ), expected )
+
+    # Entries that underflow in exp space are recomputed in log space
+    K = 20
+    a, b = np.random.random( ( K, K, 1 ) ), np.random.random( ( 1, K, K ) )
+    a[ :3, 1: ] = -2000.0
+    b[ 0, 0, :2 ] = -2000.0
+    integrand = a + b
+    max_v = np.max( integrand, axis=1, keepdims=True )
+    expected = np.log( np.sum( np.exp( integrand - max_v ), axis=1 ) ) + max_v[ :, 0 ]
+    ans = GraphHMM.contract( [ a, b ], [ 1 ] )
+    assert np.all( ans[ :3, :2 ] < -1000 )
+    assert np.allclose( ans, expected )
+
+    print( 'Passed the log contraction tests!' )
+
+##################################################################################################
+
+def testMessageStorage():
+
+    np.random.seed( 2 )
+
+    d_latent = 3
+    d_obs = 5
+    measurements = 2
+
+    # Node 0 has 3 down edges
+    graph = DataGraph()
+    graph.addEdge( parents=[ 0, 1 ], children=[ 2 ] )
+    graph.addEdge( parents=[ 0, 3 ], children=[ 4 ] )
+    graph.addEdge( parents=[ 0, 5 ], children=[ 6, 7 ] )
+    graph.addEdge( parents=[ 2, 8 ], children=[ 9 ] )
+
+    tester = MarginalizationTester( [ graph ], d_latent, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    msg = GraphHMM()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+    msg.batched = False
+    U, V = msg.filter()
+
+    # U and V are dense and every node sees the same marginal
+    assert U.shape == ( msg.pmask.shape[ 0 ], d_latent )
+    assert V[ 2 ].shape == ( msg.pmask.nnz, d_latent )
+    marginals = [ msg.integrate( joint, axes=[ -1 ] ) for node, joint in msg.nodeJoint( U, V, msg.nodes ) ]
+    assert np.allclose( marginals, marginals[ 0 ] )
+
+    for node in msg.nodes:
+        for slot in msg.vSlots( node ):
+            assert msg.pmask.row[ slot ] == node
+
+    # The FBS messages live in a message list.  Copying it to a new arena keeps the values
+    tester = MarginalizationTesterFBS( [ graph, cycleGraph3() ], d_latent, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    msg = GraphHMMFBS()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+    U, V = msg.filter()
+
+    U_copy = U.copy()
+    assert len( U_copy ) == len( U )
+    for u, u_copy in zip( U, U_copy ):
+        assert u.fbs_axis == u_copy.fbs_axis
+        assert np.allclose( u.data, u_copy.data )
+
+    print( 'Passed the message storage tests!' )
+
+##################################################################################################
+
+def bruteForceLogJoints( msg ):
+    # log P( X, Y ) for every latent state assignment of the full graph
+    N = msg.nodes.shape[ 0 ]
+    assignments = list( itertools.product( range( msg.K ), repeat=N ) )
+    log_joints = []
+    for x in assignments:
+        log_joint = 0.0
+        for node in range( N ):
+            parents, parent_order = msg.getParents( node, get_order=True )
+            if( len( parents ) == 0 ):
+                log_joint += msg.pi0[ x[ node ] ]
+            else:
+                parents = parents[ np.argsort( parent_order ) ]
+                log_joint += msg.pis[ len( parents ) + 1 ][ tuple( [ x[ p ] for p in parents ] ) + ( x[ node ], ) ]
+            log_joint += msg.L[ node ][ x[ node ] ]
+        log_joints.append( log_joint )
+    return np.array( assignments ), np.array( log_joints )
+
+def bruteForceMarginal( msg ):
+    # Sum over every latent state assignment of the full graph
+    _, log_joints = bruteForceLogJoints( msg )
+    return logsumexp( log_joints )
+
+def testChunkedFBS():
+
+    np.random.seed( 2 )
+
+    d_latent = 4
+    d_obs = 5
+    measurements = 2
+
+    # Two fbs nodes in different families
+    graph = DataGraph()
+    graph.addEdge( parents=[ 0, 1 ], children=[ 3 ] )
+    graph.addEdge( parents=[ 1, 2 ], children=[ 4 ] )
+    graph.addEdge( parents=[ 2, 3, 4 ], children=[ 5, 6 ] )
+    fbs = np.array( [ 3, 4 ] )
+
+    # The emissions of the fbs nodes need to line up with their fbs axes
+    tester = MarginalizationTesterFBS( [ ( graph, fbs ) ], d_latent, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+    msg = GraphHMMFBS()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+    U, V = msg.filter()
+    assert np.isclose( msg.marginalProb( U, V ), bruteForceMarginal( msg ) )
+
+    tester = MarginalizationTesterFBS( [ ( graph, fbs ), cycleGraph1(), graph3() ], d_latent, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    for msg in [ GraphHMMFBS(), GraphHMMFBSParallel() ]:
+        msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+        U, V = msg.filter()
+        marginal = msg.marginalProb( U, V )
+        smoothed = msg.nodeSmoothed( U, V, msg.nodes )
+
+        # Force the fbs states of the first graph to be split into blocks
+        for memory_budget in [ None, 8 * d_latent**3 * 4, 8 * d_latent**3 * 2 ]:
+            assert np.isclose( msg.chunkedMarginalProb( memory_budget=memory_budget ), marginal )
+            chunked = msg.chunkedNodeSmoothed( msg.nodes, memory_budget=memory_budget )
+            for ( node, val ), ( _node, chunked_val ) in zip( smoothed, chunked ):
+                assert node == _node
+                assert np.allclose( val, chunked_val )
+
+    # Nodes with 3 states ( like genotypes ) get split into blocks of 2 and 1 states
+    tester = MarginalizationTesterFBS( [ cycleGraph3() ], 3, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+    msg = GraphHMMFBS()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+    U, V = msg.filter()
+    marginal = msg.marginalProb( U, V )
+    smoothed = msg.nodeSmoothed( U, V, msg.nodes )
+
+    n_fbs = len( msg.feedback_sets[ 0 ] )
+    memory_budget = 8 * 3**( n_fbs + 3 ) // 2
+    assert len( msg.fbsBlocks( 0, memory_budget ) ) > 1
+    assert np.isclose( msg.chunkedMarginalProb( memory_budget=memory_budget ), marginal )
+    chunked = msg.chunkedNodeSmoothed( msg.nodes, memory_budget=memory_budget )
+    for ( node, val ), ( _node, chunked_val ) in zip( smoothed, chunked ):
+        assert node == _node
+        assert np.allclose( val, chunked_val )
+
+    # The memory budget also bounds the unchunked products
+    class SmallBudgetHMM( GraphHMMFBS ):
+        memory_budget = 8 * d_latent
+
+    msg = SmallBudgetHMM()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+    try:
+        U, V = msg.filter()
+        msg.nodeSmoothed( U, V, msg.nodes )
+        assert 0, 'Expected the memory budget to be exceeded'
+    except AssertionError as e:
+        assert 'chunked' in str( e ), str( e )
+
+    print( 'Passed the chunked fbs tests!' )
+
+##################################################################################################
+
+def testMaxProduct():
+
+    np.random.seed( 2 )
+
+    d_latent = 3
+    d_obs = 5
+    measurements = 2
+
+    graph = DataGraph()
+    graph.addEdge( parents=[ 0, 1 ], children=[ 2, 3 ] )
+    graph.addEdge( parents=[ 2, 4 ], children=[ 5 ] )
+    graph.addEdge( parents=[ 3 ], children=[ 6 ] )
+
+    # Cycles through the fbs nodes
+    cycle = DataGraph()
+    cycle.addEdge( parents=[ 0, 1 ], children=[ 2, 3 ] )
+    cycle.addEdge( parents=[ 2, 3 ], children=[ 4 ] )
+    cycle_fbs = np.array( [ 3 ] )
+
+    two_cycles = DataGraph()
+    two_cycles.addEdge( parents=[ 0, 1 ], children=[ 3 ] )
+    two_cycles.addEdge( parents=[ 1, 2 ], children=[ 4 ] )
+    two_cycles.addEdge( parents=[ 2, 3, 4 ], children=[ 5 ] )
+    two_cycles_fbs = np.array( [ 3, 4 ] )
+
+    for Tester, MaxProduct, graphs in [ ( MarginalizationTester, GraphHMMMaxProduct, [ graph ] ),
+                                        ( MarginalizationTesterFBS, GraphHMMFBSMaxProduct, [ ( cycle, cycle_fbs ) ] ),
+                                        ( MarginalizationTesterFBS, GraphHMMFBSMaxProduct, [ ( two_cycles, two_cycles_fbs ) ] ) ]:
+
+        tester = Tester( graphs, d_latent, d_obs, measurements )
+        initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+        msg = MaxProduct()
+        msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+        states, log_joint = msg.viterbi()
+
+        # Compare against every assignment of the latent states
+        assignments, log_joints = bruteForceLogJoints( msg )
+        best = np.argmax( log_joints )
+        assert np.isclose( log_joint, log_joints[ best ] ), ( log_joint, log_joints[ best ] )
+        assert np.all( states == assignments[ best ] ), ( states, assignments[ best ] )
+
+        # The max marginal of each node has to be the best joint with that node fixed
+        U, V = msg.filter()
+        for node, joint in msg.nodeJoint( U, V, msg.nodes ):
+            for k in range( d_latent ):
+                assert np.isclose( joint[ k ], log_joints[ assignments[ :, node ] == k ].max() )
+
+    print( 'Passed the max product tests!' )
+
+##################################################################################################
+
+def testSmoothedNormalization():
+
+    np.random.seed( 2 )
+
+    d_latent = 3
+    d_obs = 5
+    measurements = 2
+
+    tester = MarginalizationTesterFBS( [ graph3(), cycleGraph1(), cycleGraph7(), graph5() ], d_latent, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    for msg in [ GraphHMMFBS(), GraphHMMFBSParallel() ]:
+        msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+        U, V = msg.filter()
+
+        # P( Y ) should only be computed once per graph
+        n_calls = [ 0 ]
+        marginalProb = msg.marginalProb
+        def countedMarginalProb( *args, **kwargs ):
+            n_calls[ 0 ] += 1
+            return marginalProb( *args, **kwargs )
+        msg.marginalProb = countedMarginalProb
+
+        smoothed = msg.nodeSmoothed( U, V, msg.nodes )
+        parents_smoothed = msg.parentsSmoothed( U, V, msg.nodes )
+        parent_child_smoothed = msg.parentChildSmoothed( U, V, msg.nodes )
+        assert n_calls[ 0 ] == 0
+
+        del msg.marginalProb
+        for node, val in itertools.chain( smoothed, parents_smoothed, parent_child_smoothed ):
+            assert np.isclose( msg.integrate( val, axes=range( val.ndim ) ), 0.0 )
+            graph_start = msg.full_graph.parent_graph_assignments[ msg.graphIndex( node ) ]
+            assert graph_start <= node
+
+    print( 'Passed the smoothed normalization tests!' )
+
+##################################################################################################
+
+def testIndexConversion():
+
+    np.random.seed( 2 )
+
+    tester = MarginalizationTesterFBS( [ graph3(), cycleGraph2(), cycleGraph3() ], 3, 5, 2 )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    msg = GraphHMMFBS()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+
+    # The lookups are inverses of each other and the fbs nodes come last in the partial graph
+    full = msg.nodes
+    partial = msg.fullGraphIndexToPartialGraphIndex( full )
+    assert np.all( msg.partialGraphIndexToFullGraphIndex( partial ) == full )
+    assert np.all( np.sort( partial ) == np.arange( full.shape[ 0 ] ) )
+    assert np.all( np.sort( partial[ msg.fbs ] ) == np.arange( msg.fbs.shape[ 0 ] ) + full.shape[ 0 ] - msg.fbs.shape[ 0 ] )
+
+    for node in full:
+        assert msg.inFeedbackSet( node, is_partial_graph_index=False ) == ( node in msg.fbs )
+        assert msg.inFeedbackSet( partial[ node ], is_partial_graph_index=True ) == ( node in msg.fbs )
+
+        # The partial parents are the full parents without the fbs nodes
+        full_parents, full_order = msg.getFullParents( node, get_order=True )
+        partial_parents, partial_order = msg.getPartialParents( node, get_order=True )
+        keep = np.array( [ p not in msg.fbs for p in full_parents ], dtype=bool )
+        assert np.all( partial_parents == full_parents[ keep ] )
+        assert np.all( partial_order == full_order[ keep ] )
+
+        as_partial = msg.getPartialParents( node, return_partial_graph_index=True )
+        assert np.all( msg.partialGraphIndexToFullGraphIndex( as_partial ) == full_parents[ keep ] )
+
+    print( 'Passed the index conversion tests!' )
+
+##################################################################################################
+
 def testGraphHMM():
 
     np.random.seed( 2 )
@@ -464,6 +829,54 @@ def testGraphHMMParallel():
 
 ##################################################################################################
 
+def testParallelScaling( max_workers=None, copies=10 ):
+
+    np.random.seed( 2 )
+
+    # A batch of cyclic pedigrees
+    graphs = [ cycleGraph8(), cycleGraph9(), cycleGraph10(), cycleGraph11(), cycleGraph12(), cycleGraph13() ] * copies
+
+    d_latent = 3
+    d_obs = 5
+    measurements = 2
+
+    tester = MarginalizationTesterFBSParallel( graphs, d_latent, d_obs, measurements, random_latent_states=False )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    max_workers = max_workers if max_workers is not None else cpu_count()
+    n_workers = sorted( set( [ 1, 2, 4, 8, 16, 32, max_workers ] ) )
+    n_workers = [ n for n in n_workers if n <= max( max_workers, 2 ) ]
+
+    # Timings with more workers than cores only show the overhead of the pool
+    print( '%d graphs on %d cores'%( len( graphs ), cpu_count() ) )
+
+    U_serial, V_serial = None, None
+    serial_time = None
+    for n in n_workers:
+        msg = tester.msg
+        msg.n_workers = n
+        msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+
+        start = time.time()
+        U, V = msg.filter()
+        end = time.time()
+        msg.cleanup()
+
+        if( U_serial is None ):
+            U_serial, V_serial = U, V
+            serial_time = end - start
+        else:
+            for u, u_serial in zip( U, U_serial ):
+                assert np.allclose( u.data, u_serial.data )
+            for v, v_serial in zip( V[ 2 ], V_serial[ 2 ] ):
+                assert np.allclose( v.data, v_serial.data )
+
+        speedup = serial_time / ( end - start )
+        note = '' if n <= cpu_count() else ' ( more workers than cores )'
+        print( '%d workers: filter took %f seconds, %.2fx speedup, %.0f%% efficiency%s'%( n, end - start, speedup, 100 * speedup / n, note ) )
+
+##################################################################################################
+
 def testGraphGroupHMM():
 
     np.random.seed( 2 )
@@ -595,6 +1008,14 @@ def testSpeed():
 ##################################################################################################
 
 def graphMarginalizationTest():
+    testLogContract()
+    testMessageStorage()
+    testChunkedFBS()
+    testMaxProduct()
+    testSmoothedNormalization()
+    testIndexConversion()
+    testGraphHMMBatched()
+    testParallelScaling()
     # testGraphHMMNoFBS()
     # testGraphHMM()
     # testGraphHMMParallel()
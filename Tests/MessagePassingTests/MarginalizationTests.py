@@ -3,6 +3,7 @@ from GenModels.GM.States.MessagePassing import *
 from GenModels.GM.Distributions import *
 import time
 import scipy
+import itertools
 
 __all__ = [ 'marginalizationTest' ]
 
@@ -114,6 +115,169 @@ def testCategoricalHMMWithKnownStates():
 
 ######################################################################
 
+def testCategoricalHMMBatched():
+
+    K = 4
+    obsDim = 5
+    measurements = 2
+
+    initialDist = Dirichlet.generate( D=K )
+    transDist = TransitionDirichletPrior.generate( D_in=K, D_out=K )
+    emissionDist = TransitionDirichletPrior.generate( D_in=K, D_out=obsDim )
+
+    # Compare against the brute force marginal on a short sequence
+    T = 4
+    ys = np.array( [ Categorical.generate( D=obsDim, size=T ) for _ in range( measurements ) ] )
+
+    mp = CategoricalHMM()
+    mp.updateParams( initialDist, transDist, emissionDist, ys )
+    alphas = mp.forwardFilter()
+
+    total = 0.0
+    for xs in itertools.product( range( K ), repeat=T ):
+        p = initialDist[ xs[ 0 ] ]
+        for t in range( 1, T ):
+            p *= transDist[ xs[ t - 1 ], xs[ t ] ]
+        for t in range( T ):
+            p *= np.prod( emissionDist[ xs[ t ], ys[ :, t ] ] )
+        total += p
+
+    assert np.isclose( np.logaddexp.reduce( alphas[ -1 ] ), np.log( total ) )
+
+    # Variable length sequences should match running them one at a time
+    lengths = [ 1, 7, 30, 12, 30, 2 ]
+    ys = tuple( [ np.array( [ Categorical.generate( D=obsDim, size=T ) for _ in range( measurements ) ] ).reshape( ( measurements, T ) ) for T in lengths ] )
+
+    start = time.time()
+    batch_alphas, batch_betas = mp.filterBatch( ys )
+    end = time.time()
+    print( 'Batched filters: ', end - start )
+
+    for _ys, batch_alpha, batch_beta in zip( ys, batch_alphas, batch_betas ):
+        mp.preprocessData( _ys )
+        alphas = mp.forwardFilter()
+        betas = mp.backwardFilter()
+        assert np.allclose( alphas, batch_alpha )
+        assert np.allclose( betas, batch_beta )
+
+    print( 'Passed the batched categorical forward backward test!\n\n' )
+
+######################################################################
+
+def testCategoricalHMMViterbi():
+
+    K = 3
+    obsDim = 5
+    measurements = 2
+    T = 6
+
+    initialDist = Dirichlet.generate( D=K )
+    transDist = TransitionDirichletPrior.generate( D_in=K, D_out=K )
+    emissionDist = TransitionDirichletPrior.generate( D_in=K, D_out=obsDim )
+    ys = np.array( [ Categorical.generate( D=obsDim, size=T ) for _ in range( measurements ) ] )
+
+    mp = CategoricalHMM()
+    mp.updateParams( initialDist, transDist, emissionDist, ys )
+
+    def logJoint( xs ):
+        ans = np.log( initialDist[ xs[ 0 ] ] )
+        for t in range( 1, T ):
+            ans += np.log( transDist[ xs[ t - 1 ], xs[ t ] ] )
+        for t in range( T ):
+            ans += np.log( emissionDist[ xs[ t ], ys[ :, t ] ] ).sum()
+        return ans
+
+    # Compare against every latent state sequence
+    best = max( itertools.product( range( K ), repeat=T ), key=logJoint )
+    states, log_prob = mp.viterbi()
+    assert np.all( states == np.array( best ) )
+    assert np.isclose( log_prob, logJoint( best ) )
+
+    # With known latent states
+    known = np.array( [ [ 1, ( best[ 1 ] + 1 ) % K ], [ 4, ( best[ 4 ] + 2 ) % K ] ] )
+    allowed = [ xs for xs in itertools.product( range( K ), repeat=T ) if all( xs[ t ] == k for t, k in known ) ]
+    best = max( allowed, key=logJoint )
+    states, log_prob = mp.viterbi( knownLatentStates=known )
+    assert np.all( states == np.array( best ) )
+    assert np.isclose( log_prob, logJoint( best ) )
+
+    # Variable length sequences should match decoding them one at a time
+    lengths = [ 1, 7, 30, 12, 30, 2 ]
+    ys = tuple( [ np.array( [ Categorical.generate( D=obsDim, size=T ) for _ in range( measurements ) ] ).reshape( ( measurements, T ) ) for T in lengths ] )
+    batch_states, batch_log_probs = mp.viterbiBatch( ys )
+
+    for _ys, batch_state, batch_log_prob in zip( ys, batch_states, batch_log_probs ):
+        mp.preprocessData( _ys )
+        states, log_prob = mp.viterbi()
+        assert np.all( states == batch_state )
+        assert np.isclose( log_prob, batch_log_prob )
+
+    print( 'Passed the categorical viterbi test!\n\n' )
+
+######################################################################
+
+def testScaledHMM():
+
+    T = 60
+    K = 5
+    obsDim = 4
+    measurements = 3
+
+    initialDist = Dirichlet.generate( D=K )
+    transDist = TransitionDirichletPrior.generate( D_in=K, D_out=K )
+    emissionDist = TransitionDirichletPrior.generate( D_in=K, D_out=obsDim )
+
+    ys = np.array( [ Categorical.generate( D=obsDim, size=T ) for _ in range( measurements ) ] )
+
+    knownStates = np.array( [ [ 0, 1 ], [ 10, 3 ], [ 11, 0 ], [ 40, 2 ] ] )
+
+    def compare( mp, **kwargs ):
+        mp.backend = 'log'
+        alphas = mp.forwardFilter( **kwargs )
+        betas = mp.backwardFilter( **kwargs )
+
+        mp.backend = 'scaled'
+        scaled_alphas = mp.forwardFilter( **kwargs )
+        scaled_betas = mp.backwardFilter( **kwargs )
+
+        assert np.allclose( alphas, scaled_alphas )
+        assert np.allclose( betas, scaled_betas )
+
+    mp = CategoricalHMM()
+    mp.updateParams( initialDist, transDist, emissionDist, ys )
+    compare( mp )
+    compare( mp, knownLatentStates=knownStates )
+
+    # Make one state almost never emit the first observation ( too small to
+    # represent as a probability ) so that the scaled messages underflow.
+    # This should fall back to log space.
+    initialDist = 0.5 * initialDist + 0.5 / K
+    transDist = 0.5 * transDist + 0.5 / K
+    log_emissionDist = np.log( emissionDist )
+    log_emissionDist[ 0, 0 ] = -800.0
+    ys[ :, 5 ] = 0
+
+    mp.updateNatParams( np.log( initialDist ), np.log( transDist ), log_emissionDist, ys=ys )
+    mp.backend = 'scaled'
+    assert mp.scaledForwardFilter() is None
+    compare( mp )
+
+    mus, sigmas = list( zip( *[ NormalInverseWishart.generate( D=obsDim ) for _ in range( K ) ] ) )
+    mp = GaussianHMM()
+    mp.updateParams( initialDist, transDist, mus, sigmas, np.random.random( ( measurements, T, obsDim ) ) )
+    compare( mp )
+
+    xs = np.random.random( ( T, obsDim ) )
+    mu0, sigma0 = NormalInverseWishart.generate( D=obsDim )
+    ASigmas = [ MatrixNormalInverseWishart.generate( D_in=obsDim, D_out=obsDim ) for _ in range( K ) ]
+    mp = SLDSHMM()
+    mp.updateParams( initialDist, transDist, mu0, sigma0, None, [ A for A, _ in ASigmas ], [ sigma for _, sigma in ASigmas ], xs )
+    compare( mp )
+
+    print( 'Passed the scaled forward backward test!\n\n' )
+
+######################################################################
+
 def testGaussianHMM():
 
     T = 100
@@ -197,6 +361,12 @@ def testSLDSHMM():
     end = time.time()
     print( 'Preprocess: ', end - start )
 
+    # The vectorized regime likelihoods should match evaluating each regime separately
+    for t in np.random.choice( T - 1, 5 ):
+        for k in range( D_latent ):
+            ll = Regression.log_likelihood( ( xs[ t ], xs[ t + 1 ] ), params=( As[ k ], sigmas[ k ] ) )
+            assert np.isclose( mp.L[ t, k ], ll )
+        assert np.allclose( mp.emissionProb( t + 1, forward=True, xs=xs ), mp.L[ t ] )
 
     start = time.time()
     alphas = mp.forwardFilter()
@@ -424,12 +594,241 @@ def testStableKalmanFilter():
 
 ######################################################################
 
+def testParallelScan():
+
+    def compare( mp, **kwargs ):
+        mp.n_blocks = 1
+        alphas = mp.forwardFilter( **kwargs )
+        betas = mp.backwardFilter( **kwargs )
+
+        for n_blocks, n_workers in [ ( 7, 1 ), ( 3, 2 ) ]:
+            mp.n_blocks = n_blocks
+            mp.n_workers = n_workers
+
+            start = time.time()
+            scan_alphas = mp.forwardFilter( **kwargs )
+            scan_betas = mp.backwardFilter( **kwargs )
+            end = time.time()
+            print( 'Scan with %d blocks and %d workers: '%( n_blocks, n_workers ), end - start )
+
+            for a, _a in zip( alphas, scan_alphas ):
+                for x, _x in zip( a, _a ):
+                    assert np.allclose( x, _x )
+            for b, _b in zip( betas, scan_betas ):
+                for x, _x in zip( b, _b ):
+                    assert np.allclose( x, _x )
+
+            # The same pool is used for every scan
+            if( n_workers > 1 ):
+                pool = mp.scan_pool
+                mp.forwardFilter( **kwargs )
+                assert mp.scan_pool is pool
+
+        mp.cleanup()
+        assert hasattr( mp, '_scan_pool' ) == False
+        mp.n_blocks = 1
+        mp.n_workers = 1
+
+    T = 500
+    K = 4
+    obsDim = 3
+    measurements = 2
+
+    initialDist = Dirichlet.generate( D=K )
+    transDist = TransitionDirichletPrior.generate( D_in=K, D_out=K )
+    emissionDist = TransitionDirichletPrior.generate( D_in=K, D_out=obsDim )
+    ys = np.array( [ Categorical.generate( D=obsDim, size=T ) for _ in range( measurements ) ] )
+
+    mp = CategoricalHMM()
+    mp.updateParams( initialDist, transDist, emissionDist, ys )
+    compare( mp )
+    compare( mp, knownLatentStates=np.array( [ [ 3, 1 ], [ 100, 0 ], [ 101, 2 ], [ 499, 3 ] ] ) )
+
+    T = 200
+    D_latent = 3
+    D_obs = 4
+
+    A, sigma = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_latent )
+    C, R = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_obs )
+    mu0, sigma0 = NormalInverseWishart.generate( D=D_latent )
+    u = np.random.random( ( T, D_latent ) )
+    ys = np.array( [ Regression.sample( params=( C, R ), size=T )[ 1 ] for _ in range( 2 ) ] )
+
+    mp = KalmanFilter()
+    mp.updateParams( A=A, sigma=sigma, C=C, R=R, mu0=mu0, sigma0=sigma0, u=u, ys=ys )
+    compare( mp )
+
+    print( 'Passed the parallel scan test!\n\n' )
+
+######################################################################
+
+def testOnlineFilter():
+
+    lag = 4
+
+    def compare( mp, ys, us=None ):
+        alphas = mp.forwardFilter()
+        betas = mp.backwardFilter()
+
+        online = OnlineFilter( mp, lag=lag )
+        for t, y in enumerate( ys ):
+            alpha = online.update( y, u=None if us is None or t == 0 else us[ t - 1 ] )
+            for x, _x in zip( alphas[ t ], alpha ):
+                assert np.allclose( x, _x )
+
+        assert np.isclose( online.log_marginal, mp.log_marginalFromAlphaBeta( alphas[ 0 ], betas[ 0 ] ) )
+
+        smoothed = online.smooth()
+        assert len( smoothed ) == lag + 1
+        for t, joint in smoothed:
+            for x, _x in zip( mp.multiplyTerms( ( alphas[ t ], betas[ t ] ) ), joint ):
+                assert np.allclose( x, _x )
+
+    T = 50
+    K = 4
+    obsDim = 3
+    measurements = 2
+
+    initialDist = Dirichlet.generate( D=K )
+    transDist = TransitionDirichletPrior.generate( D_in=K, D_out=K )
+    emissionDist = TransitionDirichletPrior.generate( D_in=K, D_out=obsDim )
+    ys = np.array( [ Categorical.generate( D=obsDim, size=T ) for _ in range( measurements ) ] )
+
+    mp = CategoricalHMM()
+    mp.updateParams( initialDist, transDist, emissionDist, ys )
+    compare( mp, ys.T )
+
+    xs = np.random.random( ( T, obsDim ) )
+    mu0, sigma0 = NormalInverseWishart.generate( D=obsDim )
+    ASigmas = [ MatrixNormalInverseWishart.generate( D_in=obsDim, D_out=obsDim ) for _ in range( K ) ]
+    mp = SLDSHMM()
+    mp.updateParams( initialDist, transDist, mu0, sigma0, None, [ A for A, _ in ASigmas ], [ sigma for _, sigma in ASigmas ], xs )
+    compare( mp, xs )
+
+    D_latent = 3
+    D_obs = 4
+
+    A, sigma = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_latent )
+    C, R = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_obs )
+    mu0, sigma0 = NormalInverseWishart.generate( D=D_latent )
+    u = np.random.random( ( T, D_latent ) )
+    ys = np.array( [ Regression.sample( params=( C, R ), size=T )[ 1 ] for _ in range( measurements ) ] )
+
+    mp = KalmanFilter()
+    mp.updateParams( A=A, sigma=sigma, C=C, R=R, mu0=mu0, sigma0=sigma0, u=u, ys=ys )
+    compare( mp, np.swapaxes( ys, 0, 1 ), us=u )
+
+    print( 'Passed the online filter test!\n\n' )
+
+######################################################################
+
+def testSteadyStateKalmanFilter():
+
+    T = 2000
+    D_latent = 3
+    D_obs = 4
+    D = 2
+
+    A, sigma = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_latent )
+    C, R = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_obs )
+    mu0, sigma0 = NormalInverseWishart.generate( D=D_latent )
+    u = np.random.random( ( T, D_latent ) )
+    ys = np.array( [ Regression.sample( params=( C, R ), size=T )[ 1 ] for _ in range( D ) ] )
+
+    for Filter in [ KalmanFilter, StableKalmanFilter ]:
+
+        mp = Filter()
+        mpTrue = Filter()
+        mpTrue.steady_state_tol = None
+
+        mp.updateParams( A=A, sigma=sigma, C=C, R=R, mu0=mu0, sigma0=sigma0, u=u, ys=ys )
+        mpTrue.updateParams( A=A, sigma=sigma, C=C, R=R, mu0=mu0, sigma0=sigma0, u=u, ys=ys )
+
+        start = time.time()
+        alphas, betas = ( mp.forwardFilter(), mp.backwardFilter() )
+        end = time.time()
+        print( '%s with steady state caching: '%( Filter.__name__ ), end - start )
+
+        start = time.time()
+        alphasTrue, betasTrue = ( mpTrue.forwardFilter(), mpTrue.backwardFilter() )
+        end = time.time()
+        print( '%s without steady state caching: '%( Filter.__name__ ), end - start )
+
+        for a, b, _a, _b in zip( alphas, betas, alphasTrue, betasTrue ):
+            for x, _x in zip( a, _a ):
+                assert np.allclose( x, _x, rtol=1e-6, atol=1e-6 ), x - _x
+            for x, _x in zip( b, _b ):
+                assert np.allclose( x, _x, rtol=1e-6, atol=1e-6 ), x - _x
+
+        # Changing the parameters has to throw away the cached factorizations
+        mp.updateParams( A=A, sigma=2 * sigma, C=C, R=R, mu0=mu0, sigma0=sigma0, u=u, ys=ys )
+        mpTrue.updateParams( A=A, sigma=2 * sigma, C=C, R=R, mu0=mu0, sigma0=sigma0, u=u, ys=ys )
+        assert np.allclose( mp.forwardFilter()[ -1 ][ 1 ], mpTrue.forwardFilter()[ -1 ][ 1 ] )
+
+    print( 'Passed the steady state kalman filter test!\n\n' )
+
+######################################################################
+
+def testSwitchingKalmanFilterRegimes():
+
+    T = 500
+    D_latent = 3
+    D_obs = 4
+    D = 2
+    K = 3
+
+    As, sigmas = list( zip( *[ MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_latent ) for _ in range( K ) ] ) )
+    C, R = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_obs )
+    mu0, sigma0 = NormalInverseWishart.generate( D=D_latent )
+    u = np.random.random( ( T, D_latent ) )
+    ys = np.array( [ Regression.sample( params=( C, R ), size=T )[ 1 ] for _ in range( D ) ] )
+
+    # Long runs of the same regime
+    z = np.repeat( Categorical.generate( D=K, size=T // 50 ), 50 )
+
+    mp = SwitchingKalmanFilter()
+    mp.updateParams( z, As, sigmas, C, R, mu0, sigma0, u, ys )
+
+    start = time.time()
+    alphas = mp.forwardFilter()
+    end = time.time()
+    print( 'Forward filter over regime runs: ', end - start )
+
+    # Compare against one step at a time without the steady state cache
+    mp.steady_state_tol = None
+    alphasTrue = [ mp.forwardBaseCase() ]
+    for t in range( 1, T ):
+        alphasTrue.append( mp.forwardStep( t, alphasTrue[ -1 ] ) )
+
+    for a, _a in zip( alphas, alphasTrue ):
+        for x, _x in zip( a, _a ):
+            assert np.allclose( x, _x, rtol=1e-6, atol=1e-6 ), x - _x
+
+    # The precomputed regime blocks should match a kalman filter with those parameters
+    kf = KalmanFilter()
+    for k in range( K ):
+        kf.updateParams( A=As[ k ], sigma=sigmas[ k ], C=C, R=R, mu0=mu0, sigma0=sigma0, u=u, ys=ys )
+        t = np.flatnonzero( z[ 1: ] == k )[ 0 ]
+        for x, _x in zip( mp.transitionProb( t, t + 1 ), kf.transitionProb( t, t + 1 ) ):
+            assert np.allclose( x, _x )
+
+    print( 'Passed the switching kalman filter regime test!\n\n' )
+
+######################################################################
+
 def marginalizationTest():
 
     testCategoricalHMM()
     testCategoricalHMMWithKnownStates()
+    testCategoricalHMMBatched()
+    testCategoricalHMMViterbi()
+    testScaledHMM()
     testGaussianHMM()
     testSLDSHMM()
     testKalmanFilter()
     testSwitchingKalmanFilter()
-    testStableKalmanFilter()
\ No newline at end of file
+    testSwitchingKalmanFilterRegimes()
+    testStableKalmanFilter()
+    testParallelScan()
+    testOnlineFilter()
+    testSteadyStateKalmanFilter()
\ No newline at end of file
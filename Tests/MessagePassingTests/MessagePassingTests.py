@@ -83,6 +83,116 @@ def fbsTests():
 
     print( 'Done with the improved fbs message passing tests!' )
 
+def adjacencyIndexTest():
+    # The adjacency index should give the same answers as scanning the masks
+    graphs = [ graph1(),
+               graph2(),
+               graph3(),
+               graph4(),
+               graph5(),
+               graph6(),
+               graph7(),
+               cycleGraph1(),
+               cycleGraph2(),
+               cycleGraph3(),
+               cycleGraph7(),
+               cycleGraph8(),
+               cycleGraph9(),
+               cycleGraph10(),
+               cycleGraph11(),
+               cycleGraph12() ]
+
+    msg = GraphMessagePasser()
+    msg.updateGraphs( graphs )
+
+    def check( a, b ):
+        if( isinstance( a, np.ndarray ) or isinstance( b, np.ndarray ) ):
+            assert np.array_equal( a, b )
+        elif( np.isscalar( a ) ):
+            assert a == b
+        else:
+            assert len( a ) == len( b )
+            for _a, _b in zip( a, b ):
+                check( _a, _b )
+
+    for n in msg.nodes:
+        check( msg.getUpEdges( n ), GraphMessagePasser._upEdges( msg.cmask, n ) )
+        check( msg.getDownEdges( n ), GraphMessagePasser._downEdges( msg.pmask, n ) )
+        for get_order in [ True, False ]:
+            check( msg.getParents( n, get_order=get_order ), GraphMessagePasser._parents( msg.cmask, msg.pmask, n, get_order=get_order ) )
+            check( msg.getMates( n, get_order=get_order ), GraphMessagePasser._mates( msg.cmask, msg.pmask, n, get_order=get_order ) )
+            check( msg.getMates( n, split_by_edge=True, get_order=get_order ), GraphMessagePasser._mates( msg.cmask, msg.pmask, n, split_by_edge=True, get_order=get_order ) )
+        check( msg.getSiblings( n ), GraphMessagePasser._siblings( msg.cmask, msg.pmask, n ) )
+        check( msg.getChildren( n ), GraphMessagePasser._children( msg.cmask, msg.pmask, n ) )
+        check( msg.getChildren( n, split_by_edge=True ), GraphMessagePasser._children( msg.cmask, msg.pmask, n, split_by_edge=True ) )
+
+    nodes = msg.nodes[ ::3 ]
+    check( msg.getParents( nodes, split=True ), GraphMessagePasser._parents( msg.cmask, msg.pmask, nodes, split=True ) )
+    check( msg.getChildren( nodes ), GraphMessagePasser._children( msg.cmask, msg.pmask, nodes ) )
+    check( msg.getMates( nodes, split_by_edge=True, split=True ), GraphMessagePasser._mates( msg.cmask, msg.pmask, nodes, split_by_edge=True, split=True ) )
+
+    print( 'Done with the adjacency index tests!' )
+
+def scheduleTest():
+    graphs = [ graph1(), graph2(), graph3(), graph4(), graph5(), graph6(), graph7() ]
+
+    msg = GraphMessagePasser()
+    msg.updateGraphs( graphs )
+
+    # Every node gets a U and every ( parent, edge ) pair gets a V exactly once
+    u_visited = np.hstack( [ u_list for u_list, v_list in msg.schedule ] )
+    assert np.unique( u_visited ).size == u_visited.size == msg.nodes.size
+
+    v_visited = [ ( n, e ) for u_list, ( nodes, edges ) in msg.schedule[ 1: ] for n, e in zip( nodes, edges ) ]
+    assert len( set( v_visited ) ) == len( v_visited ) == msg.pmask.nnz
+
+    widths = msg.levelWidths()
+    assert widths.shape == ( msg.n_levels, 2 )
+    assert widths[ :, 0 ].sum() == msg.nodes.size
+
+    # Replaying the schedule visits the levels in order
+    visited = []
+    def work( is_base_case, node_list ):
+        visited.append( node_list )
+    msg.upDown( work, lambda is_base_case, node_list: None )
+    assert len( visited ) == msg.n_levels
+
+    print( 'Done with the schedule tests!' )
+
+def semaphoreTest():
+    # The vectorized semaphore counts should match the loop implementation.
+    # cycleGraph4-6 are left out because they can't be built
+    graphs = [ graph1(), graph2(), graph3(), graph4(), graph5(), graph6(), graph7(), graph8(),
+               cycleGraph1(), cycleGraph2(), cycleGraph3(),
+               cycleGraph7(), cycleGraph8(), cycleGraph9(), cycleGraph10(), cycleGraph11(), cycleGraph12(),
+               cycleGraph13(), cycleGraph14(), cycleGraph15(), cycleGraph16() ]
+
+    def check( msg ):
+        u_sem, v_sem = msg.countSemaphoreInit()
+        u_sem_loop, v_sem_loop = msg.countSemaphoreInitLoop()
+        assert np.array_equal( u_sem, u_sem_loop )
+        assert np.array_equal( v_sem.row, v_sem_loop.row )
+        assert np.array_equal( v_sem.col, v_sem_loop.col )
+        assert np.array_equal( v_sem.data, v_sem_loop.data )
+
+    for graph in graphs:
+        msg = GraphMessagePasser()
+        msg.updateGraphs( [ graph ] )
+        check( msg )
+
+    msg = GraphMessagePasser()
+    msg.updateGraphs( graphs )
+    check( msg )
+
+    msg = GraphMessagePasserFBS()
+    msg.updateGraphs( graphs )
+    check( msg.partial_graph )
+
+    print( 'Done with the semaphore tests!' )
+
 def messagePassingTest():
+    adjacencyIndexTest()
+    semaphoreTest()
+    scheduleTest()
     nonFBSTest()
     fbsTests()
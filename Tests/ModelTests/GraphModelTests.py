@@ -2,6 +2,11 @@ import autograd.numpy as np
 from GenModels.GM.States.GraphicalMessagePassing import *
 from GenModels.GM.Distributions import *
 from GenModels.GM.Models.DiscreteGraphModels import *
+from GenModels.GM.Models.DiscreteGraphParameters import *
+from GenModels.GM.Models.DiscreteGraphParameters import TransitionBins
+from GenModels.GM.Models.DiscreteGraphOptimizers import GraphSmoothedState, Gibbs
+from GenModels.GM.Models.GibbsChains import *
+from GenModels.GM.Utility import rHat, effectiveSampleSize
 import time
 from collections import Iterable
 import itertools
@@ -454,5 +459,196 @@ def testSpeed():
 
 ##################################################################################################
 
+def testParameterUpdates():
+
+    np.random.seed( 2 )
+
+    d_latent = 3
+    d_obs = 4
+    measurements = 2
+
+    tester = MarginalizationTesterFBS( [ graph3(), graph5(), cycleGraph1() ], d_latent, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    msg = GraphHMMFBS()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+    U, V = msg.filter()
+
+    node_smoothed = dict( [ ( n, np.exp( val ) ) for n, val in msg.nodeSmoothed( U, V, msg.nodes ) ] )
+    parents_smoothed = dict( [ ( n, np.exp( val ) ) for n, val in msg.parentsSmoothed( U, V, msg.nodes ) ] )
+    node_parents_smoothed = dict( [ ( n, np.exp( val ) ) for n, val in msg.parentChildSmoothed( U, V, msg.nodes ) ] )
+
+    root_prior = np.ones( d_latent )
+    transition_priors = [ np.ones( dist.shape ) for dist in transition_dists ]
+    emission_prior = np.ones( ( d_latent, d_obs ) )
+
+    em = EMParameters( root_prior, transition_priors, emission_prior )
+    em.updateInitialDist( msg, node_smoothed )
+    em.updateTransitionDist( msg, parents_smoothed, node_parents_smoothed )
+    em.updateEmissionDist( msg, node_smoothed )
+
+    vi = VIParameters( root_prior, transition_priors, emission_prior )
+    transition_mfnps = vi.updatedTransitionPrior( msg, node_parents_smoothed )
+    emission_mfnp, = vi.updatedEmissionPrior( msg, node_smoothed )
+
+    # Compare against accumulating the statistics one node at a time
+    for dist, ( mfnp, ) in zip( em.transition_dists, transition_mfnps ):
+        numerator = np.zeros( dist.pi.shape )
+        denominator = np.zeros( dist.pi.shape[ :-1 ] )
+        for node in msg.nodes:
+            if( msg.getParents( node ).shape[ 0 ] + 1 == dist.pi.ndim ):
+                numerator += node_parents_smoothed[ node ]
+                denominator += parents_smoothed[ node ]
+        assert np.allclose( dist.pi, numerator / denominator[ ..., None ] )
+        assert np.allclose( mfnp, dist.prior.mf_nat_params[ 0 ] + numerator )
+
+    numerator = np.zeros( ( d_latent, d_obs ) )
+    for node in msg.nodes:
+        for y in msg.ys[ node ]:
+            numerator[ :, y ] += node_smoothed[ node ]
+    assert np.allclose( em.emission_dist.pi, numerator / numerator.sum( axis=-1 )[ :, None ] )
+    assert np.allclose( emission_mfnp, em.emission_dist.prior.mf_nat_params[ 0 ] + numerator )
+
+    roots = np.array( [ node_smoothed[ root ] for root in msg.roots ] )
+    assert np.allclose( em.initial_dist.pi, roots.mean( axis=0 ) )
+
+    print( 'Passed the parameter update tests!' )
+
+def testGibbsStateSampler():
+
+    np.random.seed( 3 )
+
+    d_latent = 3
+    d_obs = 4
+    measurements = 2
+    n_samples = 1000
+
+    # Sampling each node from P( x_c | x_p, Y ) is exact when every node has
+    # at most one parent and there is one root
+    graph = DataGraph()
+    graph.addEdge( parents=[ 0 ], children=[ 1, 2 ] )
+    graph.addEdge( parents=[ 1 ], children=[ 3 ] )
+    graph.addEdge( parents=[ 2 ], children=[ 4, 5 ] )
+
+    tester = MarginalizationTesterFBS( [ graph ], d_latent, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    msg = GraphHMMFBS()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+    U, V = msg.filter()
+
+    # The sample frequencies should match P( x | Y )
+    counts = np.zeros( ( msg.nodes.shape[ 0 ], d_latent ) )
+    for _ in range( n_samples ):
+        graph_state = GraphSmoothedState( msg, U, V )
+        states = graph_state.sample()
+        assert np.all( states >= 0 )
+        counts[ msg.nodes, states ] += 1
+
+    node_smoothed = np.array( [ np.exp( val ) for n, val in msg.nodeSmoothed( U, V, msg.nodes ) ] )
+    assert np.abs( counts / n_samples - node_smoothed ).max() < 0.06
+
+    # The transition counts should be the same as looking up the families one node at a time
+    tester = MarginalizationTesterFBS( [ graph3(), cycleGraph1() ], d_latent, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+    U, V = msg.filter()
+
+    graph_state = GraphSmoothedState( msg, U, V )
+    graph_state.sample()
+    transition_bins = TransitionBins( msg, graph_state )
+    node_states = graph_state.node_states
+    for ndim, bins in transition_bins.counts.items():
+        expected = [ [] for _ in range( ndim ) ]
+        for node in msg.nodes:
+            parents, order = msg.getParents( node, get_order=True )
+            if( parents.shape[ 0 ] + 1 != ndim ):
+                continue
+            for i, p in zip( order, parents ):
+                expected[ i ].append( node_states[ p ] )
+            expected[ -1 ].append( node_states[ node ] )
+        for count, _count in zip( bins, expected ):
+            assert np.array_equal( count, np.array( _count ) )
+
+    print( 'Passed the Gibbs state sampler test!' )
+
+def testGibbsCurrentParams():
+
+    np.random.seed( 5 )
+
+    d_latent = 3
+    d_obs = 4
+    measurements = 2
+
+    tester = MarginalizationTesterFBS( [ graph3(), cycleGraph1() ], d_latent, d_obs, measurements )
+    initial_dist, transition_dists, emission_dist = tester.generateDists()
+
+    msg = GraphHMMFBS()
+    msg.updateParams( initial_dist, transition_dists, emission_dist, tester.graphs )
+
+    params = GibbsParameters( np.ones( d_latent ), [ np.ones( dist.shape ) for dist in transition_dists ], np.ones( ( d_latent, d_obs ) ) )
+    gibbs = Gibbs( msg, params )
+
+    # The states should be sampled using the parameters from the last step, not a new draw from the prior
+    for _ in range( 3 ):
+        initial = np.copy( params.initial_dist.pi )
+        transitions = [ np.copy( dist.pi ) for dist in params.transition_dists ]
+        emission = np.copy( params.emission_dist.pi )
+
+        gibbs.resampleStates()
+
+        assert np.allclose( params.initial_dist.pi, initial )
+        assert np.allclose( np.exp( msg.pi0 ), initial )
+        for dist, transition in zip( params.transition_dists, transitions ):
+            assert np.allclose( dist.pi, transition )
+            assert np.allclose( np.exp( msg.pis[ transition.ndim ] ), transition )
+        assert np.allclose( np.exp( msg.emission_dist ), emission )
+
+        gibbs.resampleParameters()
+        assert not np.allclose( params.emission_dist.pi, emission )
+
+    print( 'Passed the Gibbs current parameters test!' )
+
+def testGibbsChains():
+
+    np.random.seed( 4 )
+
+    # Check the diagnostics on chains that mixed and chains that didn't
+    samples = np.random.normal( size=( 4, 1000, 2 ) )
+    assert np.allclose( rHat( samples ), 1.0, atol=0.01 )
+    assert np.all( effectiveSampleSize( samples ) > 3000 )
+    samples[ 0 ] += 3.0
+    assert np.all( rHat( samples ) > 1.1 )
+
+    d_latent = 2
+    d_obs = 4
+    graphs = graphToDataGraph( [ graph3(), cycleGraph1() ], lambda node: Categorical.generate( D=d_obs, size=2 ), with_fbs=True )
+
+    initial_shape, transition_shapes, emission_shape = GHMM.parameterShapes( graphs, d_latent, d_obs )
+    priors = ( np.ones( initial_shape ), [ np.ones( shape ) for shape in transition_shapes ], np.ones( emission_shape ) )
+
+    # The chains should only depend on the seed
+    chains = GibbsChains( graphs, priors, n_chains=3, seed=1 )
+    chains.step( 4 )
+    assert chains.trace.shape == ( 3, 4, chains.params[ 0 ].flatParams().shape[ 0 ] + 1 )
+    assert np.all( np.isfinite( chains.trace ) )
+    assert not np.allclose( chains.trace[ 0 ], chains.trace[ 1 ] )
+
+    parallel_chains = GibbsChains( graphs, priors, n_chains=3, seed=1, n_workers=2 )
+    parallel_chains.step( 2 )
+    parallel_chains.step( 2 )
+    parallel_chains.cleanup()
+    assert np.allclose( chains.trace, parallel_chains.trace )
+
+    converged = chains.run( 12, check_every=4, min_ess=1e10 )
+    assert converged == False and chains.n_samples == 12
+
+    print( 'Passed the Gibbs chains test!' )
+
+##################################################################################################
+
 def graphModelTests():
-    pass
\ No newline at end of file
+    testParameterUpdates()
+    testGibbsStateSampler()
+    testGibbsCurrentParams()
+    testGibbsChains()
\ No newline at end of file
@@ -181,6 +181,179 @@ def testHMMSampleStats():
 
 ##########################################################################
 
+def testHMMExpectedStats():
+    with np.errstate( under='ignore', divide='ignore', over='raise', invalid='raise' ):
+        T = 30
+        D_latent = 4
+        D_obs = 6
+        meas = 3
+        size = 4
+
+        initialDist = Dirichlet.generate( D=D_latent )
+        transDist = TransitionDirichletPrior.generate( D_in=D_latent, D_out=D_latent )
+        emissionDist = TransitionDirichletPrior.generate( D_in=D_latent, D_out=D_obs )
+
+        state = HMMState( initialDist=initialDist, transDist=transDist, emissionDist=emissionDist )
+
+        _, ys = HMMState.generate( measurements=meas, T=T, D_latent=D_latent, D_obs=D_obs, size=size )
+        alphas, betas = state.EStep( ys=ys )
+
+        Ex0, Ext_xt1, Ext_yt = state.conditionedExpectedSufficientStats( ys, alphas, betas )
+
+        # Compare against summing every time step and observation one at a time
+        trueEx0 = np.zeros( D_latent )
+        trueExt_xt1 = np.zeros( ( D_latent, D_latent ) )
+        trueExt_yt = np.zeros( ( D_latent, D_obs ) )
+        for _ys, _alphas, _betas in zip( ys, alphas, betas ):
+            marginal = np.logaddexp.reduce( _alphas[ 0 ] + _betas[ 0 ] )
+            smoothed = np.exp( _alphas + _betas - marginal )
+            trueEx0 += smoothed[ 0 ]
+            for t in range( _alphas.shape[ 0 ] - 1 ):
+                trueExt_xt1 += np.exp( state.childParentJoint( t, _alphas, _betas, ys=_ys ) - marginal )
+            for _ys_ in _ys:
+                for t, y in enumerate( _ys_ ):
+                    trueExt_yt[ :, y ] += smoothed[ t ]
+
+        assert np.allclose( Ex0, trueEx0 )
+        assert np.allclose( Ext_xt1, trueExt_xt1 )
+        assert np.allclose( Ext_yt, trueExt_yt )
+
+        print( 'Done with HMM expected stats test' )
+
+##########################################################################
+
+def testParallelSequences():
+    with np.errstate( under='ignore', divide='raise', over='raise', invalid='raise' ):
+        T = 30
+        D_latent = 3
+        D_obs = 4
+        meas = 2
+        size = 10
+
+        initialDist = Dirichlet.generate( D=D_latent )
+        transDist = TransitionDirichletPrior.generate( D_in=D_latent, D_out=D_latent )
+        emissionDist = TransitionDirichletPrior.generate( D_in=D_latent, D_out=D_obs )
+
+        state = HMMState( initialDist=initialDist, transDist=transDist, emissionDist=emissionDist )
+
+        xs, ys = HMMState.generate( measurements=meas, T=T, D_latent=D_latent, D_obs=D_obs, size=size )
+
+        alphas, betas = state.EStep( ys=ys )
+        marginal = state.last_normalizer
+        marginals = state.ilog_marginal( ys, seperateMarginals=True )
+
+        # The batched filter gets the preprocess kwargs too
+        _alphas, _betas = state.EStep( ys=ys, preprocessKwargs={ 'computeMarginal': False } )
+        for a, b, _a, _b in zip( alphas, betas, _alphas, _betas ):
+            assert np.allclose( a, _a ) and np.allclose( b, _b )
+        likelihoods = state.ilog_likelihood( ( xs, ys ), conditionOnY=True, seperateLikelihoods=True )
+
+        # Run the same things over a process pool with uneven chunks
+        state.n_sequence_workers = 2
+        state.sequence_chunksize = 3
+
+        _alphas, _betas = state.EStep( ys=ys )
+        assert np.isclose( state.last_normalizer, marginal )
+        for a, b, _a, _b in zip( alphas, betas, _alphas, _betas ):
+            assert np.allclose( a, _a ) and np.allclose( b, _b )
+
+        assert np.allclose( state.ilog_marginal( ys, seperateMarginals=True ), marginals )
+        assert np.allclose( state.ilog_likelihood( ( xs, ys ), conditionOnY=True, seperateLikelihoods=True ), likelihoods )
+
+        samples, _ = state.isample( ys=ys )
+        assert len( samples ) == size
+        stats, counts = state.conditionedSample( ys=ys, returnStats=True )
+        assert counts == [ size, size * meas, size * T, size * T * meas ]
+
+        print( 'Done with parallel sequences test' )
+
+def testPooledSamples():
+    with np.errstate( under='ignore', divide='raise', over='raise', invalid='raise' ):
+        T = 30
+        D_latent = 3
+        D_obs = 4
+        meas = 2
+        copies = 8
+
+        initialDist = Dirichlet.generate( D=D_latent )
+        transDist = TransitionDirichletPrior.generate( D_in=D_latent, D_out=D_latent )
+        emissionDist = TransitionDirichletPrior.generate( D_in=D_latent, D_out=D_obs )
+
+        state = HMMState( initialDist=initialDist, transDist=transDist, emissionDist=emissionDist )
+        state.n_sequence_workers = 4
+        state.sequence_chunksize = 2
+
+        # Sample the same sequence a bunch of times.  Every chunk should get different samples
+        _, ys = HMMState.generate( measurements=meas, T=T, D_latent=D_latent, D_obs=D_obs, size=1 )
+        ys = ys * copies
+
+        np.random.seed( 3 )
+        samples, _ = state.isample( ys=ys )
+        pool = state.sequence_pool
+        samples = np.array( samples )
+        assert len( set( [ tuple( x ) for x in samples ] ) ) > copies // 2
+
+        # The same seed gives the same samples on the same pool
+        np.random.seed( 3 )
+        _samples, _ = state.isample( ys=ys )
+        assert state.sequence_pool is pool
+        assert np.array_equal( samples, np.array( _samples ) )
+
+        state.cleanup()
+        assert hasattr( state, '_sequence_pool' ) == False
+
+        print( 'Done with pooled samples test' )
+
+##########################################################################
+
+def testStatsOnlyEStep():
+    with np.errstate( under='ignore', divide='ignore', over='raise', invalid='raise' ):
+        T = 20
+        D_latent = 3
+        D_obs = 4
+        meas = 2
+        size = 7
+
+        initialDist = Dirichlet.generate( D=D_latent )
+        transDist = TransitionDirichletPrior.generate( D_in=D_latent, D_out=D_latent )
+        emissionDist = TransitionDirichletPrior.generate( D_in=D_latent, D_out=D_obs )
+
+        state = HMMState( initialDist=initialDist, transDist=transDist, emissionDist=emissionDist )
+        _, ys = HMMState.generate( measurements=meas, T=T, D_latent=D_latent, D_obs=D_obs, size=size )
+
+        alphas, betas = state.EStep( ys=ys )
+        marginal = state.last_normalizer
+        params = state.MStep( ys, alphas, betas )
+
+        # Small chunks so that the statistics have to be combined
+        state.sequence_chunksize = 3
+        _params = state.MStepFromStats( state.EStepStats( ys=ys ) )
+        assert np.isclose( state.last_normalizer, marginal )
+        for p, _p in zip( params, _params ):
+            assert np.allclose( p, _p )
+
+        A, sigma = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_latent )
+        C, R = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_obs )
+        mu0, sigma0 = NormalInverseWishart.generate( D=D_latent )
+
+        state = LDSState( A=A, sigma=sigma, C=C, R=R, mu0=mu0, sigma0=sigma0 )
+        _, ys = LDSState.generate( measurements=meas, T=T, D_latent=D_latent, D_obs=D_obs, size=size, stabilize=True )
+        u = np.random.random( ( size, T, D_latent ) )
+
+        alphas, betas = state.EStep( ys=ys, u=u )
+        marginal = state.last_normalizer
+        params = state.MStep( ys, u, alphas, betas )
+
+        state.sequence_chunksize = 3
+        _params = state.MStepFromStats( state.EStepStats( ys=ys, u=u ) )
+        assert np.isclose( state.last_normalizer, marginal )
+        for p, _p in zip( params, _params ):
+            assert np.allclose( p, _p )
+
+        print( 'Done with stats only E-step test' )
+
+##########################################################################
+
 def testLDSSampleStats():
 
     with np.errstate( all='raise' ), scipy.special.errstate( all='raise' ):
@@ -216,9 +389,59 @@ def testLDSSampleStats():
 
 ##########################################################################
 
+def testLDSBlockSmoother():
+    with np.errstate( under='ignore', divide='raise', over='raise', invalid='raise' ):
+        D_latent = 3
+        D_obs = 4
+        meas = 2
+
+        A, sigma = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_latent )
+        C, R = MatrixNormalInverseWishart.generate( D_in=D_latent, D_out=D_obs )
+        mu0, sigma0 = NormalInverseWishart.generate( D=D_latent )
+
+        state = LDSState( A=A, sigma=sigma, C=C, R=R, mu0=mu0, sigma0=sigma0 )
+
+        def sample( T ):
+            return np.array( [ Regression.sample( params=( C, R ), size=T )[ 1 ] for _ in range( meas ) ] )
+
+        # Sequences with different lengths go in different batches
+        ysUneven = tuple( [ sample( T ) for T in [ 20, 30, 20, 30, 1 ] ] )
+
+        ys = tuple( [ sample( 25 ) for _ in range( 3 ) ] )
+        u = np.random.random( ( 3, 25, D_latent ) )
+        u[ 0, 4, 1 ] = np.nan
+
+        for _ys, _u in [ ( ysUneven, None ), ( ys, None ), ( ys, u ), ( ys, u[ 0 ] ) ]:
+            state.smoother = 'filter'
+            trueStats = state.EStepStats( ys=_ys, u=_u )
+            trueMarginal = state.last_normalizer
+
+            # EStep returns the filter messages no matter which smoother is used
+            state.smoother = 'block'
+            alphas, betas = state.EStep( ys=_ys, u=_u )
+            assert len( alphas ) == len( _ys ) and len( betas ) == len( _ys )
+
+            stats = state.EStepStats( ys=_ys, u=_u )
+            assert np.isclose( state.last_normalizer, trueMarginal )
+            for s, _s in zip( stats, trueStats ):
+                assert np.allclose( s, _s )
+
+            # Preprocess kwargs that the block smoother doesn't know about go through the filters
+            assert state.useBlockSmoother( { 'computeMarginal': False }, {} )
+            assert state.useBlockSmoother( { 'u': _u }, {} ) == False
+
+        print( 'Done with LDS block smoother test' )
+
+##########################################################################
+
 def stateTests():
     testHMMBasic()
     testLDSBasic()
     # testLDSSample()
     testHMMSampleStats()
+    testHMMExpectedStats()
+    testParallelSequences()
+    testPooledSamples()
+    testStatsOnlyEStep()
     testLDSSampleStats()
+    testLDSBlockSmoother()